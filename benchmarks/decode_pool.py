@@ -0,0 +1,34 @@
+# Decoding returned variants one after another vs in the decode thread pool:
+#   python -m benchmarks.decode_pool [workers]
+import sys
+
+from benchmarks import best_time, painting
+from image_ai_utils.common import utils
+from image_ai_utils.common.image_codecs import ImageEncoder, ImageCodec
+from image_ai_utils.common.utils import ATTACHMENT_KEY, decode_response_images
+
+SIZE = 1024
+
+
+def main():
+    # Defaults to the plugin's own pool size, which is 1 on a single core machine
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else utils.DECODE_WORKERS
+    print(f'{SIZE}x{SIZE} variants, {workers} decode workers')
+    print(f'  {"":<14}{"variants":>10}{"inline":>12}{"pool":>12}')
+    for codec in (ImageCodec.PNG, ImageCodec.WEBP):
+        data, _ = ImageEncoder(codec, png_compress_level=1).encode(painting(SIZE, SIZE))
+        for variants in (1, 4, 8):
+            response = {'images': [{ATTACHMENT_KEY: index} for index in range(variants)]}
+            attachments = [data] * variants
+            times = []
+            for decode_workers in (1, workers):
+                utils.DECODE_WORKERS = decode_workers
+                times.append(best_time(lambda: decode_response_images(response, attachments)))
+            print(
+                f'  {codec.name:<14}{variants:>10}'
+                f'{times[0] * 1000:>10.1f}ms{times[1] * 1000:>10.1f}ms'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# Encode and decode time and size of each wire codec on a painting-like layer:
+#   python -m benchmarks.image_codecs
+from io import BytesIO
+
+from benchmarks import best_time, painting
+from image_ai_utils.common.image_codecs import (
+    RawCompression, encode_raw, decode_raw, decode_image, zstandard, lz4
+)
+
+SIZE = 2048
+
+
+def main():
+    image = painting(SIZE, SIZE)
+
+    def save(**params):
+        def encode() -> bytes:
+            buffer = BytesIO()
+            image.save(buffer, **params)
+            return buffer.getvalue()
+        return encode
+
+    encoders = [
+        (f'PNG level {level}', save(format='PNG', compress_level=level)) for level in (1, 6)
+    ]
+    encoders.append((
+        'WebP lossless',
+        save(format='WEBP', lossless=True, exact=True, quality=0, method=0)
+    ))
+    available = {
+        RawCompression.NONE: True,
+        RawCompression.ZLIB: True,
+        RawCompression.LZ4: lz4 is not None,
+        RawCompression.ZSTD: zstandard is not None
+    }
+    for compression, is_available in available.items():
+        if is_available:
+            encoders.append((
+                f'RAW {compression.name.lower()}',
+                lambda compression=compression: encode_raw(image, compression)
+            ))
+
+    print(f'RGBA {SIZE}x{SIZE}, {SIZE * SIZE * 4 / 1024 / 1024:.0f}MB of pixels')
+    print(f'  {"":<16}{"size":>12}{"encode":>12}{"decode":>12}')
+    for name, encode in encoders:
+        data = encode()
+        decode = decode_raw if name.startswith('RAW') else lambda data: decode_image(data).load()
+        encode_time = best_time(encode, repeat=3)
+        decode_time = best_time(lambda: decode(data), repeat=3)
+        print(
+            f'  {name:<16}{len(data) / 1024 / 1024:>10.2f}MB'
+            f'{encode_time * 1000:>10.1f}ms{decode_time * 1000:>10.1f}ms'
+        )
+    for name, is_available in (('lz4', lz4 is not None), ('zstandard', zstandard is not None)):
+        if not is_available:
+            print(f'{name} is not installed, its RAW compression is skipped')
+
+
+if __name__ == '__main__':
+    main()
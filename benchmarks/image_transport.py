@@ -0,0 +1,42 @@
+# Size and time of sending images as base64 data URLs inside JSON vs as binary attachments:
+#   python -m benchmarks.image_transport
+import json
+
+from benchmarks import best_time, painting
+from image_ai_utils.common.image_codecs import ImageEncoder
+from image_ai_utils.common.utils import encode_request_images, decode_response_images
+
+SIZE = 2048
+IMAGES = 4
+
+
+def main():
+    images = [painting(SIZE, SIZE) for _ in range(IMAGES)]
+    encoder = ImageEncoder(png_compress_level=1)
+    # Same encoded PNGs for both transports and no pixel decoding, only the wrapping is measured
+    encoded = [encoder.encode(image) for image in images]
+    cached = {id(image): data for image, data in zip(images, encoded)}
+    encoder.encode = lambda image: cached[id(image)]
+    request_data = {'prompt': 'prompt', 'images': images}
+
+    print(f'{IMAGES} PNG images {SIZE}x{SIZE}')
+    print(f'  {"":<10}{"wire size":>12}{"wrap":>12}{"unwrap":>12}')
+    for name, binary in (('base64', False), ('binary', True)):
+        def encode():
+            data, attachments = encode_request_images(request_data, binary, encoder)
+            return json.dumps(data).encode(), attachments
+
+        message, attachments = encode()
+        size = len(message) + sum(len(attachment) for attachment in attachments)
+        wrap_time = best_time(encode)
+        unwrap_time = best_time(lambda: decode_response_images(
+            json.loads(message), attachments, lazy=True
+        ))
+        print(
+            f'  {name:<10}{size / 1024 / 1024:>10.2f}MB'
+            f'{wrap_time * 1000:>10.2f}ms{unwrap_time * 1000:>10.2f}ms'
+        )
+
+
+if __name__ == '__main__':
+    main()
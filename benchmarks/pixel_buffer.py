@@ -0,0 +1,54 @@
+# Reading Krita layer pixels and writing results back, decoding into PIL right away vs wrapping
+# them in PixelBuffer:
+#   python -m benchmarks.pixel_buffer
+from PIL import Image
+
+from benchmarks import best_time, painting
+from image_ai_utils.common.image_codecs import RawCompression, encode_raw
+from image_ai_utils.common.pixel_buffer import PixelBuffer, image_to_pixel_data, numpy
+
+WIDTH, HEIGHT = 7680, 4320
+TILE = (2048, 1024, 2560, 1536)
+
+
+def main():
+    # Same bytes Node.pixelData() returns for an 8-bit RGBA layer
+    layer = painting(WIDTH, HEIGHT).tobytes('raw', PixelBuffer.CHANNEL_ORDER)
+    # Server result of a generation at half resolution
+    result = painting(WIDTH // 2, HEIGHT // 2).convert('RGB')
+
+    def decoded() -> Image.Image:
+        return Image.frombytes('RGBA', (WIDTH, HEIGHT), layer, 'raw', PixelBuffer.CHANNEL_ORDER)
+
+    def wrapped() -> PixelBuffer:
+        return PixelBuffer(layer, WIDTH, HEIGHT)
+
+    # Uncompressed raw, so only copies are measured and not compression
+    cases = [
+        (
+            'raw encode',
+            lambda: encode_raw(decoded(), RawCompression.NONE),
+            lambda: encode_raw(wrapped(), RawCompression.NONE)
+        ),
+        (
+            '512px tile',
+            lambda: encode_raw(decoded().crop(TILE), RawCompression.NONE),
+            lambda: encode_raw(wrapped().crop(TILE), RawCompression.NONE)
+        ),
+        (
+            'insert result',
+            lambda: result.convert('RGBA').resize((WIDTH, HEIGHT)).tobytes('raw', 'BGRA'),
+            lambda: image_to_pixel_data(result, (WIDTH, HEIGHT))
+        )
+    ]
+
+    print(f'RGBA layer {WIDTH}x{HEIGHT}, numpy {"available" if numpy else "not installed"}')
+    print(f'  {"":<16}{"PIL image":>12}{"PixelBuffer":>14}')
+    for name, before, after in cases:
+        before_time = best_time(before)
+        after_time = best_time(after)
+        print(f'  {name:<16}{before_time * 1000:>10.1f}ms{after_time * 1000:>12.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
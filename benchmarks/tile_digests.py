@@ -0,0 +1,29 @@
+# Cost of finding repainted tiles of a 4K img2img source, and how much of a run is skipped when
+# only a stroke was painted since the previous one:
+#   python -m benchmarks.tile_digests
+from benchmarks import best_time, painting
+from image_ai_utils.common.pixel_buffer import PixelBuffer
+from image_ai_utils.common.tiling import TilePlan, tile_digests
+
+WIDTH, HEIGHT = 3840, 2160
+STROKE = (1000, 700, 1400, 760)
+
+
+def main():
+    plan = TilePlan(WIDTH, HEIGHT, WIDTH, HEIGHT, tile_size=512, overlap=32)
+    image = painting(WIDTH, HEIGHT)
+    buffer = PixelBuffer(image.tobytes('raw', PixelBuffer.CHANNEL_ORDER), WIDTH, HEIGHT)
+    previous = tile_digests(image, plan)
+    painted = image.copy()
+    painted.paste((255, 255, 255, 255), STROKE)
+    changed = sum(new != old for new, old in zip(tile_digests(painted, plan), previous))
+
+    print(f'RGBA {WIDTH}x{HEIGHT}, {len(plan.tiles)} tiles of 512px')
+    for name, source in (('hash PIL image', image), ('hash PixelBuffer', buffer)):
+        seconds = best_time(lambda: tile_digests(source, plan))
+        print(f'  {name:<24}{seconds * 1000:>10.1f}ms')
+    print(f'  {"tiles to regenerate":<24}{changed:>8}/{len(plan.tiles)}')
+
+
+if __name__ == '__main__':
+    main()
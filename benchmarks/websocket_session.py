@@ -0,0 +1,99 @@
+# Latency of small diffusion requests over a socket per request and over one multiplexed session,
+# and cost of sending large session attachments. Runs against a local stand-in server:
+#   python -m benchmarks.websocket_session
+import asyncio
+import json
+import time
+import tracemalloc
+
+from typing import Tuple
+
+import websockets
+from PIL import Image
+
+import benchmarks  # noqa: F401, registers the plugin package
+from image_ai_utils.common.async_client import AsyncImageAIUtilsClient
+from image_ai_utils.common.utils import image_to_base64url
+
+REQUESTS = 50
+CONCURRENT_REQUESTS = 8
+ATTACHMENT_SIZE = 32 * 1024 * 1024
+ATTACHMENTS = 8
+
+RESULT = image_to_base64url(Image.new('RGB', (8, 8))).decode()
+
+
+async def handler(websocket, path=None):
+    path = path or websocket.request.path
+    await websocket.recv()
+    if not path.endswith('session'):
+        await websocket.recv()
+        await websocket.send(json.dumps({'status': 'finished', 'result': {'images': [RESULT]}}))
+        return
+
+    async for message in websocket:
+        if isinstance(message, bytes):
+            continue
+        request = json.loads(message)
+        await websocket.send(json.dumps({
+            'request_id': request['request_id'],
+            'status': 'finished',
+            'result': {'images': [RESULT]}
+        }))
+
+
+async def request_latency(port: int, use_session: bool, concurrent: int) -> float:
+    client = AsyncImageAIUtilsClient(
+        f'127.0.0.1:{port}', 'user', 'password', use_session=use_session
+    )
+    try:
+        # First request connects the session, it's not counted
+        await client.do_diffusion_request('text_to_image', 'prompt')
+        start = time.perf_counter()
+        for _ in range(REQUESTS // concurrent):
+            await asyncio.gather(*(
+                client.do_diffusion_request('text_to_image', 'prompt') for _ in range(concurrent)
+            ))
+        return (time.perf_counter() - start) / (REQUESTS // concurrent * concurrent)
+    finally:
+        await client.close()
+
+
+# Seconds per attachment and peak memory allocated while sending
+async def attachment_send(port: int, fragmented: bool) -> Tuple[float, int]:
+    prefix = b'0' * 32
+    attachment = memoryview(bytearray(ATTACHMENT_SIZE))
+    async with websockets.connect(f'ws://127.0.0.1:{port}/session', max_size=None) as websocket:
+        await websocket.send(json.dumps({'username': 'user', 'password': 'password'}))
+        tracemalloc.start()
+        start = time.perf_counter()
+        for _ in range(ATTACHMENTS):
+            if fragmented:
+                await websocket.send([prefix, attachment])
+            else:
+                await websocket.send(prefix + attachment)
+        seconds = (time.perf_counter() - start) / ATTACHMENTS
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return seconds, peak
+
+
+async def main():
+    async with websockets.serve(handler, '127.0.0.1', 0, max_size=None) as server:
+        port = server.sockets[0].getsockname()[1]
+        print(f'Latency per request, {REQUESTS} requests')
+        print(f'  {"concurrency":<14}{"socket each":>14}{"session":>12}')
+        for concurrent in (1, CONCURRENT_REQUESTS):
+            single = await request_latency(port, False, concurrent)
+            session = await request_latency(port, True, concurrent)
+            print(f'  {concurrent:<14}{single * 1000:>12.2f}ms{session * 1000:>10.2f}ms')
+
+        print(f'Sending {ATTACHMENT_SIZE // 1024 // 1024}MB session attachment')
+        print(f'  {"":<14}{"time":>14}{"peak memory":>14}')
+        for name, fragmented in (('prefix copied', False), ('fragments', True)):
+            seconds, peak = await attachment_send(port, fragmented)
+            print(f'  {name:<14}{seconds * 1000:>12.2f}ms{peak / 1024 / 1024:>12.1f}MB')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
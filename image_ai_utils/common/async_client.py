@@ -0,0 +1,922 @@
+import asyncio
+import itertools
+import json
+import time
+from contextlib import suppress
+from contextvars import ContextVar
+from enum import Enum
+from functools import partial
+from json import JSONDecodeError
+from typing import Optional, List, Tuple, Callable, Any, Dict, Union, Awaitable, NamedTuple, \
+    Set
+
+import httpx
+import websockets
+from PIL import Image
+from websockets.exceptions import ConnectionClosed, \
+    WebSocketException as WebSocketProtocolException
+
+from .capabilities import ServerCapabilities
+from .exceptions import WebSocketException, MissingUploadsException, ConnectionLostException, \
+    ConnectionFailedException
+from .image_codecs import ImageCodec, ImageEncoder, EncodedImage, IMAGE_TYPES
+from .pixel_buffer import PixelBuffer
+from .result_cache import ResultCache, result_cache_key
+from .upload_cache import UploadCache, BLOB_KEY, image_digest
+from .utils import decode_response_images, encode_request_images, bytes_to_image
+from .websocket_session import WebSocketSession
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Id of the queued job current request belongs to. It stays the same between retries, so server
+# can re-attach to the job or return its result instead of running it again
+JOB_ID: ContextVar[Optional[str]] = ContextVar('job_id', default=None)
+RESUME_ATTEMPTS = 5
+RESUME_DELAY = 0.5
+# Blobs larger than one chunk are uploaded in parts and continue where they stopped
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UNSUPPORTED_STATUS_CODES = (
+    httpx.codes.NOT_FOUND, httpx.codes.METHOD_NOT_ALLOWED, httpx.codes.NOT_IMPLEMENTED
+)
+
+
+class ScalingMode(str, Enum):
+    SHRINK = 'shrink'
+    GROW = 'grow'
+
+
+class ESRGANModel(str, Enum):
+    # General
+    GENERAL_X4_V3 = 'general_x4_v3'
+    X4_PLUS = 'x4_plus'
+    X2_PLUS = 'x2_plus'
+    ESRNET_X4_PLUS = 'x4_plus'
+    OFFICIAL_X4 = 'official_x4'
+
+    # Anime/Illustrations
+    X4_PLUS_ANIME_6B = 'x4_plus_anime_6b'
+
+    # Anime video
+    ANIME_VIDEO_V3 = 'anime_video_v3'
+
+
+class GFPGANModel(str, Enum):
+    V1_3 = 'V1.3'
+    V1_2 = 'V1.2'
+    V1 = 'V1'
+
+
+class ImageTransport(str, Enum):
+    AUTO = 'auto'  # binary if server reports support for it
+    BASE64 = 'base64'  # images embedded into json as data urls
+    BINARY = 'binary'  # raw image bytes in binary websocket frames or multipart bodies
+
+
+class Variants(NamedTuple):
+    images: List[Image.Image]
+    # Set when server returned thumbnails, full resolution images are fetched by index
+    result_id: Optional[str] = None
+
+
+# Cancel requests by cancelling the task that awaits them
+class AsyncImageAIUtilsClient:
+    class WebSocketResponseStatus(str, Enum):
+        FINISHED = 'finished'
+        PROGRESS = 'progress'
+        PREVIEW = 'preview'  # low resolution intermediate result for one of the variants
+        VARIANT = 'variant'  # one of the variants is finished before the whole request
+
+    # Has to be created inside the event loop, asyncio primitives bind to it on python < 3.10
+    def __init__(
+            self,
+            base_url: str,
+            username: str,
+            password: str,
+            use_tls: bool = False,
+            use_session: bool = False,
+            image_transport: ImageTransport = ImageTransport.BASE64,
+            image_codec: ImageCodec = ImageCodec.PNG,
+            png_compress_level: int = 6,
+            use_http2: bool = True,
+            max_connections: int = 10,
+            max_keepalive_connections: int = 5,
+            keepalive_expiry: float = 30,
+            connect_timeout: float = 10,
+            read_timeout: Optional[float] = None,
+            use_upload_cache: bool = True,
+            upload_cache_size: int = 64,
+            result_cache: Optional[ResultCache] = None,
+            capabilities: Optional[ServerCapabilities] = None
+    ):
+        if not base_url.endswith('/'):
+            base_url += '/'
+
+        base_url = base_url.replace('http://', '')
+        base_url = base_url.replace('https://', '')
+
+        if use_tls:
+            self._base_http_url = 'https://' + base_url
+            self._base_websocket_url = 'wss://' + base_url
+        else:
+            self._base_http_url = 'http://' + base_url
+            self._base_websocket_url = 'ws://' + base_url
+
+        self._default_headers = {
+            'Accept-Encoding': 'gzip,deflate'
+        }
+        self._auth = (username, password)
+        self._connect_timeout = connect_timeout
+        self._requested_transport = ImageTransport(image_transport)
+        self._image_transport = ImageTransport.BASE64
+        self._image_encoder = ImageEncoder(
+            codec=image_codec,
+            png_compress_level=png_compress_level,
+            local_connection=base_url.startswith(('localhost', '127.0.0.1', '[::1]'))
+        )
+        self._upload_cache = UploadCache(upload_cache_size) if use_upload_cache else None
+        self._pending_uploads: Dict[str, asyncio.Future] = {}
+        self._result_cache = result_cache
+        self._session: Optional[WebSocketSession] = None
+        if use_session:
+            self._session = WebSocketSession(
+                self._base_websocket_url,
+                self._auth,
+                connect_timeout=connect_timeout,
+                throughput_meter=self._image_encoder.throughput_meter
+            )
+
+        self._http_client = httpx.AsyncClient(
+            base_url=self._base_http_url,
+            headers=self._default_headers,
+            auth=self._auth,
+            http2=use_http2 and HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry
+            ),
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+        )
+        self.apply_capabilities(capabilities or ServerCapabilities())
+
+    @property
+    def capabilities(self) -> ServerCapabilities:
+        return self._capabilities
+
+    def apply_capabilities(self, capabilities: ServerCapabilities):
+        self._capabilities = capabilities
+        transport = self._requested_transport
+        if transport == ImageTransport.AUTO:
+            # Without handshake binary support is unknown, base64 works with every server
+            transport = ImageTransport.BINARY if capabilities.transports is not None \
+                and ImageTransport.BINARY in capabilities.transports else ImageTransport.BASE64
+        elif not capabilities.supports_transport(transport):
+            transport = ImageTransport.BASE64
+        self._image_transport = transport
+        self._image_encoder.supported_codecs = capabilities.codecs
+        self._resumable_uploads = capabilities.supports_endpoint('resumable_uploads')
+        if not capabilities.supports_endpoint('blobs'):
+            self._upload_cache = None
+        # Session connects on first request, so there is nothing to close yet
+        if self._session is not None and not self._session.connected \
+                and not capabilities.supports_endpoint(WebSocketSession.SESSION_ENDPOINT):
+            self._session = None
+
+    @staticmethod
+    async def _run_in_executor(function: Callable, *args, **kwargs) -> Any:
+        # Image encoding and decoding would block every other request sharing the loop
+        return await asyncio.get_running_loop().run_in_executor(
+            None, partial(function, *args, **kwargs)
+        )
+
+    async def _single_websocket_request(
+            self,
+            request: str,
+            request_data: Dict[str, Any],
+            request_attachments: List[bytes],
+            on_update: Callable[[Dict[str, Any], List[bytes]], None]
+    ) -> Tuple[Dict[str, Any], List[bytes]]:
+        try:
+            websocket = await websockets.connect(
+                self._base_websocket_url + request,
+                max_size=None,
+                open_timeout=self._connect_timeout
+            )
+        except (OSError, asyncio.TimeoutError, WebSocketProtocolException) as e:
+            raise ConnectionFailedException(f'Couldn\'t connect to server: {e}')
+
+        attachments: List[bytes] = []
+        try:
+            await websocket.send(json.dumps({'username': self._auth[0], 'password': self._auth[1]}))
+            start = time.perf_counter()
+            frame = json.dumps(request_data)
+            await websocket.send(frame)
+            for attachment in request_attachments:
+                await websocket.send(attachment)
+            self._image_encoder.throughput_meter.record(
+                len(frame) + sum(map(len, request_attachments)), time.perf_counter() - start
+            )
+
+            while True:
+                message = await websocket.recv()
+                if isinstance(message, bytes):
+                    attachments.append(message)
+                    continue
+
+                try:
+                    response = json.loads(message)
+                except JSONDecodeError:
+                    raise WebSocketException(
+                        f'Client received message that is not in json format:\n{message}'
+                    )
+                if 'status' not in response:
+                    raise WebSocketException(f'Wrong response format:\n{message}')
+
+                if response['status'] == self.WebSocketResponseStatus.FINISHED:
+                    return response, attachments
+                on_update(response, attachments)
+        except ConnectionClosed:
+            raise ConnectionLostException(
+                'Connection to server closed unexpectedly. See server logs for details'
+            )
+        except asyncio.CancelledError:
+            with suppress(ConnectionClosed):
+                await websocket.send(json.dumps({'action': 'cancel'}))
+            raise
+        finally:
+            await websocket.close()
+
+    async def _put_blob(
+            self, digest: str, image: Union[Image.Image, PixelBuffer, EncodedImage]
+    ) -> bool:
+        data, mime_type = await self._run_in_executor(self._image_encoder.encode, image)
+        start = time.perf_counter()
+        try:
+            response = None
+            if self._resumable_uploads and len(data) > UPLOAD_CHUNK_SIZE:
+                response = await self._upload_chunked(f'blobs/{digest}/upload', data, mime_type)
+            if response is None:
+                response = await self._http_client.put(
+                    f'blobs/{digest}', content=data, headers={'Content-Type': mime_type}
+                )
+        except httpx.TransportError:
+            return False
+        self._image_encoder.throughput_meter.record(len(data), time.perf_counter() - start)
+
+        if response.status_code in UNSUPPORTED_STATUS_CODES:
+            # Server has no blob store, everything is sent inline from now on
+            self._upload_cache = None
+            return False
+        if response.is_error or self._upload_cache is None:
+            return False
+        self._upload_cache.add(digest)
+        return True
+
+    async def _upload_chunked(
+            self, url: str, data: bytes, mime_type: str
+    ) -> Optional[httpx.Response]:
+        for attempt in range(RESUME_ATTEMPTS):
+            try:
+                # Server answers with how much it already has, after dropped connection upload
+                # continues from there
+                response = await self._http_client.post(
+                    url, headers={'Upload-Length': str(len(data)), 'Upload-Type': mime_type}
+                )
+                if response.status_code in UNSUPPORTED_STATUS_CODES:
+                    self._resumable_uploads = False
+                    return None
+                offset = int(response.headers.get('Upload-Offset', 0))
+                while offset < len(data) and not response.is_error:
+                    chunk = data[offset:offset + UPLOAD_CHUNK_SIZE]
+                    response = await self._http_client.patch(
+                        url, content=chunk, headers={'Upload-Offset': str(offset)}
+                    )
+                    offset = int(response.headers.get('Upload-Offset', offset + len(chunk)))
+                return response
+            except httpx.TransportError as e:
+                if isinstance(e, httpx.ConnectError) or attempt + 1 == RESUME_ATTEMPTS:
+                    raise
+                await asyncio.sleep(RESUME_DELAY * 2 ** attempt)
+
+    async def _upload(
+            self, digest: str, image: Union[Image.Image, PixelBuffer, EncodedImage]
+    ) -> bool:
+        if self._upload_cache is None:
+            return False
+        if self._upload_cache.touch(digest):
+            return True
+
+        # Concurrent requests with the same image wait for one upload, it's shielded so
+        # cancelling one of them doesn't fail the others
+        upload = self._pending_uploads.get(digest)
+        if upload is None:
+            upload = asyncio.ensure_future(self._put_blob(digest, image))
+            self._pending_uploads[digest] = upload
+            upload.add_done_callback(lambda _: self._pending_uploads.pop(digest, None))
+        return await asyncio.shield(upload)
+
+    async def _reference_uploads(self, request_data: Dict[str, Any]) -> Dict[str, Any]:
+        if self._upload_cache is None:
+            return request_data
+        images = {
+            key: value for key, value in request_data.items()
+            if isinstance(value, IMAGE_TYPES)
+        }
+        if not images:
+            return request_data
+
+        digests = await self._run_in_executor(
+            lambda: {key: image_digest(image) for key, image in images.items()}
+        )
+        uploaded = await asyncio.gather(
+            *(self._upload(digests[key], image) for key, image in images.items())
+        )
+        request_data = dict(request_data)
+        for key, is_uploaded in zip(images, uploaded):
+            # Images that couldn't be uploaded are sent inline
+            if is_uploaded:
+                request_data[key] = {BLOB_KEY: digests[key]}
+        return request_data
+
+    async def _with_uploads(
+            self,
+            send: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+            request_data: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        referenced_data = await self._reference_uploads(request_data)
+        if referenced_data is request_data:
+            return await send(request_data)
+
+        try:
+            return await send(referenced_data)
+        except MissingUploadsException as e:
+            # Server has already evicted some of the images, they are sent inline this time
+            if self._upload_cache is not None:
+                self._upload_cache.discard(e.digests)
+            return await send(request_data)
+
+    async def _websocket_request(
+            self,
+            request: str,
+            request_data: Dict[str, Any],
+            progress_callback: Optional[Callable[[float], None]] = None,
+            preview_callback: Optional[Callable[[int, Image.Image], None]] = None,
+            lazy_images: bool = False
+    ) -> Dict[str, Any]:
+        return await self._with_resume(
+            lambda acknowledged: self._with_uploads(
+                partial(
+                    self._send_websocket_request,
+                    request,
+                    progress_callback=progress_callback,
+                    preview_callback=preview_callback,
+                    lazy_images=lazy_images,
+                    acknowledged=acknowledged
+                ),
+                request_data
+            ),
+            ConnectionLostException
+        )
+
+    @staticmethod
+    async def _with_resume(
+            send: Callable[[asyncio.Event], Awaitable[Dict[str, Any]]], *errors: type
+    ) -> Dict[str, Any]:
+        # Without job id server can't tell resent request from a new one, and until it has
+        # acknowledged the job there is nothing to re-attach to. Both are left to the job queue,
+        # which can also move the job to another server
+        acknowledged = asyncio.Event()
+        for attempt in itertools.count():
+            try:
+                return await send(acknowledged)
+            except errors:
+                if JOB_ID.get() is None or not acknowledged.is_set() \
+                        or attempt + 1 >= RESUME_ATTEMPTS:
+                    raise
+            await asyncio.sleep(RESUME_DELAY * 2 ** attempt)
+
+    async def _send_websocket_request(
+            self,
+            request: str,
+            request_data: Dict[str, Any],
+            progress_callback: Optional[Callable[[float], None]] = None,
+            preview_callback: Optional[Callable[[int, Image.Image], None]] = None,
+            lazy_images: bool = False,
+            acknowledged: Optional[asyncio.Event] = None
+    ) -> Dict[str, Any]:
+        binary = self._image_transport == ImageTransport.BINARY
+        request_data, request_attachments = await self._run_in_executor(
+            encode_request_images, request_data, binary, self._image_encoder
+        )
+        if binary:
+            request_data['image_transport'] = self._image_transport
+        if JOB_ID.get() is not None:
+            request_data['job_id'] = JOB_ID.get()
+        if preview_callback is not None:
+            request_data['stream_previews'] = True
+
+        # Previews are decoded in executor, so they can finish out of order. Preview that was
+        # overtaken by a newer one of the same variant is dropped
+        preview_tasks: Set[asyncio.Future] = set()
+        preview_order = itertools.count()
+        shown_previews: Dict[int, int] = {}
+
+        async def show_preview(variant: int, order: int, image: Any, attachments: List[bytes]):
+            image = await self._run_in_executor(decode_response_images, image, attachments)
+            if shown_previews.get(variant, -1) < order:
+                shown_previews[variant] = order
+                preview_callback(variant, image)
+
+        def on_update(update: Dict[str, Any], update_attachments: List[bytes]):
+            # Any update means server has registered the job under its id
+            if acknowledged is not None:
+                acknowledged.set()
+            status = update['status']
+            if status == self.WebSocketResponseStatus.PROGRESS:
+                if progress_callback is not None:
+                    progress_callback(update['progress'])
+            elif status in (
+                    self.WebSocketResponseStatus.PREVIEW, self.WebSocketResponseStatus.VARIANT
+            ):
+                if preview_callback is not None:
+                    task = asyncio.ensure_future(show_preview(
+                        update['variant'], next(preview_order), update['image'], update_attachments
+                    ))
+                    preview_tasks.add(task)
+                    task.add_done_callback(preview_tasks.discard)
+
+        try:
+            if self._session is not None:
+                response, attachments = await self._session.request(
+                    request, request_data, request_attachments, on_update
+                )
+            else:
+                response, attachments = await self._single_websocket_request(
+                    request, request_data, request_attachments, on_update
+                )
+        finally:
+            # Previews still being decoded would overwrite final variants
+            for task in preview_tasks:
+                task.cancel()
+
+        if 'missing_blobs' in response:
+            raise MissingUploadsException(response['missing_blobs'])
+        if 'result' not in response:
+            raise WebSocketException('Haven\'t received result from server')
+        result = response['result']
+        if preview_callback is not None and not lazy_images \
+                and isinstance(result.get('images'), list):
+            # Variants are shown in the dialog as soon as each of them is decoded
+            images = await self._run_in_executor(
+                decode_response_images, result['images'], attachments, preview_callback
+            )
+            result = {key: value for key, value in result.items() if key != 'images'}
+            response['result'] = await self._run_in_executor(
+                decode_response_images, result, attachments
+            )
+            response['result']['images'] = images
+        else:
+            response['result'] = await self._run_in_executor(
+                decode_response_images, result, attachments, lazy=lazy_images
+            )
+        return response
+
+    async def _http_request(
+            self, request: str, request_data: Dict[str, Any], lazy_images: bool = False
+    ) -> Dict[str, Any]:
+        return await self._with_resume(
+            lambda acknowledged: self._with_uploads(
+                partial(
+                    self._send_http_request,
+                    request,
+                    lazy_images=lazy_images,
+                    acknowledged=acknowledged
+                ),
+                request_data
+            ),
+            httpx.TransportError
+        )
+
+    async def _send_http_request(
+            self,
+            request: str,
+            request_data: Dict[str, Any],
+            lazy_images: bool = False,
+            acknowledged: Optional[asyncio.Event] = None
+    ) -> Dict[str, Any]:
+        # Lets server answer resent request with result of the first one
+        headers = {'Idempotency-Key': JOB_ID.get()} if JOB_ID.get() is not None else {}
+
+        async def trace(event_name: str, _: Dict[str, Any]):
+            # Once the whole body is written server has the job under its idempotency key
+            if acknowledged is not None and event_name.endswith('send_request_body.complete'):
+                acknowledged.set()
+
+        if self._image_transport == ImageTransport.BINARY:
+            mime_types: List[str] = []
+            request_data, attachments = await self._run_in_executor(
+                encode_request_images,
+                request_data,
+                binary=True,
+                encoder=self._image_encoder,
+                mime_types=mime_types
+            )
+            response = await self._http_client.post(
+                request,
+                data={'request': json.dumps(request_data)},
+                files=[
+                    (
+                        'attachments',
+                        (f'{i}.{ImageCodec.extension(mime_type)}', attachment, mime_type)
+                    )
+                    for i, (attachment, mime_type) in enumerate(zip(attachments, mime_types))
+                ],
+                headers={'Accept': self._accept_header(), **headers},
+                extensions={'trace': trace}
+            )
+        else:
+            request_data, _ = await self._run_in_executor(
+                encode_request_images, request_data, encoder=self._image_encoder
+            )
+            response = await self._http_client.post(
+                request, json=request_data, headers=headers, extensions={'trace': trace}
+            )
+
+        if response.status_code == httpx.codes.CONFLICT:
+            with suppress(ValueError):
+                missing_blobs = response.json().get('missing_blobs')
+                if missing_blobs:
+                    raise MissingUploadsException(missing_blobs)
+        return await self._decode_http_response(response, lazy_images)
+
+    def _accept_header(self) -> str:
+        # Images are answered in any codec server negotiated, before handshake only PNG is known
+        codecs = self._image_encoder.supported_codecs or [ImageCodec.PNG]
+        mime_types = [
+            codec.mime_type for codec in ImageCodec
+            if codec in codecs and codec != ImageCodec.AUTO
+        ]
+        return ', '.join(mime_types + ['application/json'])
+
+    async def _decode_http_response(
+            self, response: httpx.Response, lazy_images: bool = False
+    ) -> Dict[str, Any]:
+        response.raise_for_status()
+        # Servers without binary transport support answer with json and data urls
+        if response.headers.get('content-type', '').startswith('image/'):
+            decode = EncodedImage if lazy_images else bytes_to_image
+            return {'image': await self._run_in_executor(decode, response.content)}
+        return await self._run_in_executor(
+            decode_response_images, response.json(), [], lazy=lazy_images
+        )
+
+    @staticmethod
+    def _image_size(image: Optional[Image.Image]) -> Tuple[int, int]:
+        return image.size if image is not None else (512, 512)
+
+    def _output_format(self, width: int, height: int) -> str:
+        return self._image_encoder.resolve(width, height).output_format
+
+    async def do_diffusion_request(
+            self,
+            request: str,
+            prompt: str,
+            num_variants: int = 6,
+            num_inference_steps: int = 50,
+            guidance_scale: float = 7.5,
+            seed: Optional[int] = None,
+            progress_callback: Optional[Callable[[float], None]] = None,
+            scaling_mode: ScalingMode = ScalingMode.GROW,
+            return_raw: bool = False,
+            preview_callback: Optional[Callable[[int, Image.Image], None]] = None,
+            thumbnail_size: Optional[int] = None,
+            lazy_images: bool = False,
+            render_size: Optional[Tuple[int, int]] = None,
+            **kwargs
+    ) -> Union[List[Image.Image], List[EncodedImage], Variants, Dict[str, Any]]:
+        request_data = {
+            'prompt': prompt,
+            'num_inference_steps': num_inference_steps,
+            'guidance_scale': guidance_scale,
+            'num_variants': num_variants,
+            'output_format': self._output_format(*self._image_size(kwargs.get('source_image'))),
+            'scaling_mode': scaling_mode,
+        }
+        request_data.update(kwargs)
+        if seed is not None:
+            request_data['seed'] = seed
+        # Servers that predate explicit sizes ignore them and derive size from scaling mode
+        if render_size is not None:
+            request_data['width'], request_data['height'] = render_size
+
+        # Same parameters and source images with fixed seed give the same images
+        response, cache_key = None, None
+        if seed is not None and self._result_cache is not None:
+            cache_key = await self._run_in_executor(
+                result_cache_key, self._base_http_url, request, request_data
+            )
+            result = await self._run_in_executor(self._result_cache.get, cache_key, lazy_images)
+            if result is not None:
+                response = {'result': result}
+                if progress_callback is not None:
+                    progress_callback(1.)
+
+        if response is None:
+            if thumbnail_size and self._capabilities.supports_endpoint('results'):
+                request_data['thumbnail_size'] = thumbnail_size
+            response = await self._websocket_request(
+                request, request_data, progress_callback, preview_callback, lazy_images
+            )
+            # Only full resolution results are worth caching
+            if cache_key is not None and 'result_id' not in response['result']:
+                await self._run_in_executor(self._result_cache.put, cache_key, response['result'])
+
+        if return_raw:
+            return response
+        elif thumbnail_size:
+            return Variants(response['result']['images'], response['result'].get('result_id'))
+        else:
+            return response['result']['images']
+
+    async def text_to_image(
+            self,
+            prompt: str,
+            aspect_ratio: float,
+            num_variants: int = 6,
+            num_inference_steps: int = 50,
+            guidance_scale: float = 7.5,
+            seed: Optional[int] = None,
+            progress_callback: Optional[Callable[[float], None]] = None,
+            preview_callback: Optional[Callable[[int, Image.Image], None]] = None,
+            scaling_mode: ScalingMode = ScalingMode.GROW,
+            thumbnail_size: Optional[int] = None,
+            lazy_images: bool = False,
+            render_size: Optional[Tuple[int, int]] = None
+    ) -> Union[List[Image.Image], Variants]:
+        return await self.do_diffusion_request(
+            'text_to_image',
+            prompt=prompt,
+            aspect_ratio=aspect_ratio,
+            num_variants=num_variants,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            seed=seed,
+            progress_callback=progress_callback,
+            preview_callback=preview_callback,
+            scaling_mode=scaling_mode,
+            thumbnail_size=thumbnail_size,
+            lazy_images=lazy_images,
+            render_size=render_size
+        )
+
+    async def image_to_image(
+            self,
+            prompt: str,
+            source_image: Image.Image,
+            strength: float = 0.8,
+            num_variants: int = 6,
+            num_inference_steps: int = 50,
+            guidance_scale: float = 7.5,
+            seed: Optional[int] = None,
+            progress_callback: Optional[Callable[[float], None]] = None,
+            preview_callback: Optional[Callable[[int, Image.Image], None]] = None,
+            scaling_mode: ScalingMode = ScalingMode.GROW,
+            thumbnail_size: Optional[int] = None,
+            lazy_images: bool = False,
+            render_size: Optional[Tuple[int, int]] = None
+    ) -> Union[List[Image.Image], Variants]:
+        return await self.do_diffusion_request(
+            'image_to_image',
+            prompt=prompt,
+            source_image=source_image,
+            strength=strength,
+            num_variants=num_variants,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            seed=seed,
+            progress_callback=progress_callback,
+            preview_callback=preview_callback,
+            scaling_mode=scaling_mode,
+            thumbnail_size=thumbnail_size,
+            lazy_images=lazy_images,
+            render_size=render_size
+        )
+
+    async def make_tilable(
+            self,
+            prompt: str,
+            source_image: Image.Image,
+            strength: float = 0.8,
+            num_variants: int = 6,
+            num_inference_steps: int = 50,
+            guidance_scale: float = 7.5,
+            seed: Optional[int] = None,
+            progress_callback: Optional[Callable[[float], None]] = None,
+            preview_callback: Optional[Callable[[int, Image.Image], None]] = None,
+            scaling_mode: ScalingMode = ScalingMode.GROW,
+            border_width: int = 50,
+            border_softness: float = 0.5,
+            thumbnail_size: Optional[int] = None,
+            lazy_images: bool = False,
+            render_size: Optional[Tuple[int, int]] = None
+    ) -> Tuple[Union[List[Image.Image], Variants], Image.Image]:
+        response = await self.do_diffusion_request(
+            'make_tilable',
+            return_raw=True,
+            prompt=prompt,
+            source_image=source_image,
+            strength=strength,
+            num_variants=num_variants,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            seed=seed,
+            progress_callback=progress_callback,
+            preview_callback=preview_callback,
+            scaling_mode=scaling_mode,
+            thumbnail_size=thumbnail_size,
+            lazy_images=lazy_images,
+            border_width=border_width,
+            border_softness=border_softness,
+            render_size=render_size
+        )
+
+        images = response['result']['images']
+        if thumbnail_size:
+            images = Variants(images, response['result'].get('result_id'))
+        return images, response['result']['mask']
+
+    async def inpaint(
+            self,
+            prompt: str,
+            source_image: Image.Image,
+            mask: Optional[Image.Image],
+            strength: float = 0.8,
+            num_variants: int = 6,
+            num_inference_steps: int = 50,
+            guidance_scale: float = 7.5,
+            seed: Optional[int] = None,
+            progress_callback: Optional[Callable[[float], None]] = None,
+            preview_callback: Optional[Callable[[int, Image.Image], None]] = None,
+            scaling_mode: ScalingMode = ScalingMode.GROW,
+            thumbnail_size: Optional[int] = None,
+            lazy_images: bool = False,
+            render_size: Optional[Tuple[int, int]] = None
+    ) -> Union[List[Image.Image], Variants]:
+        extra_kwargs = {}
+        if mask is not None:
+            extra_kwargs['mask'] = mask
+        return await self.do_diffusion_request(
+            'inpainting',
+            prompt=prompt,
+            source_image=source_image,
+            strength=strength,
+            num_variants=num_variants,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            seed=seed,
+            progress_callback=progress_callback,
+            preview_callback=preview_callback,
+            scaling_mode=scaling_mode,
+            thumbnail_size=thumbnail_size,
+            lazy_images=lazy_images,
+            render_size=render_size,
+            **extra_kwargs
+        )
+
+    async def gobig(
+            self,
+            prompt: str,
+            source_image: Image.Image,
+            target_width: int,
+            target_height: int,
+            use_real_esrgan: bool = True,
+            esrgan_model: ESRGANModel = ESRGANModel.GENERAL_X4_V3,
+            maximize: bool = True,
+            overlap: int = 64,
+            strength: float = 0.8,
+            num_inference_steps: int = 50,
+            guidance_scale: float = 7.5,
+            seed: Optional[int] = None,
+            progress_callback: Optional[Callable[[float], None]] = None,
+            lazy_images: bool = False
+    ) -> Union[Image.Image, EncodedImage]:
+        request_data = {
+            'prompt': prompt,
+            'output_format': self._output_format(target_width, target_height),
+            'num_inference_steps': num_inference_steps,
+            'guidance_scale': guidance_scale,
+            'seed': seed,
+            'image': source_image,
+            'use_real_esrgan': use_real_esrgan,
+            'esrgan_model': esrgan_model,
+            'maximize': maximize,
+            'strength': strength,
+            'target_width': target_width,
+            'target_height': target_height,
+            'overlap': overlap
+        }
+        response = await self._websocket_request(
+            'gobig', request_data, progress_callback, lazy_images=lazy_images
+        )
+        return response['result']['image']
+
+    async def upscale(
+            self,
+            source_image: Image.Image,
+            target_width: int,
+            target_height: int,
+            esrgan_model: ESRGANModel = ESRGANModel.GENERAL_X4_V3,
+            maximize: bool = True,
+            progress_callback: Optional[Callable[[float], None]] = None,
+            lazy_images: bool = False
+    ) -> Union[Image.Image, EncodedImage]:
+        request_data = {
+            'image': source_image,
+            'target_width': target_width,
+            'target_height': target_height,
+            'model': esrgan_model,
+            'output_format': self._output_format(target_width, target_height),
+            'maximize': maximize
+        }
+
+        result = (await self._http_request('upscale', request_data, lazy_images))['image']
+        if progress_callback is not None:
+            progress_callback(1.)
+        return result
+
+    async def restore_face(
+            self,
+            source_image: Image.Image,
+            model_type: GFPGANModel = GFPGANModel.V1_3,
+            use_real_esrgan: bool = True,
+            bg_tile: int = 400,
+            upscale: int = 2,
+            aligned: bool = False,
+            only_center_face: bool = False,
+            progress_callback: Optional[Callable[[float], None]] = None,
+            lazy_images: bool = False
+    ) -> Union[Image.Image, EncodedImage]:
+        request_data = {
+            'image': source_image,
+            'model_type': model_type,
+            'output_format': self._output_format(
+                source_image.width * upscale, source_image.height * upscale
+            ),
+            'use_real_esrgan': use_real_esrgan,
+            'bg_tile': bg_tile,
+            'upscale': upscale,
+            'aligned': aligned,
+            'only_center_face': only_center_face
+        }
+
+        result = (await self._http_request('restore_face', request_data, lazy_images))['image']
+        if progress_callback is not None:
+            progress_callback(1.)
+        return result
+
+    async def fetch_variants(
+            self,
+            result_id: str,
+            indices: List[int],
+            progress_callback: Optional[Callable[[float], None]] = None
+    ) -> List[Image.Image]:
+        async def fetch(index: int) -> Image.Image:
+            response = await self._http_client.get(
+                f'results/{result_id}/{index}', headers={'Accept': 'image/png, application/json'}
+            )
+            return (await self._decode_http_response(response))['image']
+
+        images = await asyncio.gather(*(fetch(index) for index in indices))
+        if progress_callback is not None:
+            progress_callback(1.)
+        return list(images)
+
+    async def get_capabilities(self) -> ServerCapabilities:
+        response = await self._http_client.get('capabilities')
+        if response.status_code in (httpx.codes.NOT_FOUND, httpx.codes.METHOD_NOT_ALLOWED):
+            # Server predates handshake
+            return ServerCapabilities()
+        response.raise_for_status()
+        return ServerCapabilities.from_json(response.json())
+
+    async def check_health(self) -> Tuple[float, Optional[int]]:
+        # Latency and number of requests waiting on server, raises if server is unreachable
+        start = time.perf_counter()
+        capabilities = await self.get_capabilities()
+        return time.perf_counter() - start, capabilities.queue_depth
+
+    async def test_connection(self) -> Tuple[bool, str]:
+        try:
+            response = await self._http_client.get('ping')
+            return response.status_code == httpx.codes.OK, response.text
+        except Exception as e:
+            return False, f'Exception: {type(e)}'
+
+    async def close(self):
+        await self._http_client.aclose()
+        if self._session is not None:
+            await self._session.close()
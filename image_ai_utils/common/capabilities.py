@@ -0,0 +1,85 @@
+import json
+import os
+from typing import Optional, List, NamedTuple, Dict, Any, Tuple
+
+from .settings import SETTINGS_PATH
+
+CAPABILITIES_PATH = os.path.join(os.path.dirname(SETTINGS_PATH), 'capabilities.json')
+
+_capabilities: Optional[Dict[str, 'ServerCapabilities']] = None
+
+
+# What server reported on handshake. None means server didn't report that field (older servers
+# don't have capabilities endpoint at all), then everything is assumed to be supported and
+# unsupported features are still discovered by failed requests
+class ServerCapabilities(NamedTuple):
+    version: Optional[str] = None
+    endpoints: Optional[List[str]] = None
+    esrgan_models: Optional[List[str]] = None
+    gfpgan_models: Optional[List[str]] = None
+    codecs: Optional[List[str]] = None
+    transports: Optional[List[str]] = None
+    max_resolution: Optional[int] = None
+    queue_depth: Optional[int] = None
+    # [width, height] sizes diffusion is rendered at, server with buckets accepts explicit size
+    resolution_buckets: Optional[List[List[int]]] = None
+    max_pixels: Optional[int] = None  # largest render that fits into VRAM
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> 'ServerCapabilities':
+        # Fields added by newer servers are ignored
+        return cls(**{key: value for key, value in data.items() if key in cls._fields})
+
+    def to_json(self) -> Dict[str, Any]:
+        return self._asdict()
+
+    def supports_endpoint(self, endpoint: str) -> bool:
+        return self.endpoints is None or endpoint in self.endpoints
+
+    def supports_transport(self, transport: str) -> bool:
+        return self.transports is None or transport in self.transports
+
+
+def model_choices(
+        known: List[Tuple[str, str]], supported: Optional[List[str]]
+) -> List[Tuple[str, str]]:
+    # (display name, model) pairs. Known models keep their names and order, models only newer
+    # server knows about are added after them
+    if supported is None:
+        return list(known)
+    known_models = [model for _, model in known]
+    return [(name, model) for name, model in known if model in supported] + \
+        [(model, model) for model in supported if model not in known_models]
+
+
+def _load() -> Dict[str, ServerCapabilities]:
+    global _capabilities
+    if _capabilities is None:
+        _capabilities = {}
+        if os.path.isfile(CAPABILITIES_PATH):
+            try:
+                with open(CAPABILITIES_PATH, 'r') as f:
+                    _capabilities = {
+                        server: ServerCapabilities.from_json(data)
+                        for server, data in json.load(f).items()
+                    }
+            except (OSError, ValueError, TypeError):
+                pass
+    return _capabilities
+
+
+def load_capabilities(server_url: str) -> Optional[ServerCapabilities]:
+    return _load().get(server_url)
+
+
+# Handshake is only done when settings are saved, so capabilities are kept between sessions
+def store_capabilities(server_url: str, capabilities: ServerCapabilities):
+    capabilities_by_server = _load()
+    capabilities_by_server[server_url] = capabilities
+    try:
+        with open(CAPABILITIES_PATH, 'w') as f:
+            json.dump(
+                {server: value.to_json() for server, value in capabilities_by_server.items()}, f
+            )
+    except OSError:
+        pass
@@ -1,389 +1,217 @@
-import json
-from enum import Enum
-from json import JSONDecodeError
-from typing import Optional, List, Tuple, Callable, Any, Dict, Union
+import asyncio
+import threading
+from typing import Optional, List, Tuple, Any, Dict, Union, Coroutine, Callable
 
 import httpx
 from PIL import Image
-from websocket import STATUS_NORMAL, WebSocketApp, \
-    WebSocketConnectionClosedException
+from .async_client import AsyncImageAIUtilsClient, ScalingMode, ESRGANModel, GFPGANModel, \
+    ImageTransport, Variants
+from .cancellation import CancellationToken
+from .capabilities import ServerCapabilities, load_capabilities, store_capabilities
+from .event_loop import BackgroundEventLoop
+from .exceptions import WebSocketException
+from .image_codecs import EncodedImage
+from .result_cache import ResultCache
 from .settings import Settings
-from .utils import base64url_to_image, image_to_base64url
 
+# Enums and exception were defined here before async client, they are kept importable from here
+__all__ = [
+    'ImageAIUtilsClient',
+    'ScalingMode',
+    'ESRGANModel',
+    'GFPGANModel',
+    'ImageTransport',
+    'Variants',
+    'WebSocketException',
+]
 
-class ScalingMode(str, Enum):
-    SHRINK = 'shrink'
-    GROW = 'grow'
-
-
-class ESRGANModel(str, Enum):
-    # General
-    GENERAL_X4_V3 = 'general_x4_v3'
-    X4_PLUS = 'x4_plus'
-    X2_PLUS = 'x2_plus'
-    ESRNET_X4_PLUS = 'x4_plus'
-    OFFICIAL_X4 = 'official_x4'
-
-    # Anime/Illustrations
-    X4_PLUS_ANIME_6B = 'x4_plus_anime_6b'
-
-    # Anime video
-    ANIME_VIDEO_V3 = 'anime_video_v3'
 
+# Blocking wrappers around AsyncImageAIUtilsClient, all requests run on the shared event loop
+# TODO check response code and throw custom exception
+class ImageAIUtilsClient:
+    def __init__(self, *args, **kwargs):
+        self._loop = BackgroundEventLoop.instance()
 
-class GFPGANModel(str, Enum):
-    V1_3 = 'V1.3'
-    V1_2 = 'V1.2'
-    V1 = 'V1'
+        async def create_async_client() -> AsyncImageAIUtilsClient:
+            return AsyncImageAIUtilsClient(*args, **kwargs)
 
+        self._async_client = self._loop.run(create_async_client())
+        # Jobs running on this client, replaced client is closed only after they finish
+        self._users = 0
+        self._retired = False
+        self._users_lock = threading.Lock()
 
-class WebSocketException(Exception):
-    def __init__(self, message):
-        self.message = message
+    @property
+    def async_client(self) -> AsyncImageAIUtilsClient:
+        return self._async_client
 
-
-# TODO check response code and throw custom exception
-class ImageAIUtilsClient:
-    class WebSocketResponseStatus(str, Enum):
-        FINISHED = 'finished'
-        PROGRESS = 'progress'
-
-    def __init__(self, base_url: str, username: str, password: str, use_tls: bool = False):
-        if not base_url.endswith('/'):
-            base_url += '/'
-
-        base_url = base_url.replace('http://', '')
-        base_url = base_url.replace('https://', '')
-
-        if use_tls:
-            self._base_http_url = 'https://' + base_url
-            self._base_websocket_url = 'wss://' + base_url
-        else:
-            self._base_http_url = 'http://' + base_url
-            self._base_websocket_url = 'ws://' + base_url
-
-        self._default_headers = {
-            'Accept-Encoding': 'gzip,deflate'
-        }
-        self._auth = (username, password)
-
-    def _websocket_request(
-            self,
-            request: str,
-            request_data: Dict[str, Any],
-            progress_callback: Optional[Callable[[float], None]] = None,
-    ) -> Dict[str, Any]:
-        response: Optional[Dict[str, Any]] = None
-
-        def on_error(_, error):
-            if isinstance(error, WebSocketConnectionClosedException):
-                error = WebSocketException(
-                    'Connection to server closed unexpectedly. See server logs for details'
-                )
-            if isinstance(error, ConnectionRefusedError):
-                error = WebSocketException('Couldn\'t connect to server')
-            raise error
-
-        def on_close(_, status_code: int, message: str):
-            if status_code != STATUS_NORMAL:
-                raise WebSocketException(message)
-            if not response or response.get('status') != self.WebSocketResponseStatus.FINISHED:
-                raise WebSocketException('Haven\'t received ')
-
-        def on_message(ws: WebSocketApp, message: str):
-            try:
-                nonlocal response
-                response = json.loads(message)
-                if 'status' not in response:
-                    raise WebSocketException(f'Wrong response format:\n{message}')
-
-                if response['status'] == self.WebSocketResponseStatus.PROGRESS:
-                    progress_callback(response['progress'])
-            except JSONDecodeError:
-                raise WebSocketException(
-                    f'Client received message that is not in json format:\n{message}'
-                )
-
-        def on_open(ws: WebSocketApp):
-            ws.send(json.dumps({'username': self._auth[0], 'password': self._auth[1]}))
-            ws.send(json.dumps(request_data))
-
-        app = WebSocketApp(
-            self._base_websocket_url + request,
-            on_message=on_message,
-            on_error=on_error,
-            on_close=on_close,
-            on_open=on_open,
-        )
-        app.run_forever()
-
-        return response
+    def _run(
+            self, coroutine: Coroutine, cancellation_token: Optional[CancellationToken] = None
+    ) -> Any:
+        return self._loop.run(coroutine, cancellation_token)
 
     def do_diffusion_request(
-            self,
-            request: str,
-            prompt: str,
-            num_variants: int = 6,
-            num_inference_steps: int = 50,
-            guidance_scale: float = 7.5,
-            seed: Optional[int] = None,
-            progress_callback: Optional[Callable[[float], None]] = None,
-            scaling_mode: ScalingMode = ScalingMode.GROW,
-            return_raw: bool = False,
-            **kwargs
-    ) -> Union[List[Image.Image], Dict[str, Any]]:
-        request_data = {
-            'prompt': prompt,
-            'num_inference_steps': num_inference_steps,
-            'guidance_scale': guidance_scale,
-            'num_variants': num_variants,
-            'output_format': 'PNG',
-            'scaling_mode': scaling_mode,
-        }
-        request_data.update(kwargs)
-        if seed is not None:
-            request_data['seed'] = seed
-
-        response = self._websocket_request(request, request_data, progress_callback)
-
-        if return_raw:
-            return response
-        else:
-            images = response['result']['images']
-            return [base64url_to_image(image.encode()) for image in images]
+            self, *args, cancellation_token: Optional[CancellationToken] = None, **kwargs
+    ) -> Union[List[Image.Image], List[EncodedImage], Variants, Dict[str, Any]]:
+        return self._run(
+            self._async_client.do_diffusion_request(*args, **kwargs), cancellation_token
+        )
 
     def text_to_image(
-            self,
-            prompt: str,
-            aspect_ratio: float,
-            num_variants: int = 6,
-            num_inference_steps: int = 50,
-            guidance_scale: float = 7.5,
-            seed: Optional[int] = None,
-            progress_callback: Optional[Callable[[float], None]] = None,
-            scaling_mode: ScalingMode = ScalingMode.GROW
-    ) -> List[Image.Image]:
-        return self.do_diffusion_request(
-            'text_to_image',
-            prompt=prompt,
-            aspect_ratio=aspect_ratio,
-            num_variants=num_variants,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            seed=seed,
-            progress_callback=progress_callback,
-            scaling_mode=scaling_mode
-        )
+            self, *args, cancellation_token: Optional[CancellationToken] = None, **kwargs
+    ) -> Union[List[Image.Image], Variants]:
+        return self._run(self._async_client.text_to_image(*args, **kwargs), cancellation_token)
 
     def image_to_image(
-            self,
-            prompt: str,
-            source_image: Image.Image,
-            strength: float = 0.8,
-            num_variants: int = 6,
-            num_inference_steps: int = 50,
-            guidance_scale: float = 7.5,
-            seed: Optional[int] = None,
-            progress_callback: Optional[Callable[[float], None]] = None,
-            scaling_mode: ScalingMode = ScalingMode.GROW
-    ) -> List[Image.Image]:
-        return self.do_diffusion_request(
-            'image_to_image',
-            prompt=prompt,
-            source_image=image_to_base64url(source_image).decode(),
-            strength=strength,
-            num_variants=num_variants,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            seed=seed,
-            progress_callback=progress_callback,
-            scaling_mode=scaling_mode
-        )
+            self, *args, cancellation_token: Optional[CancellationToken] = None, **kwargs
+    ) -> Union[List[Image.Image], Variants]:
+        return self._run(self._async_client.image_to_image(*args, **kwargs), cancellation_token)
 
     def make_tilable(
-            self,
-            prompt: str,
-            source_image: Image.Image,
-            strength: float = 0.8,
-            num_variants: int = 6,
-            num_inference_steps: int = 50,
-            guidance_scale: float = 7.5,
-            seed: Optional[int] = None,
-            progress_callback: Optional[Callable[[float], None]] = None,
-            scaling_mode: ScalingMode = ScalingMode.GROW,
-            border_width: int = 50,
-            border_softness: float = 0.5
-    ) -> Tuple[List[Image.Image], Image.Image]:
-        response = self.do_diffusion_request(
-            'make_tilable',
-            return_raw=True,
-            prompt=prompt,
-            source_image=image_to_base64url(source_image).decode(),
-            strength=strength,
-            num_variants=num_variants,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            seed=seed,
-            progress_callback=progress_callback,
-            scaling_mode=scaling_mode,
-            border_width=border_width,
-            border_softness=border_softness
-        )
-
-        images = [base64url_to_image(image.encode()) for image in response['result']['images']]
-        mask = base64url_to_image(response['result']['mask'].encode())
-        return images, mask
+            self, *args, cancellation_token: Optional[CancellationToken] = None, **kwargs
+    ) -> Tuple[Union[List[Image.Image], Variants], Image.Image]:
+        return self._run(self._async_client.make_tilable(*args, **kwargs), cancellation_token)
 
     def inpaint(
-            self,
-            prompt: str,
-            source_image: Image.Image,
-            mask: Optional[Image.Image],
-            strength: float = 0.8,
-            num_variants: int = 6,
-            num_inference_steps: int = 50,
-            guidance_scale: float = 7.5,
-            seed: Optional[int] = None,
-            progress_callback: Optional[Callable[[float], None]] = None,
-            scaling_mode: ScalingMode = ScalingMode.GROW
-    ) -> List[Image.Image]:
-        extra_kwargs = {}
-        if mask is not None:
-            extra_kwargs['mask'] = image_to_base64url(mask).decode()
-        return self.do_diffusion_request(
-            'inpainting',
-            prompt=prompt,
-            source_image=image_to_base64url(source_image).decode(),
-            strength=strength,
-            num_variants=num_variants,
-            num_inference_steps=num_inference_steps,
-            guidance_scale=guidance_scale,
-            seed=seed,
-            progress_callback=progress_callback,
-            scaling_mode=scaling_mode,
-            **extra_kwargs
-        )
-
+            self, *args, cancellation_token: Optional[CancellationToken] = None, **kwargs
+    ) -> Union[List[Image.Image], Variants]:
+        return self._run(self._async_client.inpaint(*args, **kwargs), cancellation_token)
 
     def gobig(
-            self,
-            prompt: str,
-            source_image: Image.Image,
-            target_width: int,
-            target_height: int,
-            use_real_esrgan: bool = True,
-            esrgan_model: ESRGANModel = ESRGANModel.GENERAL_X4_V3,
-            maximize: bool = True,
-            overlap: int = 64,
-            strength: float = 0.8,
-            num_inference_steps: int = 50,
-            guidance_scale: float = 7.5,
-            seed: Optional[int] = None,
-            progress_callback: Optional[Callable[[float], None]] = None,
-    ) -> Image.Image:
-        request_data = {
-            'prompt': prompt,
-            'output_format': 'PNG',
-            'num_inference_steps': num_inference_steps,
-            'guidance_scale': guidance_scale,
-            'seed': seed,
-            'image': image_to_base64url(source_image).decode(),
-            'use_real_esrgan': use_real_esrgan,
-            'esrgan_model': esrgan_model,
-            'maximize': maximize,
-            'strength': strength,
-            'target_width': target_width,
-            'target_height': target_height,
-            'overlap': overlap
-        }
-        response = self._websocket_request('gobig', request_data, progress_callback)
-        return base64url_to_image(response['result']['image'].encode())
+            self, *args, cancellation_token: Optional[CancellationToken] = None, **kwargs
+    ) -> Union[Image.Image, EncodedImage]:
+        return self._run(self._async_client.gobig(*args, **kwargs), cancellation_token)
 
     def upscale(
-            self,
-            source_image: Image.Image,
-            target_width: int,
-            target_height: int,
-            esrgan_model: ESRGANModel = ESRGANModel.GENERAL_X4_V3,
-            maximize: bool = True
-    ) -> Image.Image:
-        request_data = {
-            'image': image_to_base64url(source_image).decode(),
-            'target_width': target_width,
-            'target_height': target_height,
-            'model': esrgan_model,
-            'maximize': maximize
-        }
-
-        response = httpx.post(
-            self._base_http_url + 'upscale',
-            json=request_data,
-            headers=self._default_headers,
-            timeout=None,
-            auth=self._auth
-        )
-        response.raise_for_status()
-        return base64url_to_image(response.json()['image'].encode())
+            self, *args, cancellation_token: Optional[CancellationToken] = None, **kwargs
+    ) -> Union[Image.Image, EncodedImage]:
+        return self._run(self._async_client.upscale(*args, **kwargs), cancellation_token)
 
     def restore_face(
-            self,
-            source_image: Image.Image,
-            model_type: GFPGANModel = GFPGANModel.V1_3,
-            use_real_esrgan: bool = True,
-            bg_tile: int = 400,
-            upscale: int = 2,
-            aligned: bool = False,
-            only_center_face: bool = False
-    ) -> Image.Image:
-        request_data = {
-            'image': image_to_base64url(source_image).decode(),
-            'model_type': model_type,
-            'use_real_esrgan': use_real_esrgan,
-            'bg_tile': bg_tile,
-            'upscale': upscale,
-            'aligned': aligned,
-            'only_center_face': only_center_face
-        }
-
-        response = httpx.post(
-            self._base_http_url + 'restore_face',
-            json=request_data,
-            headers=self._default_headers,
-            timeout=None,
-            auth=self._auth
-        )
-        response.raise_for_status()
-        return base64url_to_image(response.json()['image'].encode())
+            self, *args, cancellation_token: Optional[CancellationToken] = None, **kwargs
+    ) -> Union[Image.Image, EncodedImage]:
+        return self._run(self._async_client.restore_face(*args, **kwargs), cancellation_token)
+
+    def fetch_variants(
+            self, *args, cancellation_token: Optional[CancellationToken] = None, **kwargs
+    ) -> List[Image.Image]:
+        return self._run(self._async_client.fetch_variants(*args, **kwargs), cancellation_token)
 
     def test_connection(self) -> Tuple[bool, str]:
-        try:
-            response = httpx.get(
-                self._base_http_url + 'ping', headers=self._default_headers, auth=self._auth
-            )
-            response.status_code == httpx.codes.OK, response.text
-        except Exception as e:
-            return False, f'Exception: {type(e)}'
+        return self._run(self._async_client.test_connection())
 
-    _client = None
+    def get_capabilities(self) -> ServerCapabilities:
+        return self._run(self._async_client.get_capabilities())
 
-    @classmethod
-    def client(cls):
-        if cls._client is not None:
-            return cls._client
+    def apply_capabilities(self, capabilities: ServerCapabilities):
+        # Applied on the loop, so requests in flight never see half updated client
+        async def apply():
+            self._async_client.apply_capabilities(capabilities)
+
+        self._run(apply())
+
+    # One client per server, connection pools and upload caches are per server anyway
+    _clients: Dict[str, 'ImageAIUtilsClient'] = {}
 
+    @classmethod
+    def client(cls, server: Optional[str] = None):
         if Settings.settings() is None:
             return None
 
-        cls._client = ImageAIUtilsClient(
-            base_url=Settings.settings().SERVER_URL,
+        server = server or Settings.settings().SERVER_URL
+        if server in cls._clients:
+            return cls._clients[server]
+
+        cls._clients[server] = ImageAIUtilsClient(
+            base_url=server,
             use_tls=Settings.settings().USE_TLS,
             username=Settings.settings().USERNAME,
-            password=Settings.settings().PASSWORD
+            password=Settings.settings().PASSWORD,
+            use_session=Settings.settings().USE_WEBSOCKET_SESSION,
+            image_transport=Settings.settings().IMAGE_TRANSPORT,
+            image_codec=Settings.settings().IMAGE_CODEC,
+            png_compress_level=Settings.settings().PNG_COMPRESS_LEVEL,
+            use_http2=Settings.settings().USE_HTTP2,
+            max_connections=Settings.settings().HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=Settings.settings().HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=Settings.settings().HTTP_KEEPALIVE_EXPIRY,
+            connect_timeout=Settings.settings().CONNECT_TIMEOUT,
+            read_timeout=Settings.settings().READ_TIMEOUT,
+            use_upload_cache=Settings.settings().USE_UPLOAD_CACHE,
+            upload_cache_size=Settings.settings().UPLOAD_CACHE_SIZE,
+            result_cache=ResultCache.instance() if Settings.settings().USE_RESULT_CACHE else None,
+            capabilities=load_capabilities(server)
         )
 
-        return cls._client
+        return cls._clients[server]
+
+    @classmethod
+    def cached_capabilities(cls) -> ServerCapabilities:
+        if Settings.settings() is None:
+            return ServerCapabilities()
+        return load_capabilities(Settings.settings().SERVER_URL) or ServerCapabilities()
+
+    @classmethod
+    def server_clients(cls) -> Dict[str, 'ImageAIUtilsClient']:
+        if Settings.settings() is None:
+            return {}
+        return {server: cls.client(server) for server in Settings.settings().servers()}
+
+    @staticmethod
+    async def negotiate(
+            clients: Dict[str, 'ImageAIUtilsClient'],
+            progress_callback: Optional[Callable[[float], None]] = None
+    ) -> Dict[str, ServerCapabilities]:
+        # Handshake is done once per settings change on the event loop, all servers at once.
+        # Only servers that answered are in the result
+        capabilities_by_server: Dict[str, ServerCapabilities] = {}
+
+        async def handshake(server: str, client: ImageAIUtilsClient):
+            try:
+                capabilities = await client.async_client.get_capabilities()
+            except (httpx.HTTPError, ValueError, TypeError):
+                # Server is unreachable now, what it reported last time is still the best guess
+                return
+            client.async_client.apply_capabilities(capabilities)
+            capabilities_by_server[server] = capabilities
+            if progress_callback is not None:
+                progress_callback(len(capabilities_by_server) / len(clients))
+
+        await asyncio.gather(*(handshake(server, client) for server, client in clients.items()))
+        return capabilities_by_server
+
+    @staticmethod
+    def store_negotiated(capabilities_by_server: Dict[str, ServerCapabilities]):
+        # Kept on disk for new sessions
+        for server, capabilities in capabilities_by_server.items():
+            store_capabilities(server, capabilities)
 
     @classmethod
     def refresh_credentials(cls):
-        if cls.client() is not None:
-            cls.client()._auth = (Settings.settings().USERNAME, Settings.settings().PASSWORD)
+        # Pooled connections are bound to old url and credentials, so clients are recreated lazily
+        clients, cls._clients = cls._clients, {}
+        for client in clients.values():
+            client._retire()
+
+    # Can be called from any thread
+    def acquire(self) -> 'ImageAIUtilsClient':
+        with self._users_lock:
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._users_lock:
+            self._users -= 1
+            close = self._retired and self._users == 0
+        if close:
+            self._loop.submit(self._async_client.close())
+
+    def _retire(self):
+        with self._users_lock:
+            self._retired = True
+            close = self._users == 0
+        if close:
+            self._loop.submit(self._async_client.close())
+
+    def close(self):
+        self._run(self._async_client.close())
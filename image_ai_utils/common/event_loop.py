@@ -0,0 +1,58 @@
+import asyncio
+import threading
+from concurrent.futures import Future, CancelledError
+from typing import Optional, Coroutine, Any
+
+from .cancellation import CancellationToken
+from .exceptions import RequestCancelledException
+
+
+# Single event loop thread shared by all requests, so concurrent jobs don't need a thread each
+class BackgroundEventLoop:
+    _instance: Optional['BackgroundEventLoop'] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name='image_ai_utils_event_loop', daemon=True
+        )
+        self._thread.start()
+
+    @classmethod
+    def instance(cls) -> 'BackgroundEventLoop':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = BackgroundEventLoop()
+            return cls._instance
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self._loop
+
+    def submit(self, coroutine: Coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def run(
+            self, coroutine: Coroutine, cancellation_token: Optional[CancellationToken] = None
+    ) -> Any:
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise RuntimeError('Blocking call from the event loop thread would deadlock')
+
+        if cancellation_token is not None and cancellation_token.cancelled:
+            # Short coroutine could finish before cancel callback reaches it
+            coroutine.close()
+            raise RequestCancelledException()
+
+        future = self.submit(coroutine)
+        if cancellation_token is None:
+            return future.result()
+
+        cancellation_token.add_callback(future.cancel)
+        try:
+            return future.result()
+        except CancelledError:
+            raise RequestCancelledException()
+        finally:
+            cancellation_token.remove_callback(future.cancel)
@@ -0,0 +1,32 @@
+from typing import List
+
+
+class WebSocketException(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+# Connection dropped or couldn't be made, request itself may still be running on server
+class ConnectionLostException(WebSocketException):
+    pass
+
+
+# Server couldn't be reached at all, so nothing was sent and there is nothing to resume
+class ConnectionFailedException(WebSocketException):
+    pass
+
+
+class RequestCancelledException(Exception):
+    def __init__(self, message: str = 'Request was cancelled'):
+        self.message = message
+
+
+class UnsupportedPixelFormatException(Exception):
+    def __init__(self, message: str):
+        self.message = message
+
+
+class MissingUploadsException(Exception):
+    def __init__(self, digests: List[str]):
+        self.digests = digests
+        self.message = f'Server doesn\'t have uploaded images: {", ".join(digests)}'
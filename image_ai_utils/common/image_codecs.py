@@ -0,0 +1,273 @@
+import struct
+import threading
+import zlib
+from enum import Enum
+from io import BytesIO
+from typing import Optional, Tuple, Union, List
+
+from PIL import Image
+
+from .pixel_buffer import PixelBuffer, image_to_pixel_data
+from .pixel_format import PixelFormat, RGBA_U8
+from .resampling import ResamplingFilter, resample_bgra
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+RAW_SIGNATURE = b'RAWI'
+# signature, width, height, compression, mode
+RAW_HEADER = struct.Struct('<4sIIB4s')
+
+SMALL_IMAGE_PIXELS = 512 * 512
+FAST_CONNECTION_BYTES_PER_SECOND = 50 * 1024 * 1024
+SLOW_CONNECTION_BYTES_PER_SECOND = 5 * 1024 * 1024
+
+
+class ImageCodec(str, Enum):
+    AUTO = 'auto'
+    PNG = 'png'
+    WEBP = 'webp'  # lossless
+    RAW = 'raw'  # raw pixels compressed with zstd, lz4 or zlib, whichever is available
+
+    @property
+    def mime_type(self) -> str:
+        if self == ImageCodec.RAW:
+            return 'image/x-raw'
+        return f'image/{self.value}'
+
+    @property
+    def output_format(self) -> str:
+        return self.value.upper()
+
+    @staticmethod
+    def extension(mime_type: str) -> str:
+        if mime_type == ImageCodec.RAW.mime_type:
+            return ImageCodec.RAW.value
+        return mime_type.rsplit('/', 1)[-1]
+
+
+class RawCompression(int, Enum):
+    NONE = 0
+    ZLIB = 1
+    LZ4 = 2
+    ZSTD = 3
+
+
+def _best_raw_compression() -> RawCompression:
+    if zstandard is not None:
+        return RawCompression.ZSTD
+    if lz4 is not None:
+        return RawCompression.LZ4
+    return RawCompression.ZLIB
+
+
+def encode_raw(
+        image: Union[Image.Image, PixelBuffer], compression: Optional[RawCompression] = None
+) -> bytes:
+    if compression is None:
+        compression = _best_raw_compression()
+
+    # Krita pixels are sent in their native channel order without going through PIL
+    if isinstance(image, PixelBuffer):
+        pixels, mode = image.raw_bytes(), PixelBuffer.CHANNEL_ORDER
+    else:
+        pixels, mode = image.tobytes(), image.mode
+    if compression == RawCompression.ZSTD:
+        pixels = zstandard.ZstdCompressor(level=1, threads=-1).compress(pixels)
+    elif compression == RawCompression.LZ4:
+        pixels = lz4.frame.compress(pixels)
+    elif compression == RawCompression.ZLIB:
+        pixels = zlib.compress(pixels, 1)
+
+    header = RAW_HEADER.pack(
+        RAW_SIGNATURE, image.width, image.height, compression, mode.encode().ljust(4)
+    )
+    return header + pixels
+
+
+def is_raw(data: Union[bytes, memoryview]) -> bool:
+    return bytes(data[:len(RAW_SIGNATURE)]) == RAW_SIGNATURE
+
+
+def _raw_mode(mode: bytes) -> Tuple[str, str]:
+    raw_mode = mode.decode().strip()
+    return 'RGBA' if raw_mode == PixelBuffer.CHANNEL_ORDER else raw_mode, raw_mode
+
+
+def decompress_raw(data: Union[bytes, memoryview]) -> Union[bytes, memoryview]:
+    compression = RAW_HEADER.unpack_from(data)[3]
+    pixels = memoryview(data)[RAW_HEADER.size:]
+    if compression == RawCompression.ZSTD:
+        pixels = zstandard.ZstdDecompressor().decompress(pixels)
+    elif compression == RawCompression.LZ4:
+        pixels = lz4.frame.decompress(pixels)
+    elif compression == RawCompression.ZLIB:
+        pixels = zlib.decompress(pixels)
+    return pixels
+
+
+def decode_raw(data: Union[bytes, memoryview]) -> Image.Image:
+    _, width, height, _, mode = RAW_HEADER.unpack_from(data)
+    mode, raw_mode = _raw_mode(mode)
+    return Image.frombuffer(mode, (width, height), decompress_raw(data), 'raw', raw_mode, 0, 1)
+
+
+def decode_image(data: Union[bytes, memoryview]) -> Image.Image:
+    if is_raw(data):
+        return decode_raw(data)
+    return Image.open(BytesIO(data))
+
+
+# Image received from server, kept encoded until something needs its pixels. Size and format are
+# read from the header, decoded image is cached until `unload`
+class EncodedImage:
+    def __init__(self, data: Union[bytes, memoryview]):
+        self._data = data
+        self._image: Optional[Image.Image] = None
+        self._lock = threading.Lock()
+        if is_raw(data):
+            _, self.width, self.height, _, mode = RAW_HEADER.unpack_from(data)
+            self.mode, self._raw_mode = _raw_mode(mode)
+            self.format = ImageCodec.RAW.output_format
+        else:
+            # Only parses the header
+            header = Image.open(BytesIO(data))
+            self.width, self.height = header.size
+            self.mode, self._raw_mode = header.mode, None
+            self.format = header.format
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self.width, self.height
+
+    @property
+    def data(self) -> Union[bytes, memoryview]:
+        return self._data
+
+    @property
+    def mime_type(self) -> str:
+        if self._raw_mode is not None:
+            return ImageCodec.RAW.mime_type
+        return Image.MIME.get(self.format, 'application/octet-stream')
+
+    @property
+    def loaded(self) -> bool:
+        return self._image is not None
+
+    def load(self) -> Image.Image:
+        with self._lock:
+            if self._image is None:
+                image = decode_image(self._data)
+                image.load()
+                self._image = image
+            return self._image
+
+    def unload(self):
+        self._image = None
+
+    def to_pixel_data(
+            self,
+            size: Optional[Tuple[int, int]] = None,
+            pixel_format: PixelFormat = RGBA_U8,
+            resampling_filter: ResamplingFilter = ResamplingFilter.AUTO
+    ) -> Union[bytes, memoryview]:
+        # Raw BGRA is already in Krita's layout, so it's only decompressed and resampled in place
+        if self._raw_mode == PixelBuffer.CHANNEL_ORDER and pixel_format == RGBA_U8:
+            if size is None or size == self.size:
+                return decompress_raw(self._data)
+            return resample_bgra(decompress_raw(self._data), self.size, size, resampling_filter)
+
+        # Decoded image isn't kept, after this only layer has the pixels
+        image = self._image if self._image is not None else decode_image(self._data)
+        return image_to_pixel_data(image, size, pixel_format, resampling_filter)
+
+
+class ThroughputMeter:
+    def __init__(self, smoothing: float = 0.3, min_sample_bytes: int = 256 * 1024):
+        self._smoothing = smoothing
+        self._min_sample_bytes = min_sample_bytes
+        self._bytes_per_second: Optional[float] = None
+
+    def record(self, num_bytes: int, seconds: float):
+        if num_bytes < self._min_sample_bytes or seconds <= 0:
+            return
+
+        sample = num_bytes / seconds
+        if self._bytes_per_second is None:
+            self._bytes_per_second = sample
+        else:
+            self._bytes_per_second += self._smoothing * (sample - self._bytes_per_second)
+
+    @property
+    def bytes_per_second(self) -> Optional[float]:
+        return self._bytes_per_second
+
+
+class ImageEncoder:
+    def __init__(
+            self,
+            codec: ImageCodec = ImageCodec.PNG,
+            png_compress_level: int = 6,
+            local_connection: bool = False,
+            throughput_meter: Optional[ThroughputMeter] = None
+    ):
+        self._codec = ImageCodec(codec)
+        self._png_compress_level = png_compress_level
+        self._local_connection = local_connection
+        self.throughput_meter = throughput_meter or ThroughputMeter()
+        # None until server reports which codecs it can decode
+        self.supported_codecs: Optional[List[str]] = None
+
+    def resolve(self, width: int, height: int, mode: str = 'RGBA') -> ImageCodec:
+        codec = self._resolve(width, height, mode)
+        # PNG is supported by every server version
+        if self.supported_codecs is not None and codec not in self.supported_codecs:
+            return ImageCodec.PNG
+        return codec
+
+    def _resolve(self, width: int, height: int, mode: str) -> ImageCodec:
+        if self._codec != ImageCodec.AUTO:
+            return self._codec
+
+        # Compression ratio doesn't matter for small images, but PNG is supported everywhere
+        if width * height <= SMALL_IMAGE_PIXELS or mode not in ('RGB', 'RGBA'):
+            return ImageCodec.PNG
+
+        bytes_per_second = self.throughput_meter.bytes_per_second
+        if bytes_per_second is None:
+            return ImageCodec.RAW if self._local_connection else ImageCodec.PNG
+        if bytes_per_second >= FAST_CONNECTION_BYTES_PER_SECOND:
+            return ImageCodec.RAW
+        if bytes_per_second <= SLOW_CONNECTION_BYTES_PER_SECOND:
+            return ImageCodec.WEBP
+        return ImageCodec.PNG
+
+    def encode(self, image: Union[Image.Image, PixelBuffer, EncodedImage]) -> Tuple[bytes, str]:
+        # Already encoded, e.g. result that is sent back or cached
+        if isinstance(image, EncodedImage):
+            return image.data, image.mime_type
+
+        codec = self.resolve(image.width, image.height, image.mode)
+        if codec == ImageCodec.RAW:
+            return encode_raw(image), codec.mime_type
+
+        if isinstance(image, PixelBuffer):
+            image = image.to_image()
+
+        buffer = BytesIO()
+        if codec == ImageCodec.WEBP:
+            image.save(buffer, format='WEBP', lossless=True, exact=True, quality=0, method=0)
+        else:
+            image.save(buffer, format='PNG', compress_level=self._png_compress_level)
+        return buffer.getvalue(), codec.mime_type
+
+
+# Everything that can be sent as an image
+IMAGE_TYPES = (Image.Image, PixelBuffer, EncodedImage)
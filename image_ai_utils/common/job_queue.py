@@ -0,0 +1,369 @@
+import asyncio
+import heapq
+import itertools
+import time
+import uuid
+from collections import deque
+from enum import Enum
+from typing import Optional, Callable, Any, Dict, List, Tuple
+
+import httpx
+from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot, QTimer
+from websockets.exceptions import ConnectionClosed
+
+from .client import ImageAIUtilsClient
+from .exceptions import ConnectionLostException, ConnectionFailedException
+from .progress_task import ProgressTask
+from .server_pool import ServerPool
+from .settings import Settings
+
+# Result code of dialogs that put their request into the queue instead of running it
+QUEUED_RESULT_CODE = 2
+
+
+class JobStatus(str, Enum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    RETRYING = 'retrying'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+
+class JobPriority(int, Enum):
+    LOW = 0
+    NORMAL = 1
+    HIGH = 2
+
+
+class Job(QObject):
+    changed = pyqtSignal()
+    preview = pyqtSignal(int, object)
+    attempt_finished = pyqtSignal()
+
+    def __init__(
+            self,
+            name: str,
+            client_method: str,
+            request_data: Dict[str, Any],
+            on_result: Optional[Callable[[Any], None]] = None,
+            priority: JobPriority = JobPriority.NORMAL,
+            stream_previews: bool = False,
+            affinity: Optional[str] = None,
+            pinned: bool = False
+    ):
+        super().__init__()
+        # Same for every attempt, so retried job can be picked up where server left it
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.client_method = client_method
+        self.request_data = request_data
+        self.on_result = on_result
+        self.priority = priority
+        self.stream_previews = stream_previews
+        # Server job should run on, pinned jobs need state that only this server has
+        self.affinity = affinity
+        self.pinned = pinned and affinity is not None
+        self.status = JobStatus.QUEUED
+        self.progress = 0.
+        self.attempts = 0
+        self.server: Optional[str] = None
+        self.task: Optional[ProgressTask] = None
+        self.result = None
+        self.error_message: Optional[str] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in (JobStatus.FINISHED, JobStatus.FAILED, JobStatus.CANCELLED)
+
+    def set_status(self, status: JobStatus):
+        self.status = status
+        self.changed.emit()
+
+    # Task signals are emitted from the event loop thread, slots make them queued to this thread
+    @pyqtSlot(float)
+    def set_progress(self, progress: float):
+        self.progress = progress
+        self.changed.emit()
+
+    @pyqtSlot(int, object)
+    def set_preview(self, variant: int, image: Any):
+        self.preview.emit(variant, image)
+
+    @pyqtSlot()
+    def finish_attempt(self):
+        self.attempt_finished.emit()
+
+
+# One action over many layers. Job is built, and layer pixels are read, only when there is room
+# in the window, so few layers are held in memory while earlier ones are uploaded, processed and
+# inserted. `make_job` returns None for layers that can't be processed anymore
+class JobBatch(QObject):
+    changed = pyqtSignal()
+
+    def __init__(self, name: str, make_jobs: List[Callable[[], Optional[Job]]], window: int):
+        super().__init__()
+        self.name = name
+        self.total = len(make_jobs)
+        self.finished = 0
+        self.failed = 0
+        self.pixels = 0
+        self._pending = deque(make_jobs)
+        self._window = max(1, window)
+        self._in_flight: List[Job] = []
+        self._queue: Optional['JobQueue'] = None
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        return not self._pending and not self._in_flight
+
+    @property
+    def throughput(self) -> Optional[float]:
+        # Source megapixels per second, from reading the first layer to inserting the last
+        if self._started_at is None or self.pixels == 0:
+            return None
+        end = self._finished_at if self._finished_at is not None else time.monotonic()
+        return self.pixels / 1e6 / max(end - self._started_at, 1e-3)
+
+    def start(self, queue: 'JobQueue'):
+        self._queue = queue
+        self._started_at = time.monotonic()
+        self._fill()
+
+    def cancel(self):
+        self._pending.clear()
+        for job in list(self._in_flight):
+            self._queue.cancel(job)
+        self._fill()
+
+    def _fill(self):
+        while self._pending and len(self._in_flight) < self._window:
+            job = self._pending.popleft()()
+            if job is None:
+                self.failed += 1
+                continue
+            self._in_flight.append(job)
+            job.changed.connect(self._on_job_changed)
+            self._queue.submit(job)
+
+        if self.done and self._finished_at is None:
+            self._finished_at = time.monotonic()
+        self.changed.emit()
+
+    def _on_job_changed(self):
+        job: Job = self.sender()
+        if not job.done:
+            return
+
+        job.changed.disconnect(self._on_job_changed)
+        self._in_flight.remove(job)
+        source_image = job.request_data.get('source_image')
+        if job.status == JobStatus.FINISHED:
+            self.finished += 1
+            if source_image is not None:
+                self.pixels += source_image.width * source_image.height
+        else:
+            self.failed += 1
+        # Job stays in the list until cleared, but its pixels are already in the layer
+        job.request_data.pop('source_image', None)
+        job.result = None
+        self._fill()
+
+
+# Keeps server busy by feeding jobs to client in the background, results are handed to
+# `on_result` callbacks on the GUI thread
+class JobQueue(QObject):
+    job_added = pyqtSignal(object)
+    job_removed = pyqtSignal(object)
+    batch_added = pyqtSignal(object)
+    batch_removed = pyqtSignal(object)
+
+    _instance: Optional['JobQueue'] = None
+
+    def __init__(self):
+        super().__init__()
+        self._queue: List[Tuple[int, int, Job]] = []
+        self._sequence = itertools.count()
+        self._jobs: List[Job] = []
+        self._batches: List[JobBatch] = []
+        self._running: Dict[str, int] = {}
+        ServerPool.instance().checked.connect(self._schedule)
+        self._health_timer = QTimer(self)
+        self._health_timer.timeout.connect(self._check_servers)
+        self._health_timer.start(self._health_check_interval())
+
+    @classmethod
+    def instance(cls) -> 'JobQueue':
+        if cls._instance is None:
+            cls._instance = JobQueue()
+        return cls._instance
+
+    @property
+    def jobs(self) -> List[Job]:
+        return list(self._jobs)
+
+    @property
+    def batches(self) -> List[JobBatch]:
+        return list(self._batches)
+
+    def submit(self, job: Job) -> Job:
+        self._jobs.append(job)
+        self.job_added.emit(job)
+        self._enqueue(job)
+        return job
+
+    def submit_batch(self, batch: JobBatch) -> JobBatch:
+        self._batches.append(batch)
+        self.batch_added.emit(batch)
+        batch.start(self)
+        return batch
+
+    def _enqueue(self, job: Job):
+        # Higher priority first, FIFO among equal priorities
+        heapq.heappush(self._queue, (-job.priority, next(self._sequence), job))
+        job.set_status(JobStatus.QUEUED)
+        self._schedule()
+
+    def cancel(self, job: Job):
+        if job.status == JobStatus.RUNNING:
+            job.task.cancel()
+        elif not job.done:
+            # Queued jobs are dropped lazily when they reach the top of the heap
+            job.set_status(JobStatus.CANCELLED)
+
+    def cancel_all(self):
+        # Batches first, otherwise they would replace cancelled jobs with new ones
+        for batch in self._batches:
+            batch.cancel()
+        for job in self._jobs:
+            self.cancel(job)
+
+    def clear_finished(self):
+        for job in [job for job in self._jobs if job.done]:
+            self._jobs.remove(job)
+            self.job_removed.emit(job)
+        for batch in [batch for batch in self._batches if batch.done]:
+            self._batches.remove(batch)
+            self.batch_removed.emit(batch)
+
+    @staticmethod
+    def _health_check_interval() -> int:
+        # Until settings are saved, default from Settings is used
+        interval = Settings.settings().HEALTH_CHECK_INTERVAL if Settings.settings() is not None \
+            else Settings.__fields__['HEALTH_CHECK_INTERVAL'].default
+        return int(interval * 1000)
+
+    def _check_servers(self):
+        # Interval is picked up from settings changed since the last check
+        self._health_timer.setInterval(self._health_check_interval())
+        if Settings.settings() is None:
+            return
+        ServerPool.instance().check()
+
+    def _schedule(self):
+        if Settings.settings() is None:
+            return
+
+        server_pool = ServerPool.instance()
+        limit = Settings.settings().MAX_CONCURRENT_JOBS
+        waiting = []
+        while self._queue:
+            entry = heapq.heappop(self._queue)
+            job = entry[2]
+            if job.status != JobStatus.QUEUED:
+                continue
+            server = server_pool.choose(self._running, limit, job.affinity, job.pinned)
+            if server is None:
+                waiting.append(entry)
+                # Pinned job waits for its own server, jobs after it can still run elsewhere
+                if job.pinned:
+                    continue
+                break
+            self._start(job, server)
+
+        for entry in waiting:
+            heapq.heappush(self._queue, entry)
+
+    def _start(self, job: Job, server: str):
+        job.server = server
+        job.attempts += 1
+        job.progress = 0.
+        client = ImageAIUtilsClient.client(server).acquire()
+        job.task = ProgressTask(
+            getattr(client.async_client, job.client_method),
+            job.request_data,
+            stream_previews=job.stream_previews,
+            job_id=job.id
+        )
+        job.task.finished.connect(client.release)
+        job.task.progress_signal.connect(job.set_progress)
+        job.task.preview_signal.connect(job.set_preview)
+        job.task.finished.connect(job.finish_attempt)
+        job.attempt_finished.connect(self._on_attempt_finished)
+        self._running[server] = self._running.get(server, 0) + 1
+        job.set_status(JobStatus.RUNNING)
+        job.task.start()
+
+    @staticmethod
+    def _is_retryable(error: Optional[Exception]) -> bool:
+        if isinstance(error, httpx.HTTPStatusError):
+            return error.response.status_code >= 500
+        # Plain WebSocketException is an error reported by server or a broken response, sending
+        # the same request again would fail the same way
+        return isinstance(error, (
+            httpx.TransportError,
+            ConnectionLostException,
+            ConnectionFailedException,
+            ConnectionClosed,
+            OSError,
+            asyncio.TimeoutError
+        ))
+
+    @classmethod
+    def _is_connection_error(cls, error: Optional[Exception]) -> bool:
+        # Server answered with error status, so it's still reachable
+        return cls._is_retryable(error) and not isinstance(error, httpx.HTTPStatusError)
+
+    def _on_attempt_finished(self):
+        job: Job = self.sender()
+        job.attempt_finished.disconnect(self._on_attempt_finished)
+        self._running[job.server] -= 1
+        task, job.task = job.task, None
+        server_pool = ServerPool.instance()
+
+        if task.success:
+            server_pool.record_success(job.server)
+            job.result = task.result
+            try:
+                if job.on_result is not None:
+                    job.on_result(task.result)
+                job.set_status(JobStatus.FINISHED)
+            except Exception as e:
+                job.error_message = f'Couldn\'t apply result: {e}'
+                job.set_status(JobStatus.FAILED)
+        elif task.cancelled:
+            job.set_status(JobStatus.CANCELLED)
+        elif (
+                self._is_retryable(task.error) and
+                job.attempts <= Settings.settings().JOB_MAX_RETRIES
+        ):
+            job.error_message = task.error_message
+            job.set_status(JobStatus.RETRYING)
+            delay = Settings.settings().JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+            if self._is_connection_error(task.error):
+                server_pool.record_failure(job.server)
+                # Another server can take the job right away, backoff is only for the same one
+                if not job.pinned and server_pool.has_alternative(job.server):
+                    delay = 0
+            QTimer.singleShot(int(delay * 1000), lambda: self._retry(job))
+        else:
+            job.error_message = task.error_message
+            job.set_status(JobStatus.FAILED)
+
+        self._schedule()
+
+    def _retry(self, job: Job):
+        if job.status == JobStatus.RETRYING:
+            self._enqueue(job)
@@ -0,0 +1,92 @@
+from typing import Optional, Tuple, Union
+
+from PIL import Image
+
+from .pixel_format import PixelFormat, RGBA_U8, pixels_to_bgra, image_to_pixels
+from .resampling import ResamplingFilter, resample
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+Box = Tuple[int, int, int, int]  # left, top, right, bottom
+
+
+# Layer pixels in Krita's 8-bit BGRA order, wrapped without copying when layer is 8-bit RGBA. PIL
+# image is only materialized when something actually needs it, raw codec sends BGRA bytes as is
+class PixelBuffer:
+    mode = 'RGBA'
+    CHANNEL_ORDER = 'BGRA'
+
+    def __init__(self, data, width: int, height: int):
+        # numpy array lets crops stay views into the original buffer
+        if numpy is not None and not isinstance(data, numpy.ndarray):
+            data = numpy.frombuffer(data, dtype=numpy.uint8).reshape((height, width, 4))
+        elif numpy is None:
+            data = memoryview(data)
+        self._data = data
+        self._width = width
+        self._height = height
+
+    @classmethod
+    def from_node(cls, node, x: int, y: int, width: int, height: int) -> 'PixelBuffer':
+        data = node.pixelData(x, y, width, height)
+        pixel_format = PixelFormat.from_node(node)
+        if pixel_format != RGBA_U8:
+            # Other depths and colour models are converted once, so the rest of the code only
+            # deals with 8-bit BGRA
+            data = pixels_to_bgra(data, pixel_format, width, height)
+        return cls(data, width, height)
+
+    @property
+    def width(self) -> int:
+        return self._width
+
+    @property
+    def height(self) -> int:
+        return self._height
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self._width, self._height
+
+    def crop(self, box: Box) -> 'PixelBuffer':
+        left, top, right, bottom = box
+        if numpy is not None:
+            return PixelBuffer(self._data[top:bottom, left:right], right - left, bottom - top)
+        return PixelBuffer(
+            self.to_image().crop(box).tobytes('raw', self.CHANNEL_ORDER), right - left, bottom - top
+        )
+
+    def raw_bytes(self) -> Union[bytes, memoryview]:
+        if numpy is not None:
+            # Copies only if this is a crop
+            return memoryview(numpy.ascontiguousarray(self._data)).cast('B')
+        return self._data
+
+    def to_image(self) -> Image.Image:
+        # Swizzle happens while decoding into PIL's own memory, that's the only full copy
+        return Image.frombuffer(
+            'RGBA', self.size, self.raw_bytes(), 'raw', self.CHANNEL_ORDER, 0, 1
+        )
+
+
+def image_to_pixel_data(
+        image: Image.Image,
+        size: Optional[Tuple[int, int]] = None,
+        pixel_format: PixelFormat = RGBA_U8,
+        resampling_filter: ResamplingFilter = ResamplingFilter.AUTO
+) -> bytes:
+    # Every convert, resize and tobytes makes full copy of the image, so skip ones that aren't
+    # needed and resize before adding alpha channel
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    if size is not None:
+        image = resample(image, size, resampling_filter)
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    # Result is converted back to depth of the layer, not the whole document
+    if pixel_format != RGBA_U8:
+        return image_to_pixels(image, pixel_format)
+    return image.tobytes('raw', PixelBuffer.CHANNEL_ORDER)
@@ -0,0 +1,280 @@
+import sys
+from array import array
+from enum import Enum
+from typing import NamedTuple, List
+
+from PIL import Image
+
+from .exceptions import UnsupportedPixelFormatException
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Huge float layers are converted in chunks, so there is never more than one extra copy of them
+CHUNK_PIXELS = 1024 * 1024
+
+
+class ColorModel(str, Enum):
+    RGBA = 'RGBA'
+    GRAYA = 'GRAYA'
+    CMYKA = 'CMYKA'
+
+    @property
+    def channels(self) -> int:
+        return {ColorModel.RGBA: 4, ColorModel.GRAYA: 2, ColorModel.CMYKA: 5}[self]
+
+
+class ColorDepth(str, Enum):
+    U8 = 'U8'
+    U16 = 'U16'
+    F16 = 'F16'
+    F32 = 'F32'
+
+    @property
+    def is_float(self) -> bool:
+        return self in (ColorDepth.F16, ColorDepth.F32)
+
+    @property
+    def dtype(self) -> str:
+        return {
+            ColorDepth.U8: 'u1', ColorDepth.U16: 'u2', ColorDepth.F16: 'f2', ColorDepth.F32: 'f4'
+        }[self]
+
+
+class PixelFormat(NamedTuple):
+    model: ColorModel
+    depth: ColorDepth
+    linear: bool = False
+
+    @classmethod
+    def from_node(cls, node) -> 'PixelFormat':
+        model, depth = node.colorModel(), node.colorDepth()
+        try:
+            model, depth = ColorModel(model), ColorDepth(depth)
+        except ValueError:
+            raise UnsupportedPixelFormatException(
+                f'{model}/{depth} layers are not supported, convert layer to RGB, grayscale '
+                f'or CMYK first'
+            )
+        if depth == ColorDepth.F16 and numpy is None:
+            raise UnsupportedPixelFormatException('numpy is required for 16-bit float layers')
+
+        # Default profiles of float documents are linear, e.g. sRGB-elle-V2-g10.icc
+        profile = node.colorProfile() or ''
+        return cls(model, depth, 'g10' in profile or 'linear' in profile.lower())
+
+    @property
+    def channel_order(self) -> str:
+        # Integer RGB is stored as BGR in Krita, float one as RGB
+        if self.model == ColorModel.RGBA:
+            return 'RGBA' if self.depth.is_float else 'BGRA'
+        if self.model == ColorModel.GRAYA:
+            return 'LA'
+        return 'CMYKA'
+
+    @property
+    def channel_units(self) -> List[float]:
+        if self.depth == ColorDepth.U8:
+            unit = 255
+        elif self.depth == ColorDepth.U16:
+            unit = 65535
+        else:
+            unit = 1
+        # Krita keeps float CMYK in 0..100 range, alpha is always last and in 0..1
+        colour_unit = 100 if self.model == ColorModel.CMYKA and self.depth.is_float else unit
+        return [colour_unit] * (self.model.channels - 1) + [unit]
+
+
+RGBA_U8 = PixelFormat(ColorModel.RGBA, ColorDepth.U8)
+
+
+# Float values are looked up with 16-bit precision like in the fallback, that's well below one
+# 8-bit step even in shadows of linear colour
+FLOAT_LEVELS = 65536
+
+
+def _gamma_table(levels: int, to_linear: bool) -> List[float]:
+    table = []
+    for i in range(levels):
+        value = i / (levels - 1)
+        if to_linear:
+            value = value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+        else:
+            value = value * 12.92 if value <= 0.0031308 else 1.055 * value ** (1 / 2.4) - 0.055
+        table.append(value)
+    return table
+
+
+def _replace_alpha(data: bytes, alpha: bytes, channels: int) -> bytes:
+    # Channels of all supported models are interleaved with alpha last
+    result = bytearray(data)
+    result[channels - 1::channels] = alpha[channels - 1::channels]
+    return bytes(result)
+
+
+def _to_u8_numpy(data, pixel_format: PixelFormat) -> bytes:
+    pixels = numpy.frombuffer(data, dtype=pixel_format.depth.dtype)
+    pixels = pixels.reshape((-1, pixel_format.model.channels))
+    units = numpy.array(pixel_format.channel_units, dtype=numpy.float32)
+    levels = FLOAT_LEVELS if pixel_format.depth.is_float else int(units[-1]) + 1
+    # Integer values index tables directly, float ones are quantized to FLOAT_LEVELS first
+    colour_table = numpy.array(_gamma_table(levels, to_linear=False)) if pixel_format.linear \
+        else numpy.linspace(0, 1, levels)
+    colour_table = (colour_table * 255 + 0.5).astype(numpy.uint8)
+    alpha_table = (numpy.linspace(0, 1, levels) * 255 + 0.5).astype(numpy.uint8)
+
+    result = numpy.empty(pixels.shape, dtype=numpy.uint8)
+    for start in range(0, len(pixels), CHUNK_PIXELS):
+        chunk = pixels[start:start + CHUNK_PIXELS]
+        if pixel_format.depth.is_float:
+            chunk = chunk * ((levels - 1) / units)
+            chunk += 0.5
+            numpy.clip(chunk, 0, levels - 1, out=chunk)
+            chunk = chunk.astype(numpy.uint16)
+        # Looking up whole chunk and fixing alpha after is faster than strided lookups
+        colour_table.take(chunk, out=result[start:start + CHUNK_PIXELS])
+        result[start:start + CHUNK_PIXELS, -1] = alpha_table.take(chunk[:, -1])
+    return result.tobytes()
+
+
+def _from_u8_numpy(data: bytes, pixel_format: PixelFormat) -> bytes:
+    pixels = numpy.frombuffer(data, dtype=numpy.uint8).reshape((-1, pixel_format.model.channels))
+    colour_unit, alpha_unit = pixel_format.channel_units[0], pixel_format.channel_units[-1]
+    colour_table = numpy.array(_gamma_table(256, to_linear=True)) if pixel_format.linear \
+        else numpy.linspace(0, 1, 256)
+    colour_table, alpha_table = colour_table * colour_unit, numpy.linspace(0, alpha_unit, 256)
+    if not pixel_format.depth.is_float:
+        colour_table, alpha_table = colour_table + 0.5, alpha_table + 0.5
+    colour_table = colour_table.astype(pixel_format.depth.dtype)
+    alpha_table = alpha_table.astype(pixel_format.depth.dtype)
+
+    result = numpy.empty(pixels.shape, dtype=pixel_format.depth.dtype)
+    for start in range(0, len(pixels), CHUNK_PIXELS):
+        chunk = pixels[start:start + CHUNK_PIXELS]
+        colour_table.take(chunk, out=result[start:start + CHUNK_PIXELS])
+        result[start:start + CHUNK_PIXELS, -1] = alpha_table.take(chunk[:, -1])
+    return result.tobytes()
+
+
+# Without numpy channels are processed as one wide single channel image, so PIL still does all
+# the per pixel work. Deeper values are quantized to 16 bits first, PIL looks up 32-bit integer
+# images in 65536 entry tables, so gamma is as precise as with numpy
+def _to_u8_fallback(data, pixel_format: PixelFormat, width: int, height: int) -> bytes:
+    channels = pixel_format.model.channels
+    if pixel_format.depth == ColorDepth.U8:
+        result = bytes(data)
+        if pixel_format.linear:
+            table = bytes(round(value * 255) for value in _gamma_table(256, to_linear=False))
+            result = _replace_alpha(result.translate(table), result, channels)
+        return result
+
+    size = (width * channels, height)
+    colour_unit, alpha_unit = pixel_format.channel_units[0], pixel_format.channel_units[-1]
+    if pixel_format.depth == ColorDepth.U16:
+        wide = Image.frombuffer('I;16', size, data, 'raw', 'I;16N', 0, 1).convert('I')
+        alpha = wide
+    else:
+        floats = Image.frombuffer('F', size, data, 'raw', 'F;32NF', 0, 1)
+        wide = floats.point(lambda value: value * 65535 / colour_unit + 0.5).convert('I')
+        alpha = wide if colour_unit == alpha_unit else \
+            floats.point(lambda value: value * 65535 / alpha_unit + 0.5).convert('I')
+
+    alpha_table = [(i * 255 + 65535 // 2) // 65535 for i in range(65536)]
+    if pixel_format.linear:
+        colour_table = [round(value * 255) for value in _gamma_table(65536, to_linear=False)]
+    else:
+        colour_table = alpha_table
+    # Values out of range are clamped to the ends of the table by PIL
+    result = wide.point(colour_table, 'L').tobytes()
+    if alpha is not wide or colour_table is not alpha_table:
+        result = _replace_alpha(result, alpha.point(alpha_table, 'L').tobytes(), channels)
+    return result
+
+
+def _from_u8_fallback(data: bytes, pixel_format: PixelFormat, width: int, height: int) -> bytes:
+    channels = pixel_format.model.channels
+    colour_unit, alpha_unit = pixel_format.channel_units[0], pixel_format.channel_units[-1]
+    gamma = _gamma_table(256, to_linear=True) if pixel_format.linear \
+        else [i / 255 for i in range(256)]
+
+    if pixel_format.depth == ColorDepth.U8:
+        if pixel_format.linear:
+            table = bytes(round(value * 255) for value in gamma)
+            data = _replace_alpha(data.translate(table), data, channels)
+        return data
+    if pixel_format.depth == ColorDepth.U16:
+        # High and low bytes of 16-bit values are looked up separately, v * 257 for alpha
+        values = [round(value * 65535) for value in gamma]
+        high = _replace_alpha(data.translate(bytes(value >> 8 for value in values)), data, channels)
+        low = _replace_alpha(data.translate(bytes(value & 255 for value in values)), data, channels)
+        low_first = sys.byteorder == 'little'
+        result = bytearray(len(data) * 2)
+        result[0::2] = low if low_first else high
+        result[1::2] = high if low_first else low
+        return bytes(result)
+
+    wide = Image.frombuffer('L', (width * channels, height), data, 'raw', 'L', 0, 1)
+    result = array('f')
+    result.frombytes(wide.point([value * colour_unit for value in gamma], 'F').tobytes())
+    alpha = array('f')
+    alpha.frombytes(wide.point([i / 255 * alpha_unit for i in range(256)], 'F').tobytes())
+    result[channels - 1::channels] = alpha[channels - 1::channels]
+    return result.tobytes()
+
+
+def _to_u8(data, pixel_format: PixelFormat, width: int, height: int) -> bytes:
+    if pixel_format.depth == ColorDepth.U8 and not pixel_format.linear:
+        return data
+    if numpy is not None:
+        return _to_u8_numpy(data, pixel_format)
+    return _to_u8_fallback(data, pixel_format, width, height)
+
+
+# Lossy only for 8-bit linear layers, they can't hold sRGB shadows. Their step near black is about
+# 13 sRGB steps, so 8-bit colour read back from them is off by up to 6
+def _from_u8(data: bytes, pixel_format: PixelFormat, width: int, height: int) -> bytes:
+    if pixel_format.depth == ColorDepth.U8 and not pixel_format.linear:
+        return data
+    if numpy is not None:
+        return _from_u8_numpy(data, pixel_format)
+    return _from_u8_fallback(data, pixel_format, width, height)
+
+
+def pixels_to_bgra(data, pixel_format: PixelFormat, width: int, height: int) -> bytes:
+    # Depth is reduced first, colour model is converted by PIL on 8-bit data
+    data = _to_u8(data, pixel_format, width, height)
+    size = (width, height)
+    if pixel_format.model == ColorModel.RGBA:
+        if pixel_format.channel_order == 'BGRA':
+            return bytes(data)
+        image = Image.frombuffer('RGBA', size, data, 'raw', pixel_format.channel_order, 0, 1)
+    elif pixel_format.model == ColorModel.GRAYA:
+        image = Image.frombuffer('LA', size, data, 'raw', 'LA', 0, 1).convert('RGBA')
+    else:
+        pixels = memoryview(data)
+        cmyk = bytearray(width * height * 4)
+        for channel in range(4):
+            cmyk[channel::4] = pixels[channel::5]
+        image = Image.frombuffer('CMYK', size, bytes(cmyk), 'raw', 'CMYK', 0, 1).convert('RGBA')
+        image.putalpha(Image.frombuffer('L', size, bytes(pixels[4::5]), 'raw', 'L', 0, 1))
+    return image.tobytes('raw', 'BGRA')
+
+
+def image_to_pixels(image: Image.Image, pixel_format: PixelFormat) -> bytes:
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+
+    if pixel_format.model == ColorModel.RGBA:
+        data = image.tobytes('raw', pixel_format.channel_order)
+    elif pixel_format.model == ColorModel.GRAYA:
+        data = image.convert('LA').tobytes()
+    else:
+        cmyk = image.convert('CMYK').tobytes()
+        result = bytearray(image.width * image.height * 5)
+        for channel in range(4):
+            result[channel::5] = cmyk[channel::4]
+        result[4::5] = image.getchannel('A').tobytes()
+        data = bytes(result)
+    return _from_u8(data, pixel_format, image.width, image.height)
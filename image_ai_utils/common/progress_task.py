@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import traceback
+from concurrent.futures import Future
+from typing import Callable, Dict, Any, Awaitable, Optional
+
+from PIL import Image
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from .async_client import JOB_ID
+from .event_loop import BackgroundEventLoop
+from .exceptions import WebSocketException
+
+
+# Runs async client method on the shared event loop and bridges its callbacks to Qt signals
+class ProgressTask(QObject):
+    progress_signal = pyqtSignal(float)
+    preview_signal = pyqtSignal(int, object)
+    finished = pyqtSignal()
+
+    def __init__(
+            self,
+            client_method: Callable[..., Awaitable],
+            request_data: Dict[str, Any],
+            stream_previews: bool = False,
+            job_id: Optional[str] = None
+    ):
+        super().__init__()
+        self._job_id = job_id
+        self._request_data = request_data
+        self._client_method = client_method
+        self._stream_previews = stream_previews
+        self._future: Optional[Future] = None
+        self._done = threading.Event()
+        self._done_lock = threading.Lock()
+        self.result = None
+        self.success = False
+        self.cancelled = False
+        self.error: Optional[Exception] = None
+        self.error_message = None
+
+    def start(self):
+        self._future = BackgroundEventLoop.instance().submit(self._run())
+        # Future cancelled before the coroutine starts never reaches its finally block
+        self._future.add_done_callback(lambda future: future.cancelled() and self._finish())
+
+    def _finish(self):
+        with self._done_lock:
+            if self._done.is_set():
+                return
+            self._done.set()
+        self.finished.emit()
+
+    async def _run(self):
+        def progress_callback(progress: float):
+            self.progress_signal.emit(progress)
+
+        def preview_callback(variant: int, image: Image.Image):
+            self.preview_signal.emit(variant, image)
+
+        # Set inside the task, so it's only seen by requests of this task
+        JOB_ID.set(self._job_id)
+        extra_kwargs = {}
+        if self._stream_previews:
+            extra_kwargs['preview_callback'] = preview_callback
+
+        try:
+            self.result = await self._client_method(
+                progress_callback=progress_callback, **self._request_data, **extra_kwargs
+            )
+            self.success = True
+        except asyncio.CancelledError:
+            self.success = False
+            self.cancelled = True
+            raise
+        except WebSocketException as e:
+            self.success = False
+            self.error = e
+            self.error_message = e.message
+        except Exception as e:
+            self.success = False
+            self.error = e
+            self.error_message = ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+        finally:
+            self._finish()
+
+    def cancel(self):
+        if self._future is not None:
+            self.cancelled = True
+            self._future.cancel()
+
+    def isRunning(self) -> bool:
+        return self._future is not None and not self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
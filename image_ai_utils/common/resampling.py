@@ -0,0 +1,47 @@
+from enum import Enum
+from typing import Tuple, Union
+
+from PIL import Image
+
+
+class ResamplingFilter(str, Enum):
+    AUTO = 'auto'  # area average when shrinking, lanczos when enlarging
+    LANCZOS = 'lanczos'
+    AREA = 'area'
+    BICUBIC = 'bicubic'
+    NEAREST = 'nearest'  # keeps hard edges of pixel art
+
+
+_PIL_FILTERS = {
+    ResamplingFilter.LANCZOS: Image.LANCZOS,
+    ResamplingFilter.AREA: Image.BOX,
+    ResamplingFilter.BICUBIC: Image.BICUBIC,
+    ResamplingFilter.NEAREST: Image.NEAREST,
+}
+
+
+def resample(
+        image: Image.Image,
+        size: Tuple[int, int],
+        resampling_filter: ResamplingFilter = ResamplingFilter.AUTO
+) -> Image.Image:
+    if image.size == size:
+        return image
+    resampling_filter = ResamplingFilter(resampling_filter)
+    if resampling_filter == ResamplingFilter.AUTO:
+        # Lanczos rings on downscales, area average is both sharper and cheaper there
+        shrinking = size[0] * size[1] < image.width * image.height
+        resampling_filter = ResamplingFilter.AREA if shrinking else ResamplingFilter.LANCZOS
+    return image.resize(size, _PIL_FILTERS[resampling_filter])
+
+
+def resample_bgra(
+        data: Union[bytes, memoryview],
+        size: Tuple[int, int],
+        target_size: Tuple[int, int],
+        resampling_filter: ResamplingFilter = ResamplingFilter.AUTO
+) -> bytes:
+    # Channels are labelled RGBA while they are in BGRA order. Filters treat colour channels alike
+    # and alpha stays last, so buffer is wrapped without swizzling and comes out in Krita's order
+    image = Image.frombuffer('RGBA', size, data, 'raw', 'RGBA', 0, 1)
+    return resample(image, target_size, resampling_filter).tobytes()
@@ -0,0 +1,90 @@
+import math
+from typing import NamedTuple, Optional, List, Sequence, Tuple, Callable
+
+from PIL import Image
+
+# Models render without artifacts only at multiples of this
+RESOLUTION_MULTIPLE = 64
+# Models were trained on 512x512, smaller renders lose detail and larger ones repeat subjects
+NATIVE_RESOLUTION = 512
+# Buckets whose aspect ratio is within ~5% of the closest one are treated as equally close
+ASPECT_TOLERANCE = 0.05
+# Used when server doesn't report its limit, four native renders fit on most cards
+DEFAULT_MAX_PIXELS = 4 * NATIVE_RESOLUTION ** 2
+
+
+class RenderPlan(NamedTuple):
+    width: int
+    height: int
+    target_width: int
+    target_height: int
+
+    @property
+    def cost(self) -> float:
+        # Relative to single native render, diffusion compute and VRAM grow with pixel count
+        return self.width * self.height / NATIVE_RESOLUTION ** 2
+
+    @property
+    def resized(self) -> bool:
+        return (self.width, self.height) != (self.target_width, self.target_height)
+
+    def fit_source(self, image: Image.Image) -> Image.Image:
+        # Server scales source to render size anyway, scaling it down here saves the upload
+        if image.width * image.height <= self.width * self.height:
+            return image
+        return image.resize((self.width, self.height), Image.LANCZOS, reducing_gap=2.)
+
+
+def _round_to_multiple(value: float, rounding: Callable[[float], int] = round) -> int:
+    return max(RESOLUTION_MULTIPLE, rounding(value / RESOLUTION_MULTIPLE) * RESOLUTION_MULTIPLE)
+
+
+def _aspect_error(size: Tuple[int, int], aspect_ratio: float) -> float:
+    return abs(math.log(size[0] / size[1] / aspect_ratio))
+
+
+def plan_resolution(
+        target_width: int,
+        target_height: int,
+        scaling_mode: str = 'grow',
+        buckets: Optional[Sequence[Sequence[int]]] = None,
+        max_pixels: Optional[int] = None
+) -> RenderPlan:
+    max_pixels = max_pixels or DEFAULT_MAX_PIXELS
+    fits = target_width * target_height <= max_pixels and \
+        target_width % RESOLUTION_MULTIPLE == 0 and target_height % RESOLUTION_MULTIPLE == 0
+    # Selection that is already a valid render size is rendered as is, without resizing
+    if fits and (not buckets or [target_width, target_height] in map(list, buckets)):
+        return RenderPlan(target_width, target_height, target_width, target_height)
+
+    # Same rule server applies to aspect ratio: grow brings shorter side up to native resolution,
+    # shrink brings longer side down to it
+    side = min(target_width, target_height) if scaling_mode == 'grow' else \
+        max(target_width, target_height)
+    scale = NATIVE_RESOLUTION / side
+    width = _round_to_multiple(target_width * scale)
+    height = _round_to_multiple(target_height * scale)
+    if width * height > max_pixels:
+        scale = math.sqrt(max_pixels / (width * height))
+        width = _round_to_multiple(width * scale, math.floor)
+        height = _round_to_multiple(height * scale, math.floor)
+
+    if buckets:
+        # Server only renders its own sizes. Bucket closest to target aspect ratio wins, if
+        # several are about as close, one with pixel count closest to unbucketed plan
+        sizes: List[Tuple[int, int]] = [
+            (bucket_width, bucket_height) for bucket_width, bucket_height in buckets
+            if bucket_width * bucket_height <= max_pixels
+        ] or [tuple(min(buckets, key=lambda bucket: bucket[0] * bucket[1]))]
+        aspect_ratio = target_width / target_height
+        best_error = min(_aspect_error(size, aspect_ratio) for size in sizes)
+        pixels = width * height
+        width, height = min(
+            (
+                size for size in sizes
+                if _aspect_error(size, aspect_ratio) <= best_error + ASPECT_TOLERANCE
+            ),
+            key=lambda size: (abs(math.log(size[0] * size[1] / pixels)), size[0] * size[1])
+        )
+
+    return RenderPlan(width, height, target_width, target_height)
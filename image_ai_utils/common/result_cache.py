@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, NamedTuple, List
+
+from .image_codecs import ImageCodec, ImageEncoder, IMAGE_TYPES
+from .settings import Settings, SETTINGS_PATH
+from .upload_cache import image_digest
+from .utils import encode_request_images, decode_response_images
+
+RESULT_CACHE_PATH = os.path.join(os.path.dirname(SETTINGS_PATH), 'result_cache')
+RESULT_FILE_EXTENSION = '.result'
+# json length, number of attachments
+RESULT_HEADER = struct.Struct('<II')
+ATTACHMENT_LENGTH = struct.Struct('<Q')
+
+
+def result_cache_key(server: str, request: str, request_data: Dict[str, Any]) -> str:
+    def canonical(value: Any) -> Any:
+        if isinstance(value, IMAGE_TYPES):
+            return {'$image': image_digest(value)}
+        if isinstance(value, list):
+            return [canonical(item) for item in value]
+        return value
+
+    # Output format is part of the key too, lossy codecs don't give back the same pixels
+    key_data = {key: canonical(value) for key, value in request_data.items()}
+    key_data.update({'$server': server, '$request': request})
+    return hashlib.blake2b(
+        json.dumps(key_data, sort_keys=True, default=str).encode(), digest_size=20
+    ).hexdigest()
+
+
+class ResultCacheStats(NamedTuple):
+    hits: int
+    misses: int
+    entries: int
+    size: int
+
+
+# Results of deterministic requests on disk, least recently used ones are evicted when total size
+# goes over the limit. Every result is a single file with images in raw format, so reading it back
+# is mostly decompression
+class ResultCache:
+    _instance: Optional['ResultCache'] = None
+
+    def __init__(self, directory: str, max_size: int):
+        self._directory = directory
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._encoder = ImageEncoder(codec=ImageCodec.RAW)
+        self._entries: Optional['OrderedDict[str, int]'] = None
+        self._hits = 0
+        self._misses = 0
+
+    @classmethod
+    def instance(cls) -> 'ResultCache':
+        settings = Settings.settings()
+        max_size = (settings.RESULT_CACHE_SIZE if settings is not None else 1024) * 1024 * 1024
+        if cls._instance is None:
+            cls._instance = ResultCache(RESULT_CACHE_PATH, max_size)
+        else:
+            cls._instance.set_max_size(max_size)
+        return cls._instance
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self._directory, key + RESULT_FILE_EXTENSION)
+
+    def _load_entries(self) -> 'OrderedDict[str, int]':
+        # Modification time is bumped on every hit, so it orders entries from least recently used
+        if self._entries is None:
+            files = []
+            if os.path.isdir(self._directory):
+                for entry in os.scandir(self._directory):
+                    key, extension = os.path.splitext(entry.name)
+                    if entry.is_file() and extension == RESULT_FILE_EXTENSION:
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, key, stat.st_size))
+            self._entries = OrderedDict((key, size) for _, key, size in sorted(files))
+        return self._entries
+
+    def _evict(self):
+        entries = self._load_entries()
+        total_size = sum(entries.values())
+        while entries and total_size > self._max_size:
+            key, size = entries.popitem(last=False)
+            total_size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def set_max_size(self, max_size: int):
+        with self._lock:
+            self._max_size = max_size
+            self._evict()
+
+    @property
+    def stats(self) -> ResultCacheStats:
+        with self._lock:
+            entries = self._load_entries()
+            return ResultCacheStats(self._hits, self._misses, len(entries), sum(entries.values()))
+
+    def get(self, key: str, lazy: bool = False) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if key not in self._load_entries():
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = memoryview(f.read())
+            os.utime(path)
+            json_length, num_attachments = RESULT_HEADER.unpack_from(data)
+            offset = RESULT_HEADER.size
+            result = json.loads(bytes(data[offset:offset + json_length]))
+            offset += json_length
+            attachments: List[memoryview] = []
+            for _ in range(num_attachments):
+                length, = ATTACHMENT_LENGTH.unpack_from(data, offset)
+                offset += ATTACHMENT_LENGTH.size
+                attachments.append(data[offset:offset + length])
+                offset += length
+            result = decode_response_images(result, attachments, lazy=lazy)
+        except (OSError, ValueError, struct.error):
+            # Broken or removed by someone else, it will be replaced by the next result
+            with self._lock:
+                self._entries.pop(key, None)
+                self._misses += 1
+            return None
+
+        with self._lock:
+            self._hits += 1
+        return result
+
+    def put(self, key: str, result: Dict[str, Any]):
+        data, attachments = encode_request_images(result, binary=True, encoder=self._encoder)
+        data = json.dumps(data).encode()
+        parts = [RESULT_HEADER.pack(len(data), len(attachments)), data]
+        for attachment in attachments:
+            parts.append(ATTACHMENT_LENGTH.pack(len(attachment)))
+            parts.append(attachment)
+
+        path = self._path(key)
+        temporary_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            with open(temporary_path, 'wb') as f:
+                f.writelines(parts)
+            os.replace(temporary_path, path)
+        except OSError:
+            # Cache is only an optimization, full disk shouldn't fail the request
+            return
+
+        with self._lock:
+            entries = self._load_entries()
+            entries[key] = sum(map(len, parts))
+            entries.move_to_end(key)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for key in self._load_entries():
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._hits = 0
+            self._misses = 0
@@ -0,0 +1,156 @@
+import asyncio
+import time
+from typing import Optional, List, Dict, Tuple
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+from .client import ImageAIUtilsClient
+from .event_loop import BackgroundEventLoop
+from .settings import Settings
+
+LATENCY_SMOOTHING = 0.3
+# Unreachable server is tried again after this many seconds, doubled on every failure in a row
+FAILURE_BACKOFF = 5
+MAX_FAILURE_BACKOFF = 120
+
+
+class ServerHealth:
+    def __init__(self, url: str):
+        self.url = url
+        self.latency: Optional[float] = None
+        self.queue_depth: Optional[int] = None
+        self.failures = 0
+        self._retry_at = 0.
+
+    @property
+    def available(self) -> bool:
+        return self.failures == 0 or time.monotonic() >= self._retry_at
+
+    def record_success(self, latency: Optional[float] = None, queue_depth: Optional[int] = None):
+        self.failures = 0
+        if latency is not None:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+        if queue_depth is not None:
+            self.queue_depth = queue_depth
+
+    def record_failure(self):
+        self.failures += 1
+        self._retry_at = time.monotonic() + min(
+            MAX_FAILURE_BACKOFF, FAILURE_BACKOFF * 2 ** (self.failures - 1)
+        )
+
+
+# Servers from settings with their last known health. Jobs go to the least loaded reachable
+# server, health checks only run when there is more than one server to choose from
+class ServerPool(QObject):
+    checked = pyqtSignal()
+
+    _instance: Optional['ServerPool'] = None
+
+    def __init__(self):
+        super().__init__()
+        self._health: Dict[str, ServerHealth] = {}
+        self._checking = False
+
+    @classmethod
+    def instance(cls) -> 'ServerPool':
+        if cls._instance is None:
+            cls._instance = ServerPool()
+        cls._instance.set_servers(
+            Settings.settings().servers() if Settings.settings() is not None else []
+        )
+        return cls._instance
+
+    @property
+    def servers(self) -> List[str]:
+        return list(self._health)
+
+    def set_servers(self, servers: List[str]):
+        if servers == self.servers:
+            return
+        # Servers that are still in the list keep what is known about them
+        self._health = {url: self._health.get(url) or ServerHealth(url) for url in servers}
+
+    def health(self, server: str) -> Optional[ServerHealth]:
+        return self._health.get(server)
+
+    def record_success(self, server: str):
+        health = self._health.get(server)
+        if health is not None:
+            health.record_success()
+
+    def record_failure(self, server: str):
+        health = self._health.get(server)
+        if health is not None:
+            health.record_failure()
+
+    def has_alternative(self, server: str) -> bool:
+        return any(
+            health.available for health in self._health.values() if health.url != server
+        )
+
+    def choose(
+            self,
+            running: Dict[str, int],
+            limit: int,
+            affinity: Optional[str] = None,
+            pinned: bool = False
+    ) -> Optional[str]:
+        # Pinned job without a server to stick to can run anywhere
+        if pinned and affinity is not None:
+            return affinity if running.get(affinity, 0) < limit else None
+
+        free = [health for health in self._health.values() if running.get(health.url, 0) < limit]
+        # Unreachable servers are skipped while there is somewhere else to go, if every server is
+        # down jobs still run and fail with retries like with a single server
+        if any(health.available for health in self._health.values()):
+            free = [health for health in free if health.available]
+        if not free:
+            return None
+
+        # Server that already has uploads and results of previous job is preferred while it has
+        # free slots, even if others are less loaded
+        for health in free:
+            if health.url == affinity:
+                return affinity
+
+        # Reported queue lags behind, so jobs started since the last check are added to it
+        def load(health: ServerHealth) -> Tuple[int, float]:
+            return (health.queue_depth or 0) + running.get(health.url, 0), health.latency or 0.
+
+        return min(free, key=load).url
+
+    def check(self):
+        if self._checking or len(self._health) < 2:
+            return
+
+        # Clients are created on this thread, creating them blocks on the event loop
+        clients = [
+            (health, ImageAIUtilsClient.client(health.url).acquire())
+            for health in self._health.values()
+        ]
+        self._checking = True
+        future = BackgroundEventLoop.instance().submit(self._check(clients))
+        future.add_done_callback(lambda _: self._on_checked(clients))
+
+    @staticmethod
+    async def _check(clients: List[Tuple[ServerHealth, ImageAIUtilsClient]]):
+        results = await asyncio.gather(
+            *(client.async_client.check_health() for _, client in clients),
+            return_exceptions=True
+        )
+        for (health, _), result in zip(clients, results):
+            if isinstance(result, Exception):
+                health.record_failure()
+            else:
+                health.record_success(*result)
+
+    def _on_checked(self, clients: List[Tuple[ServerHealth, ImageAIUtilsClient]]):
+        # Called from the event loop thread, signal is delivered to the queue on GUI thread
+        for _, client in clients:
+            client.release()
+        self._checking = False
+        self.checked.emit()
@@ -1,6 +1,7 @@
 import json
 import os.path
 from os import environ
+from typing import Optional, List
 
 from pydantic import BaseSettings, Field
 
@@ -16,10 +17,39 @@ class Settings(BaseSettings):
     USERNAME: str = Field(...)
     PASSWORD: str = Field(...)
     SERVER_URL: str = Field('localhost:8000')
+    SERVER_URLS: List[str] = Field([])  # other servers jobs are balanced between
+    HEALTH_CHECK_INTERVAL: float = Field(15)  # seconds
     USE_TLS: bool = Field(False)
+    USE_WEBSOCKET_SESSION: bool = Field(False)
+    IMAGE_TRANSPORT: str = Field('base64')
+    IMAGE_CODEC: str = Field('png')
+    PNG_COMPRESS_LEVEL: int = Field(1)
+    USE_HTTP2: bool = Field(True)
+    HTTP_MAX_CONNECTIONS: int = Field(10)
+    HTTP_MAX_KEEPALIVE_CONNECTIONS: int = Field(5)
+    HTTP_KEEPALIVE_EXPIRY: float = Field(30)  # seconds idle connection is kept open
+    CONNECT_TIMEOUT: float = Field(10)
+    READ_TIMEOUT: Optional[float] = Field(None)
+    MAX_CONCURRENT_JOBS: int = Field(2)
+    JOB_MAX_RETRIES: int = Field(2)
+    JOB_RETRY_DELAY: float = Field(2)
+    USE_UPLOAD_CACHE: bool = Field(True)
+    UPLOAD_CACHE_SIZE: int = Field(64)
+    USE_RESULT_CACHE: bool = Field(True)
+    RESULT_CACHE_SIZE: int = Field(1024)  # megabytes
+    INPAINT_CROP_TO_MASK: bool = Field(True)
+    INPAINT_CONTEXT_MARGIN: int = Field(64)  # pixels around the mask sent with the crop
+    INCREMENTAL_TILE_SIZE: int = Field(512)  # img2img source tiles compared between runs
+    INCREMENTAL_TILE_OVERLAP: int = Field(64)
+    BATCH_WINDOW: int = Field(4)  # layers of batch action read ahead of the server
+    RESAMPLING_FILTER: str = Field('auto')  # used when results are fitted into selection
+    RESULT_THUMBNAIL_SIZE: int = Field(256)  # 0 to always receive full resolution variants
 
     _settings = None
 
+    def servers(self) -> List[str]:
+        return list(dict.fromkeys([self.SERVER_URL] + self.SERVER_URLS))
+
     @classmethod
     def reload(cls):
         if not os.path.isfile(SETTINGS_PATH):
@@ -0,0 +1,205 @@
+import math
+import threading
+from typing import NamedTuple, Tuple, List, Callable, Set, Optional, Iterable, Union
+
+from PIL import Image, ImageChops
+
+from .pixel_buffer import PixelBuffer
+from .upload_cache import image_digest
+from .utils import map_images
+
+Box = Tuple[int, int, int, int]  # left, top, right, bottom
+# Models work on multiples of 64, crops of such size are processed without rescaling
+CROP_MULTIPLE = 64
+
+
+class Tile(NamedTuple):
+    index: int
+    column: int
+    row: int
+    core: Box  # source pixels this tile is responsible for
+    context: Box  # core grown by overlap, this part is sent to server
+    output_core: Box
+    output_context: Box
+
+
+class TilePlan:
+    def __init__(
+            self,
+            width: int,
+            height: int,
+            target_width: int,
+            target_height: int,
+            tile_size: int = 512,
+            overlap: int = 32
+    ):
+        self.width = width
+        self.height = height
+        self.target_width = target_width
+        self.target_height = target_height
+        self.columns = max(1, math.ceil(width / tile_size))
+        self.rows = max(1, math.ceil(height / tile_size))
+        # Seams are blended over half of upscaled overlap on each side of the border
+        self.blend = int(overlap * min(target_width / width, target_height / height) / 2)
+
+        # Equal sized cores, so last row and column aren't slivers
+        x_edges = [round(i * width / self.columns) for i in range(self.columns + 1)]
+        y_edges = [round(i * height / self.rows) for i in range(self.rows + 1)]
+
+        self.tiles: List[Tile] = []
+        for row in range(self.rows):
+            for column in range(self.columns):
+                core = (x_edges[column], y_edges[row], x_edges[column + 1], y_edges[row + 1])
+                context = (
+                    max(0, core[0] - overlap),
+                    max(0, core[1] - overlap),
+                    min(width, core[2] + overlap),
+                    min(height, core[3] + overlap)
+                )
+                self.tiles.append(Tile(
+                    len(self.tiles),
+                    column,
+                    row,
+                    core,
+                    context,
+                    self.scale_box(core),
+                    self.scale_box(context)
+                ))
+
+    def scale_box(self, box: Box) -> Box:
+        # Every edge is scaled independently, so adjacent boxes stay adjacent after rounding
+        return (
+            round(box[0] * self.target_width / self.width),
+            round(box[1] * self.target_height / self.height),
+            round(box[2] * self.target_width / self.width),
+            round(box[3] * self.target_height / self.height)
+        )
+
+
+# Only cores are compared, change in overlap of a tile is a change in core of its neighbour.
+# Hashing releases GIL, so tiles are hashed in the decode pool
+def tile_digests(
+        image: Union[Image.Image, PixelBuffer],
+        plan: TilePlan,
+        progress_callback: Optional[Callable[[float], None]] = None
+) -> List[str]:
+    hashed = 0
+    lock = threading.Lock()
+
+    def digest(tile: Tile) -> str:
+        nonlocal hashed
+        result = image_digest(image.crop(tile.core))
+        if progress_callback is not None:
+            with lock:
+                hashed += 1
+                progress_callback(hashed / len(plan.tiles))
+        return result
+
+    return map_images(digest, plan.tiles)
+
+
+def _grow_span(start: int, end: int, margin: int, size: int, multiple: int) -> Tuple[int, int]:
+    start, end = max(0, start - margin), min(size, end + margin)
+    length = min(size, math.ceil((end - start) / multiple) * multiple)
+    # Padding is split between both sides, span is shifted back inside the image at its edges
+    start = max(0, min(size - length, start - (length - (end - start)) // 2))
+    return start, start + length
+
+
+def mask_crop_box(
+        mask: Image.Image, margin: int, multiple: int = CROP_MULTIPLE
+) -> Optional[Box]:
+    # Bounding box of non-zero pixels is found by PIL without going through pixels in python
+    bbox = mask.getbbox()
+    if bbox is None:
+        return None
+    left, right = _grow_span(bbox[0], bbox[2], margin, mask.width, multiple)
+    top, bottom = _grow_span(bbox[1], bbox[3], margin, mask.height, multiple)
+    return left, top, right, bottom
+
+
+def _box_size(box: Box) -> Tuple[int, int]:
+    return box[2] - box[0], box[3] - box[1]
+
+
+# Writes upscaled tiles as soon as they arrive, in any order. First tile of adjacent pair writes
+# shared strip as is, second one blends over it with linear ramp read back from destination,
+# so only tiles in flight are kept in memory
+class TileBlender:
+    def __init__(
+            self,
+            plan: TilePlan,
+            read: Callable[[Box], Image.Image],
+            write: Callable[[Box, Image.Image], None],
+            written: Iterable[Tuple[int, int]] = ()
+    ):
+        self._plan = plan
+        self._read = read
+        self._write = write
+        # (column, row) of tiles already in destination, new tiles are blended over them
+        self._written: Set[Tuple[int, int]] = set(written)
+
+    @property
+    def finished(self) -> bool:
+        return len(self._written) == len(self._plan.tiles)
+
+    def _write_box(self, tile: Tile) -> Box:
+        blend = self._plan.blend
+        core, context = tile.output_core, tile.output_context
+        return (
+            max(context[0], core[0] - blend) if tile.column > 0 else core[0],
+            max(context[1], core[1] - blend) if tile.row > 0 else core[1],
+            min(context[2], core[2] + blend) if tile.column < self._plan.columns - 1 else core[2],
+            min(context[3], core[3] + blend) if tile.row < self._plan.rows - 1 else core[3]
+        )
+
+    def _blend_mask(self, tile: Tile, box: Box) -> Image.Image:
+        width, height = _box_size(box)
+        core = tile.output_core
+        mask = Image.new('L', (width, height), 255)
+        ramp = Image.linear_gradient('L')
+
+        sides = [
+            ((tile.column - 1, tile.row), 2 * (core[0] - box[0]), True, None),
+            ((tile.column + 1, tile.row), 2 * (box[2] - core[2]), True, Image.FLIP_LEFT_RIGHT),
+            ((tile.column, tile.row - 1), 2 * (core[1] - box[1]), False, None),
+            ((tile.column, tile.row + 1), 2 * (box[3] - core[3]), False, Image.FLIP_TOP_BOTTOM),
+        ]
+        for neighbour, strip, horizontal, flip in sides:
+            if neighbour not in self._written or strip <= 0:
+                continue
+
+            # Weight of this tile goes from 0 at the outer edge to full at the end of the strip
+            if horizontal:
+                strip = min(strip, width)
+                side_ramp = ramp.transpose(Image.TRANSPOSE).resize((strip, height))
+                left, top = (0, 0) if flip is None else (width - strip, 0)
+            else:
+                strip = min(strip, height)
+                side_ramp = ramp.resize((width, strip))
+                left, top = (0, 0) if flip is None else (0, height - strip)
+            if flip is not None:
+                side_ramp = side_ramp.transpose(flip)
+
+            area = (left, top, left + side_ramp.width, top + side_ramp.height)
+            mask.paste(ImageChops.darker(mask.crop(area), side_ramp), area)
+
+        return mask
+
+    def add(self, tile: Tile, image: Image.Image):
+        context = tile.output_context
+        if image.size != _box_size(context):
+            image = image.resize(_box_size(context), Image.LANCZOS)
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+
+        box = self._write_box(tile)
+        region = image.crop((
+            box[0] - context[0], box[1] - context[1], box[2] - context[0], box[3] - context[1]
+        ))
+        mask = self._blend_mask(tile, box)
+        if mask.getextrema() != (255, 255):
+            region = Image.composite(region, self._read(box), mask)
+
+        self._write(box, region)
+        self._written.add((tile.column, tile.row))
@@ -1,20 +1,34 @@
 from enum import Enum
-from typing import Optional, List
+from functools import partial
+from typing import Optional, List, Tuple, Dict, Any, Callable
 
 from PyQt5 import uic
-from PyQt5.QtCore import QRect
+from PyQt5.QtCore import QRect, Qt, pyqtSignal
 from PyQt5.QtGui import QPixmap, QPainter, QPaintEvent
 from PyQt5.QtWidgets import QDialog, QPushButton, QSizePolicy, QCheckBox, QSpinBox, QGridLayout, \
     QTextEdit, QDoubleSpinBox, QLabel, QComboBox
 
 from PIL import Image
 from PIL.ImageQt import ImageQt
-from .exception_dialog import ExceptionDialog
-from .progress_bar_dialog import ProgressBarDialog
+from .job_dialog import JobDialog
 from .upscale_dialog import UpscaleDialog
-from ..client import ImageAIUtilsClient
-from ..progress_thread import ProgressThread
-from ..utils import get_ui_file_path
+from ..async_client import Variants
+from ..capabilities import ServerCapabilities
+from ..job_queue import QUEUED_RESULT_CODE, Job, JobStatus
+from ..resolution import RenderPlan, plan_resolution
+from ..settings import Settings
+from ..utils import get_ui_file_path, map_images
+
+
+def _make_thumbnail(image: Image.Image, size: int) -> Image.Image:
+    if size <= 0 or max(image.size) <= size:
+        return image
+    scale = size / max(image.size)
+    return image.resize(
+        (max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+        Image.BILINEAR,
+        reducing_gap=2.
+    )
 
 
 class ImageSelectButton(QPushButton):
@@ -23,23 +37,36 @@ class ImageSelectButton(QPushButton):
 
         self.setCheckable(True)
         self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
-        self._pixmap = pixmap
         self._margin = 5
-        self._aspect_ratio = self._pixmap.width() / self._pixmap.height()
+        self.set_pixmap(pixmap)
         self.setStyleSheet('QPushButton:checked { border: 3px solid blue }"')
 
+    def set_pixmap(self, pixmap: QPixmap):
+        self._pixmap = pixmap
+        self._scaled_pixmap: Optional[QPixmap] = None
+        self._aspect_ratio = self._pixmap.width() / self._pixmap.height()
+        self.updateGeometry()
+        self.update()
+
     def paintEvent(self, event: QPaintEvent):
         super().paintEvent(event)
-        painter = QPainter()
-        painter.begin(self)
-
         button_rectangle = self.rect()
         height = button_rectangle.height() - self._margin * 2
         width = button_rectangle.width() - self._margin * 2
+        if width <= 0 or height <= 0:
+            return
+
         image_rectangle = QRect(0, 0, width, height)
         image_rectangle.moveCenter(button_rectangle.center())
-        painter.drawPixmap(image_rectangle, self._pixmap)
+        # Pixmap is rescaled only when button is resized, not on every repaint
+        if self._scaled_pixmap is None or self._scaled_pixmap.size() != image_rectangle.size():
+            self._scaled_pixmap = self._pixmap.scaled(
+                image_rectangle.size(), Qt.IgnoreAspectRatio, Qt.SmoothTransformation
+            )
 
+        painter = QPainter()
+        painter.begin(self)
+        painter.drawPixmap(image_rectangle.topLeft(), self._scaled_pixmap)
         painter.end()
 
     def hasHeightForWidth(self) -> bool:
@@ -56,9 +83,18 @@ class DiffusionMode(int, Enum):
     MAKE_TILABLE = 3
 
 
-class DiffusionDialog(QDialog):
+DIFFUSION_MODE_NAMES = {
+    DiffusionMode.TEXT_TO_IMAGE: 'Txt2Img',
+    DiffusionMode.IMAGE_TO_IMAGE: 'Img2Img',
+    DiffusionMode.INPAINT: 'Inpaint',
+    DiffusionMode.MAKE_TILABLE: 'Make Tilable',
+}
+
+
+class DiffusionDialog(JobDialog):
     use_random_seed_check_box: QCheckBox
     seed_spin_box: QSpinBox
+    generate_button: QPushButton
     upscale_selected_button: QPushButton
     apply_button: QPushButton
     images_grid_layout: QGridLayout
@@ -73,6 +109,11 @@ class DiffusionDialog(QDialog):
     border_width_spin_box: QSpinBox
     border_softness_label: QLabel
     border_softness_double_spin_box: QDoubleSpinBox
+    incremental_label: QLabel
+    incremental_check_box: QCheckBox
+    render_size_label: QLabel
+    # Changed tiles are only counted once artist asks for incremental run
+    incremental_requested = pyqtSignal()
 
     def __init__(self):
         super().__init__()
@@ -80,10 +121,23 @@ class DiffusionDialog(QDialog):
         self.use_random_seed_check_box.stateChanged.connect(
             lambda state: self.seed_spin_box.setEnabled(not state)
         )
+        self._set_run_button(self.generate_button)
+        self.scaling_mode_combo_box.currentIndexChanged.connect(self._update_render_plan)
+        self.number_of_variants_spin_box.valueChanged.connect(self._update_render_plan)
+        self.incremental_check_box.toggled.connect(
+            lambda checked: checked and self.incremental_requested.emit()
+        )
         self.upscale_dialog = UpscaleDialog()
-        self.progress_bar_dialog = ProgressBarDialog()
+        self.upscale_dialog.finished.connect(self._on_upscale_finished)
+        self._upscaled_id: Optional[int] = None
         self._columns = 2  # TODO change dynamically
-        self._result_images: List[Image.Image] = []
+        # Full resolution variants, None until fetched when server returned only thumbnails
+        self._result_images: List[Optional[Image.Image]] = []
+        self._thumbnails: List[Image.Image] = []
+        self._result_id: Optional[str] = None
+        # Full resolution variants are kept only on the server that generated them
+        self._result_server: Optional[str] = None
+        self._after_fetch: Optional[Callable[[], None]] = None
         self._result_mask: Optional[Image.Image] = None
         self._image_selection = []
         self._target_width = 512
@@ -91,7 +145,13 @@ class DiffusionDialog(QDialog):
         self._mode: Optional[DiffusionMode] = None
         self._source_image: Optional[Image.Image] = None
         self._mask: Optional[Image.Image] = None
+        self._incremental_available = False
+        self._resolution_buckets: Optional[List[List[int]]] = None
+        self._max_pixels: Optional[int] = None
         self._imageqt = None
+        self._preview_imageqt = {}
+        self._preview_buttons = {}
+        self._queued_request: Optional[Tuple[str, Dict[str, Any]]] = None
 
     def set_source_image(self, source_image: Image.Image):
         self._source_image = source_image
@@ -99,9 +159,51 @@ class DiffusionDialog(QDialog):
     def set_mask(self, mask: Optional[Image.Image]):
         self._mask = mask
 
-    def _update_buttons(self):
+    def set_incremental_available(self, available: bool):
+        # Not available when there is no previous img2img result to update
+        self._incremental_available = available
+        self.incremental_check_box.setChecked(False)
+        self.incremental_check_box.setText('')
+
+    def set_tile_hashing_progress(self, progress: float):
+        self.incremental_check_box.setText(f'comparing tiles {progress:.0%}')
+
+    def set_changed_tiles(self, changed: int, total: int):
+        self.incremental_check_box.setText(f'{changed}/{total} changed')
+
+    @property
+    def incremental(self) -> bool:
+        return self._incremental_available and self._mode == DiffusionMode.IMAGE_TO_IMAGE and \
+            self.incremental_check_box.isChecked()
+
+    def set_capabilities(self, capabilities: ServerCapabilities):
+        self._resolution_buckets = capabilities.resolution_buckets
+        self._max_pixels = capabilities.max_pixels
+        self._update_render_plan()
+
+    def render_plan_for(self, width: int, height: int) -> RenderPlan:
+        return plan_resolution(
+            width,
+            height,
+            self.scaling_mode_combo_box.currentText(),
+            self._resolution_buckets,
+            self._max_pixels
+        )
+
+    @property
+    def render_plan(self) -> RenderPlan:
+        return self.render_plan_for(self._target_width, self._target_height)
+
+    def _update_render_plan(self):
+        plan = self.render_plan
+        text = f'{plan.width}x{plan.height}, ' \
+            f'{plan.cost * self.number_of_variants_spin_box.value():.1f}x cost'
+        if plan.resized:
+            text += f', resized to {plan.target_width}x{plan.target_height}'
+        self.render_size_label.setText(text)
+
+    def _clear_buttons(self):
         layout = self.images_grid_layout
-        # Removing old buttons
         for i in reversed(range(layout.count())):
             item = layout.itemAt(i)
             layout.removeItem(item)
@@ -109,11 +211,34 @@ class DiffusionDialog(QDialog):
             if current_widget:
                 current_widget.setParent(None)
 
-        # Data gets corrupted if we do it in one go or don't save
-        self._imageqt = [ImageQt(image) for image in self._result_images]
+        self._preview_imageqt = {}
+        self._preview_buttons = {}
+
+    def _set_preview(self, variant: int, image: Image.Image):
+        # Data gets corrupted if we don't save ImageQt
+        self._preview_imageqt[variant] = ImageQt(image)
+        pixmap = QPixmap.fromImage(self._preview_imageqt[variant])
+        button = self._preview_buttons.get(variant)
+        if button is None:
+            button = ImageSelectButton(pixmap)
+            button.setCheckable(False)
+            self._preview_buttons[variant] = button
+            self.images_grid_layout.addWidget(
+                button, variant // self._columns, variant % self._columns
+            )
+        else:
+            button.set_pixmap(pixmap)
+
+    def _update_buttons(self):
+        layout = self.images_grid_layout
+        self._clear_buttons()
+
+        # Data gets corrupted if we do it in one go or don't save. Conversion itself is done
+        # in the decode pool, only pixmaps have to be created on GUI thread
+        self._imageqt = map_images(ImageQt, self._thumbnails)
         pixmaps = [QPixmap.fromImage(image) for image in self._imageqt]
 
-        self._image_selection = [False] * len(self._result_images)
+        self._image_selection = [False] * len(self._thumbnails)
         self.upscale_selected_button.setEnabled(False)
         self.apply_button.setEnabled(False)
         for i, pixmap in enumerate(pixmaps):
@@ -121,24 +246,56 @@ class DiffusionDialog(QDialog):
             button.toggled.connect(self._get_toggle_image_slot(i))
             layout.addWidget(button, i // self._columns, i % self._columns)
 
+    def _selected_indices(self) -> List[int]:
+        return [i for i, selected in enumerate(self._image_selection) if selected]
+
+    def _with_full_images(self, indices: List[int], action: Callable[[], None]):
+        if self.running:
+            return
+
+        missing = [i for i in indices if self._result_images[i] is None]
+        if not missing:
+            action()
+            return
+
+        self._after_fetch = action
+        self._submit_job(
+            'Fetch variants',
+            'fetch_variants',
+            {'result_id': self._result_id, 'indices': missing},
+            server=self._result_server
+        )
+
     def upscale(self):
-        selected_id = self._image_selection.index(True)
+        if self.upscale_dialog.isVisible():
+            self.upscale_dialog.activateWindow()
+            return
+
+        self._with_full_images(self._selected_indices()[:1], self._show_upscale_dialog)
+
+    def _show_upscale_dialog(self):
+        self._upscaled_id = self._image_selection.index(True)
         self.upscale_dialog.set_upscaling_params(
-            source_image=self._result_images[selected_id],
+            source_image=self._result_images[self._upscaled_id],
             target_width=self._target_width,
             target_height=self._target_height,
             prompt=self.prompt_plain_text_edit.toPlainText()
         )
-        if not self.upscale_dialog.exec():
-            return
+        self.upscale_dialog.show()
 
-        self._result_images[selected_id] = self.upscale_dialog.result_image
-        self._update_buttons()
+    def _on_upscale_finished(self, result: int):
+        if result == QDialog.Accepted and self._upscaled_id is not None:
+            self._result_images[self._upscaled_id] = self.upscale_dialog.result_image
+            self._thumbnails[self._upscaled_id] = _make_thumbnail(
+                self.upscale_dialog.result_image, Settings.settings().RESULT_THUMBNAIL_SIZE
+            )
+            self._update_buttons()
+        self._upscaled_id = None
 
     def apply(self):
-        self.accept()
+        self._with_full_images(self._selected_indices(), self.accept)
 
-    def generate(self):
+    def _build_request(self) -> Optional[Tuple[str, Dict[str, Any]]]:
         # TODO separate widget
         request_data = {
             'prompt': self.prompt_plain_text_edit.toPlainText(),
@@ -150,45 +307,100 @@ class DiffusionDialog(QDialog):
         if not self.use_random_seed_check_box.isChecked():
             request_data['seed'] = self.seed_spin_box.value()
 
+        plan = self.render_plan
         if self._mode == DiffusionMode.TEXT_TO_IMAGE:
             aspect_ratio = self._target_width / self._target_height
             request_data['aspect_ratio'] = aspect_ratio
-            thread = ProgressThread(ImageAIUtilsClient.client().text_to_image, request_data)
+            request_data['render_size'] = (plan.width, plan.height)
+            return 'text_to_image', request_data
         elif self._mode == DiffusionMode.IMAGE_TO_IMAGE:
             request_data['strength'] = self.strength_double_spin_box.value()
-            request_data['source_image'] = self._source_image
-            thread = ProgressThread(ImageAIUtilsClient.client().image_to_image, request_data)
+            request_data['source_image'] = plan.fit_source(self._source_image)
+            request_data['render_size'] = (plan.width, plan.height)
+            return 'image_to_image', request_data
         elif self._mode == DiffusionMode.INPAINT:
             request_data['strength'] = self.strength_double_spin_box.value()
-            request_data['source_image'] = self._source_image
-            request_data['mask'] = self._mask
-            thread = ProgressThread(ImageAIUtilsClient.client().inpaint, request_data)
+            request_data['source_image'] = plan.fit_source(self._source_image)
+            request_data['mask'] = plan.fit_source(self._mask) if self._mask is not None else None
+            request_data['render_size'] = (plan.width, plan.height)
+            return 'inpaint', request_data
         elif self._mode == DiffusionMode.MAKE_TILABLE:
             request_data['strength'] = self.strength_double_spin_box.value()
-            request_data['source_image'] = self._source_image
+            request_data['source_image'] = plan.fit_source(self._source_image)
+            request_data['render_size'] = (plan.width, plan.height)
             request_data['border_width'] = self.border_width_spin_box.value()
             request_data['border_softness'] = self.border_softness_double_spin_box.value()
-            thread = ProgressThread(ImageAIUtilsClient.client().make_tilable, request_data)
-        else:
+            return 'make_tilable', request_data
+
+        return None
+
+    def generate(self):
+        if self.running:
+            self.cancel_job()
             return
 
-        self.progress_bar_dialog.set_progress(0)
-        thread.progress_signal.connect(self.progress_bar_dialog.set_progress)
-        thread.finished.connect(self.progress_bar_dialog.accept)
-        thread.start()
-        self.progress_bar_dialog.exec()
-        thread.wait()
-        if not thread.success:
-            ExceptionDialog(thread.error_message).exec()
+        # Changed tiles go straight into the previous result layer, there is nothing to choose from
+        if self.incremental:
+            self.queue()
             return
 
-        if self._mode == DiffusionMode.MAKE_TILABLE:
-            self._result_images, self._result_mask = thread.result
-        else:
-            self._result_images = thread.result
+        request = self._build_request()
+        if request is None:
+            return
+
+        client_method, request_data = request
+        # Only thumbnails are needed to choose, selected variants are fetched on apply or upscale
+        request_data['thumbnail_size'] = Settings.settings().RESULT_THUMBNAIL_SIZE
+        self._clear_buttons()
+        self.upscale_selected_button.setEnabled(False)
+        self.apply_button.setEnabled(False)
+        self._submit_job(
+            DIFFUSION_MODE_NAMES[self._mode],
+            client_method,
+            request_data,
+            preview_callback=self._set_preview
+        )
+
+    def _job_finished(self, job: Job):
+        if job.client_method == 'fetch_variants':
+            action, self._after_fetch = self._after_fetch, None
+            if job.status == JobStatus.FINISHED:
+                for i, image in zip(job.request_data['indices'], job.result):
+                    self._result_images[i] = image
+                action()
+            return
+
+        if job.status == JobStatus.FINISHED:
+            result = job.result
+            if self._mode == DiffusionMode.MAKE_TILABLE:
+                result, self._result_mask = result
+            if not isinstance(result, Variants):
+                result = Variants(result)
+
+            self._result_id = result.result_id
+            self._result_server = job.server
+            if self._result_id is None:
+                # Server doesn't support thumbnails, full images are scaled down just for display
+                self._result_images = list(result.images)
+                self._thumbnails = map_images(
+                    partial(_make_thumbnail, size=Settings.settings().RESULT_THUMBNAIL_SIZE),
+                    result.images
+                )
+            else:
+                self._result_images = [None] * len(result.images)
+                self._thumbnails = list(result.images)
 
         self._update_buttons()
 
+    def queue(self):
+        self._queued_request = self._build_request()
+        if self._queued_request is not None:
+            self.done(QUEUED_RESULT_CODE)
+
+    @property
+    def queued_request(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        return self._queued_request
+
     def _get_toggle_image_slot(self, i: int):
         def _toggle(checked: bool):
             self._image_selection[i] = checked
@@ -205,10 +417,14 @@ class DiffusionDialog(QDialog):
         self.border_width_spin_box.setVisible(mode == DiffusionMode.MAKE_TILABLE)
         self.border_softness_label.setVisible(mode == DiffusionMode.MAKE_TILABLE)
         self.border_softness_double_spin_box.setVisible(mode == DiffusionMode.MAKE_TILABLE)
+        incremental_visible = mode == DiffusionMode.IMAGE_TO_IMAGE and self._incremental_available
+        self.incremental_label.setVisible(incremental_visible)
+        self.incremental_check_box.setVisible(incremental_visible)
 
     def set_target_size(self, width, height):
         self._target_width = width
         self._target_height = height
+        self._update_render_plan()
 
     @property
     def result_images(self) -> List[Image.Image]:
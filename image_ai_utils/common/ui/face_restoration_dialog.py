@@ -1,29 +1,29 @@
-from typing import Optional
+from typing import Optional, Tuple, Dict, Any
 
 from PIL import Image
 
-from httpx import HTTPStatusError
-
-import httpx
 from PyQt5.QtGui import QPixmap
 
 from PIL.ImageQt import ImageQt
 from PyQt5 import uic
-from PyQt5.QtWidgets import QDialog, QComboBox, QSpinBox, QCheckBox, QPushButton, QLabel
+from PyQt5.QtWidgets import QComboBox, QSpinBox, QCheckBox, QPushButton, QLabel
 
-from .exception_dialog import ExceptionDialog
-from ..client import ImageAIUtilsClient, GFPGANModel
+from .job_dialog import JobDialog
+from ..capabilities import ServerCapabilities, model_choices
+from ..client import GFPGANModel
+from ..job_queue import QUEUED_RESULT_CODE, Job, JobStatus
 from ..utils import get_ui_file_path
 
 GFPGAN_MODELS = [GFPGANModel.V1_3, GFPGANModel.V1_2, GFPGANModel.V1]
 
 
-class FaceRestorationDialog(QDialog):
+class FaceRestorationDialog(JobDialog):
     model_combo_box: QComboBox
     use_real_esrgan_check_box: QCheckBox
     background_tile_spin_box: QSpinBox
     upscale_factor_spin_box: QSpinBox
     only_center_face_check_box: QCheckBox
+    restore_button: QPushButton
     apply_button: QPushButton
     image_label: QLabel
 
@@ -31,8 +31,16 @@ class FaceRestorationDialog(QDialog):
         super().__init__()
         uic.loadUi(get_ui_file_path('face_restoration_dialog.ui'), self)
 
+        self._gfpgan_models = [
+            (self.model_combo_box.itemText(i), GFPGAN_MODELS[i])
+            for i in range(self.model_combo_box.count())
+        ]
+        self._set_model_choices(self.model_combo_box, self._gfpgan_models)
+
         self._source_image: Optional[Image.Image] = None
         self._result_image: Optional[Image.Image] = None
+        self._queued_request: Optional[Tuple[str, Dict[str, Any]]] = None
+        self._set_run_button(self.restore_button)
         self.apply_button.setEnabled(False)
 
     def set_source_image(self, source_image: Image.Image):
@@ -42,28 +50,48 @@ class FaceRestorationDialog(QDialog):
         self.image_label.setPixmap(pixmap)
         self.apply_button.setEnabled(False)
 
+    def set_capabilities(self, capabilities: ServerCapabilities):
+        self._set_model_choices(
+            self.model_combo_box, model_choices(self._gfpgan_models, capabilities.gfpgan_models)
+        )
+
+    def _build_request(self) -> Tuple[str, Dict[str, Any]]:
+        return 'restore_face', {
+            'source_image': self._source_image,
+            'model_type': self.model_combo_box.currentData(),
+            'use_real_esrgan': self.use_real_esrgan_check_box.isChecked(),
+            'bg_tile': self.background_tile_spin_box.value(),
+            'upscale': self.upscale_factor_spin_box.value(),
+            'only_center_face': self.only_center_face_check_box.isChecked()
+        }
+
     def restore_face(self):
-        try:
-            self._result_image = ImageAIUtilsClient.client().restore_face(
-                source_image=self._source_image,
-                model_type=GFPGAN_MODELS[self.model_combo_box.currentIndex()],
-                use_real_esrgan=self.use_real_esrgan_check_box.isChecked(),
-                bg_tile=self.background_tile_spin_box.value(),
-                upscale=self.upscale_factor_spin_box.value(),
-                only_center_face=self.only_center_face_check_box.isChecked()
-            )
-        except HTTPStatusError as e:
-            ExceptionDialog(f'{e.response.status_code}: {e.response.text}').exec()
+        if self.running:
+            self.cancel_job()
             return
-        except httpx.ConnectError:
-            ExceptionDialog(f'Could not connect to server').exec()
+
+        client_method, request_data = self._build_request()
+        self.apply_button.setEnabled(False)
+        self._submit_job('Face Restoration', client_method, request_data)
+
+    def _job_finished(self, job: Job):
+        if job.status != JobStatus.FINISHED:
             return
 
+        self._result_image = job.result
         self._imageqt = ImageQt(self._result_image)
         pixmap = QPixmap.fromImage(self._imageqt)
         self.image_label.setPixmap(pixmap)
         self.apply_button.setEnabled(True)
 
+    def queue(self):
+        self._queued_request = self._build_request()
+        self.done(QUEUED_RESULT_CODE)
+
+    @property
+    def queued_request(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        return self._queued_request
+
     @property
     def result_image(self) -> Optional[Image.Image]:
         return self._result_image
@@ -0,0 +1,92 @@
+from typing import Optional, Dict, Any, Callable, List, Tuple
+
+from PyQt5.QtWidgets import QDialog, QPushButton, QComboBox
+
+from PIL import Image
+from .exception_dialog import ExceptionDialog
+from ..job_queue import Job, JobQueue, JobPriority, JobStatus
+
+
+# Modeless dialog that runs its request through the job queue, so Krita stays interactive and
+# progress is reported in the docker. While job is running run button cancels it
+class JobDialog(QDialog):
+    def __init__(self):
+        super().__init__()
+        self.setModal(False)
+        self._job: Optional[Job] = None
+        self._run_button: Optional[QPushButton] = None
+        self._run_button_text = ''
+        # Next jobs prefer the same server, it already has uploaded images of this dialog
+        self._last_server: Optional[str] = None
+
+    def _set_run_button(self, button: QPushButton):
+        self._run_button = button
+        self._run_button_text = button.text()
+
+    @staticmethod
+    def _set_model_choices(combo_box: QComboBox, choices: List[Tuple[str, str]]):
+        # Model is stored as item data, so selection survives server adding or removing models
+        current_model = combo_box.currentData()
+        combo_box.clear()
+        for name, model in choices:
+            combo_box.addItem(name, model)
+        index = combo_box.findData(current_model)
+        combo_box.setCurrentIndex(max(index, 0))
+
+    @property
+    def running(self) -> bool:
+        return self._job is not None
+
+    def _submit_job(
+            self,
+            name: str,
+            client_method: str,
+            request_data: Dict[str, Any],
+            preview_callback: Optional[Callable[[int, Image.Image], None]] = None,
+            server: Optional[str] = None
+    ) -> Job:
+        # Job that needs results kept on specific server only runs there
+        self._job = Job(
+            name,
+            client_method,
+            request_data,
+            priority=JobPriority.HIGH,
+            stream_previews=preview_callback is not None,
+            affinity=server or self._last_server,
+            pinned=server is not None
+        )
+        self._job.changed.connect(self._on_job_changed)
+        if preview_callback is not None:
+            self._job.preview.connect(preview_callback)
+        self._set_running(True)
+        return JobQueue.instance().submit(self._job)
+
+    def _on_job_changed(self):
+        job = self._job
+        if job is None or not job.done:
+            return
+
+        job.changed.disconnect(self._on_job_changed)
+        self._job = None
+        if job.status == JobStatus.FINISHED:
+            self._last_server = job.server
+        self._set_running(False)
+        if job.status == JobStatus.FAILED:
+            ExceptionDialog(job.error_message).exec()
+        self._job_finished(job)
+
+    def _job_finished(self, job: Job):
+        pass
+
+    def _set_running(self, running: bool):
+        if self._run_button is not None:
+            self._run_button.setText('Cancel' if running else self._run_button_text)
+
+    def cancel_job(self):
+        if self._job is not None:
+            JobQueue.instance().cancel(self._job)
+
+    def done(self, result: int):
+        # Nobody would see result of the job after dialog is closed
+        self.cancel_job()
+        super().done(result)
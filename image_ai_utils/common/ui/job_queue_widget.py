@@ -0,0 +1,96 @@
+from typing import Dict
+
+from PyQt5 import uic
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QWidget, QListWidget, QPushButton, QListWidgetItem, QLabel
+
+from .exception_dialog import ExceptionDialog
+from ..job_queue import JobQueue, Job, JobStatus, JobBatch
+from ..utils import get_ui_file_path
+
+
+class JobQueueWidget(QWidget):
+    jobs_list_widget: QListWidget
+    cancel_job_button: QPushButton
+    clear_finished_button: QPushButton
+    batch_status_label: QLabel
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        uic.loadUi(get_ui_file_path('job_queue_widget.ui'), self)
+        self._items: Dict[Job, QListWidgetItem] = {}
+
+        self._queue = JobQueue.instance()
+        self._queue.job_added.connect(self._add_job)
+        self._queue.job_removed.connect(self._remove_job)
+        for job in self._queue.jobs:
+            self._add_job(job)
+        self._queue.batch_added.connect(self._add_batch)
+        self._queue.batch_removed.connect(lambda _: self._update_batch_status())
+        for batch in self._queue.batches:
+            batch.changed.connect(self._update_batch_status)
+        self._update_batch_status()
+
+        self.jobs_list_widget.itemSelectionChanged.connect(self._update_buttons)
+        self.jobs_list_widget.itemDoubleClicked.connect(self._show_error)
+        self.cancel_job_button.clicked.connect(self.cancel_selected)
+        self.clear_finished_button.clicked.connect(self._queue.clear_finished)
+
+    def _add_job(self, job: Job):
+        item = QListWidgetItem()
+        item.setData(Qt.UserRole, job)
+        self._items[job] = item
+        self.jobs_list_widget.addItem(item)
+        job.changed.connect(lambda: self._update_item(job))
+        self._update_item(job)
+
+    def _remove_job(self, job: Job):
+        item = self._items.pop(job, None)
+        if item is not None:
+            self.jobs_list_widget.takeItem(self.jobs_list_widget.row(item))
+
+    def _add_batch(self, batch: JobBatch):
+        batch.changed.connect(self._update_batch_status)
+        self._update_batch_status()
+
+    def _update_batch_status(self):
+        lines = []
+        for batch in self._queue.batches:
+            line = f'{batch.name}: {batch.finished}/{batch.total} layers'
+            if batch.failed:
+                line += f', {batch.failed} failed'
+            if batch.throughput is not None:
+                line += f', {batch.throughput:.2f} MP/s'
+            lines.append(line)
+        self.batch_status_label.setText('\n'.join(lines))
+        self.batch_status_label.setVisible(bool(lines))
+
+    def _update_item(self, job: Job):
+        item = self._items.get(job)
+        if item is None:
+            return
+
+        if job.status == JobStatus.RUNNING:
+            status = f'{int(job.progress * 100)}%'
+        elif job.status == JobStatus.RETRYING:
+            status = f'retrying ({job.attempts})'
+        else:
+            status = job.status.value
+        item.setText(f'{job.name}: {status}')
+        item.setToolTip(job.error_message or '')
+        self._update_buttons()
+
+    def _selected_jobs(self):
+        return [item.data(Qt.UserRole) for item in self.jobs_list_widget.selectedItems()]
+
+    def _update_buttons(self):
+        self.cancel_job_button.setEnabled(any(not job.done for job in self._selected_jobs()))
+
+    def _show_error(self, item: QListWidgetItem):
+        job: Job = item.data(Qt.UserRole)
+        if job.status == JobStatus.FAILED and job.error_message:
+            ExceptionDialog(job.error_message).exec()
+
+    def cancel_selected(self):
+        for job in self._selected_jobs():
+            self._queue.cancel(job)
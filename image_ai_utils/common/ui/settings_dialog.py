@@ -1,9 +1,15 @@
 import json
+from typing import Optional
 
+import httpx
 from PyQt5 import uic
-from PyQt5.QtWidgets import QDialog, QLineEdit, QMessageBox, QCheckBox
+from PyQt5.QtCore import pyqtSignal
+from PyQt5.QtWidgets import QDialog, QLineEdit, QMessageBox, QCheckBox, QComboBox, QSpinBox, \
+    QLabel, QPushButton, QPlainTextEdit
 
 from ..client import ImageAIUtilsClient
+from ..progress_task import ProgressTask
+from ..result_cache import ResultCache
 from ..utils import get_ui_file_path
 from ..settings import Settings, SETTINGS_PATH
 
@@ -13,31 +19,84 @@ class SettingsDialog(QDialog):
     username_line_edit: QLineEdit
     password_line_edit: QLineEdit
     use_tls_check_box: QCheckBox
+    use_websocket_session_check_box: QCheckBox
+    image_transport_combo_box: QComboBox
+    image_codec_combo_box: QComboBox
+    png_compress_level_spin_box: QSpinBox
+    max_concurrent_jobs_spin_box: QSpinBox
+    job_max_retries_spin_box: QSpinBox
+    use_result_cache_check_box: QCheckBox
+    result_cache_size_spin_box: QSpinBox
+    result_cache_stats_label: QLabel
+    clear_result_cache_button: QPushButton
+    server_urls_plain_text_edit: QPlainTextEdit
+    resampling_filter_combo_box: QComboBox
+
+    # Emitted once handshake with servers is finished and their capabilities are stored
+    capabilities_changed = pyqtSignal()
 
     def __init__(self):
         super().__init__()
         uic.loadUi(get_ui_file_path('settings_dialog.ui'), self)
+        self._negotiation: Optional[ProgressTask] = None
+
+    def _update_result_cache_stats(self):
+        stats = ResultCache.instance().stats
+        self.result_cache_stats_label.setText(
+            f'{stats.hits} hits, {stats.misses} misses, {stats.entries} results '
+            f'({stats.size / 1024 / 1024:.1f} MB)'
+        )
 
     def init_fields(self):
+        self._update_result_cache_stats()
         if Settings.settings() is None:
             return
 
         self.url_line_edit.setText(Settings.settings().SERVER_URL)
         self.username_line_edit.setText(Settings.settings().USERNAME)
         self.password_line_edit.setText(Settings.settings().PASSWORD)
+        self.use_tls_check_box.setChecked(Settings.settings().USE_TLS)
+        self.use_websocket_session_check_box.setChecked(
+            Settings.settings().USE_WEBSOCKET_SESSION
+        )
+        self.image_transport_combo_box.setCurrentText(Settings.settings().IMAGE_TRANSPORT)
+        self.image_codec_combo_box.setCurrentText(Settings.settings().IMAGE_CODEC)
+        self.png_compress_level_spin_box.setValue(Settings.settings().PNG_COMPRESS_LEVEL)
+        self.max_concurrent_jobs_spin_box.setValue(Settings.settings().MAX_CONCURRENT_JOBS)
+        self.job_max_retries_spin_box.setValue(Settings.settings().JOB_MAX_RETRIES)
+        self.use_result_cache_check_box.setChecked(Settings.settings().USE_RESULT_CACHE)
+        self.result_cache_size_spin_box.setValue(Settings.settings().RESULT_CACHE_SIZE)
+        self.server_urls_plain_text_edit.setPlainText('\n'.join(Settings.settings().SERVER_URLS))
+        self.resampling_filter_combo_box.setCurrentText(Settings.settings().RESAMPLING_FILTER)
+
+    def clear_result_cache(self):
+        ResultCache.instance().clear()
+        self._update_result_cache_stats()
 
     def test_connection(self):
         client = ImageAIUtilsClient(
             base_url=self.url_line_edit.text(),
             username=self.username_line_edit.text(),
-            password=self.password_line_edit.text()
+            password=self.password_line_edit.text(),
+            use_tls=self.use_tls_check_box.isChecked()
         )
         success, message = client.test_connection()
+        text = 'Successfully connected to server'
+        if success:
+            try:
+                capabilities = client.get_capabilities()
+            except (httpx.HTTPError, ValueError, TypeError):
+                capabilities = None
+            if capabilities is not None and capabilities.version is not None:
+                text += f'\nServer version: {capabilities.version}'
+            if capabilities is not None and capabilities.queue_depth is not None:
+                text += f'\nQueued requests: {capabilities.queue_depth}'
+        client.close()
         if success:
             message_box = QMessageBox()
             message_box.setIcon(QMessageBox.Information)
             message_box.setWindowTitle('Success')
-            message_box.setText('Successfully connected to server')
+            message_box.setText(text)
             message_box.setStandardButtons(QMessageBox.Ok)
             message_box.exec()
         else:
@@ -49,19 +108,53 @@ class SettingsDialog(QDialog):
             message_box.exec()
 
     def save(self):
+        settings = Settings.settings().dict() if Settings.settings() is not None else {}
+        settings.update({
+            'SERVER_URL': self.url_line_edit.text(),
+            'USERNAME': self.username_line_edit.text(),
+            'USE_TLS': self.use_tls_check_box.isChecked(),
+            'USE_WEBSOCKET_SESSION': self.use_websocket_session_check_box.isChecked(),
+            'IMAGE_TRANSPORT': self.image_transport_combo_box.currentText(),
+            'IMAGE_CODEC': self.image_codec_combo_box.currentText(),
+            'PNG_COMPRESS_LEVEL': self.png_compress_level_spin_box.value(),
+            'MAX_CONCURRENT_JOBS': self.max_concurrent_jobs_spin_box.value(),
+            'JOB_MAX_RETRIES': self.job_max_retries_spin_box.value(),
+            'USE_RESULT_CACHE': self.use_result_cache_check_box.isChecked(),
+            'RESULT_CACHE_SIZE': self.result_cache_size_spin_box.value(),
+            'SERVER_URLS': [
+                url.strip() for url in self.server_urls_plain_text_edit.toPlainText().splitlines()
+                if url.strip()
+            ],
+            'RESAMPLING_FILTER': self.resampling_filter_combo_box.currentText(),
+            'PASSWORD': self.password_line_edit.text()
+        })
         with open(SETTINGS_PATH, 'w') as f:
-            json.dump(
-                {
-                    'SERVER_URL': self.url_line_edit.text(),
-                    'USERNAME': self.username_line_edit.text(),
-                    'USE_TLS': self.use_tls_check_box.isChecked(),
-                    'PASSWORD': self.password_line_edit.text()
-                },
-                f
-            )
+            json.dump(settings, f)
 
         Settings.reload()
         ImageAIUtilsClient.refresh_credentials()
+        self._negotiate()
+        ResultCache.instance()  # picks up new size limit
+
+    def _negotiate(self):
+        # Dialogs and transport are set up from what server supports instead of failing requests.
+        # Handshake runs in background, unreachable servers would block GUI for their timeouts
+        if self._negotiation is not None:
+            self._negotiation.cancel()
+        self._negotiation = ProgressTask(
+            ImageAIUtilsClient.negotiate, {'clients': ImageAIUtilsClient.server_clients()}
+        )
+        self._negotiation.finished.connect(self._on_negotiated)
+        self._negotiation.start()
+
+    def _on_negotiated(self):
+        task: ProgressTask = self.sender()
+        if task is not self._negotiation:
+            return
+        self._negotiation = None
+        if task.success:
+            ImageAIUtilsClient.store_negotiated(task.result)
+            self.capabilities_changed.emit()
 
     def apply(self):
         self.save()
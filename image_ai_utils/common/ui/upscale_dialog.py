@@ -1,21 +1,19 @@
 import logging
 from enum import Enum
-from typing import Optional, List
+from typing import Optional, List, Tuple, Dict, Any
 
-import httpx
 from PyQt5 import uic
 from PyQt5.QtGui import QPixmap
-from PyQt5.QtWidgets import QDialog, QSpinBox, QLabel, QPushButton, QWidget, QCheckBox, \
+from PyQt5.QtWidgets import QSpinBox, QLabel, QPushButton, QWidget, QCheckBox, \
     QDoubleSpinBox, QComboBox, QPlainTextEdit
-from httpx import HTTPStatusError
 
 from PIL import Image
 from PIL.ImageQt import ImageQt
-from .exception_dialog import ExceptionDialog
-from .progress_bar_dialog import ProgressBarDialog
-from ..progress_thread import ProgressThread
+from .job_dialog import JobDialog
+from ..capabilities import ServerCapabilities, model_choices
+from ..job_queue import QUEUED_RESULT_CODE, Job, JobStatus
 from ..utils import get_ui_file_path
-from ..client import ImageAIUtilsClient, ESRGANModel
+from ..client import ESRGANModel
 
 ESRGAN_MODELS = [
     ESRGANModel.GENERAL_X4_V3,
@@ -28,10 +26,11 @@ ESRGAN_MODELS = [
 ]
 
 
-class UpscaleDialog(QDialog):
+class UpscaleDialog(JobDialog):
     target_width_spin_box: QSpinBox
     target_height_spin_box: QSpinBox
     image_label: QLabel
+    upscale_button: QPushButton
     apply_button: QPushButton
     use_realesrgan_check_box: QCheckBox
     use_realesrgan_label: QLabel
@@ -61,6 +60,12 @@ class UpscaleDialog(QDialog):
     seed_label: QLabel
     guidance_scale_double_spin_box: QDoubleSpinBox
     guidance_scale_label: QLabel
+    tiled_check_box: QCheckBox
+    tiled_label: QLabel
+    tile_size_spin_box: QSpinBox
+    tile_size_label: QLabel
+    tile_overlap_spin_box: QSpinBox
+    tile_overlap_label: QLabel
 
     class UpscalingMode(int, Enum):
         REAL_ESRGAN = 0
@@ -70,13 +75,22 @@ class UpscaleDialog(QDialog):
         super().__init__()
         uic.loadUi(get_ui_file_path('upscale_dialog.ui'), self)
 
+        # Names come from the .ui file, models that server doesn't have are hidden
+        self._esrgan_models = [
+            (self.esrgan_model_combo_box.itemText(i), model)
+            for i, model in enumerate(ESRGAN_MODELS)
+        ]
+        self._set_model_choices(self.esrgan_model_combo_box, self._esrgan_models)
+        self._max_resolution: Optional[int] = None
+
         self.use_random_seed_check_box.stateChanged.connect(
             lambda state: self.seed_spin_box.setEnabled(not state)
         )
-        self.progress_bar_dialog = ProgressBarDialog()
+        self._set_run_button(self.upscale_button)
         self._upscaling_mode = self.UpscalingMode.REAL_ESRGAN
         self._source_image: Optional[Image.Image] = None
         self._result_image: Optional[Image.Image] = None
+        self._queued_request: Optional[Tuple[str, Dict[str, Any]]] = None
         self._require_gobig: List[QWidget] = [
             self.use_realesrgan_check_box,
             self.use_realesrgan_label,
@@ -95,6 +109,15 @@ class UpscaleDialog(QDialog):
             self.guidance_scale_double_spin_box,
             self.guidance_scale_label
         ]
+        self._require_real_esrgan: List[QWidget] = [
+            self.tiled_check_box,
+            self.tiled_label,
+            self.tile_size_spin_box,
+            self.tile_size_label,
+            self.tile_overlap_spin_box,
+            self.tile_overlap_label
+        ]
+        self.tiled_check_box.toggled.connect(self._update_upscale_button)
 
         self.change_mode(self.upscale_mode_combo_box.currentIndex())
         self.toggle_lock_aspect_ratio(self.lock_aspect_ratio_check_box.isChecked())
@@ -108,6 +131,40 @@ class UpscaleDialog(QDialog):
             for widget in self._require_gobig:
                 widget.setVisible(True)
 
+        for widget in self._require_real_esrgan:
+            widget.setVisible(self._upscaling_mode == self.UpscalingMode.REAL_ESRGAN)
+        self._update_upscale_button()
+
+    def set_capabilities(self, capabilities: ServerCapabilities):
+        self._set_model_choices(
+            self.esrgan_model_combo_box,
+            model_choices(self._esrgan_models, capabilities.esrgan_models)
+        )
+        gobig_supported = capabilities.supports_endpoint('gobig')
+        self.upscale_mode_combo_box.model().item(self.UpscalingMode.GOBIG).setEnabled(
+            gobig_supported
+        )
+        if not gobig_supported:
+            self.upscale_mode_combo_box.setCurrentIndex(self.UpscalingMode.REAL_ESRGAN)
+        self._max_resolution = capabilities.max_resolution
+
+    def _update_upscale_button(self):
+        # Tiled result is written straight into layer, it's never loaded whole into the dialog
+        self.upscale_button.setEnabled(self.running or self.tile_params is None)
+
+    def _set_running(self, running: bool):
+        super()._set_running(running)
+        self._update_upscale_button()
+
+    @property
+    def tile_params(self) -> Optional[Tuple[int, int]]:
+        if (
+                self._upscaling_mode != self.UpscalingMode.REAL_ESRGAN or
+                not self.tiled_check_box.isChecked()
+        ):
+            return None
+        return self.tile_size_spin_box.value(), self.tile_overlap_spin_box.value()
+
     def update_target_width(self, width: int):
         if self.lock_aspect_ratio_check_box.isChecked():
             self.scale_spin_box.blockSignals(True)
@@ -176,6 +233,9 @@ class UpscaleDialog(QDialog):
         self.original_height_label.setText(str(source_height))
         self.target_width_spin_box.setValue(target_width)
         self.target_height_spin_box.setValue(target_height)
+        # Server would refuse to upscale the whole image at once
+        if self._max_resolution and max(target_width, target_height) > self._max_resolution:
+            self.tiled_check_box.setChecked(True)
 
         self._imageqt = ImageQt(self._source_image)
         pixmap = QPixmap.fromImage(self._imageqt)
@@ -183,59 +243,62 @@ class UpscaleDialog(QDialog):
 
         self.apply_button.setEnabled(False)
 
-    def upscale(self):
+    def _build_request(self) -> Tuple[str, Dict[str, Any]]:
         if self.upscale_mode_combo_box.currentIndex() == self.UpscalingMode.REAL_ESRGAN:
-            try:
-                self._result_image = ImageAIUtilsClient.client().upscale(
-                    source_image=self._source_image,
-                    target_width=self.target_width_spin_box.value(),
-                    target_height=self.target_height_spin_box.value(),
-                    esrgan_model=ESRGAN_MODELS[self.esrgan_model_combo_box.currentIndex()],
-                    maximize=self.maximize_check_box.isChecked()
-                )
-            except HTTPStatusError as e:
-                ExceptionDialog(f'{e.response.status_code}: {e.response.text}').exec()
-                return
-            except httpx.ConnectError:
-                ExceptionDialog(f'Could not connect to server').exec()
-                return
-
-        else:
-            request_data = {
-                'prompt': self.prompt_plain_text_edit.toPlainText(),
+            return 'upscale', {
                 'source_image': self._source_image,
                 'target_width': self.target_width_spin_box.value(),
                 'target_height': self.target_height_spin_box.value(),
-                'use_real_esrgan': self.use_realesrgan_check_box.isChecked(),
-                'esrgan_model': ESRGAN_MODELS[self.esrgan_model_combo_box.currentIndex()],
-                'maximize': self.maximize_check_box.isChecked(),
-                'overlap': self.gobig_overlap_spin_box.value(),
-                'strength': self.init_strength_double_spin_box.value(),
-                'num_inference_steps': self.inference_steps_spin_box.value(),
-                'guidance_scale': self.guidance_scale_double_spin_box.value(),
+                'esrgan_model': self.esrgan_model_combo_box.currentData(),
+                'maximize': self.maximize_check_box.isChecked()
             }
 
-            if not self.use_random_seed_check_box.isChecked():
-                request_data['seed'] = self.seed_spin_box.value()
+        request_data = {
+            'prompt': self.prompt_plain_text_edit.toPlainText(),
+            'source_image': self._source_image,
+            'target_width': self.target_width_spin_box.value(),
+            'target_height': self.target_height_spin_box.value(),
+            'use_real_esrgan': self.use_realesrgan_check_box.isChecked(),
+            'esrgan_model': self.esrgan_model_combo_box.currentData(),
+            'maximize': self.maximize_check_box.isChecked(),
+            'overlap': self.gobig_overlap_spin_box.value(),
+            'strength': self.init_strength_double_spin_box.value(),
+            'num_inference_steps': self.inference_steps_spin_box.value(),
+            'guidance_scale': self.guidance_scale_double_spin_box.value(),
+        }
 
-            thread = ProgressThread(ImageAIUtilsClient.client().gobig, request_data)
-            self.progress_bar_dialog.set_progress(0)
-            thread.progress_signal.connect(self.progress_bar_dialog.set_progress)
-            thread.finished.connect(self.progress_bar_dialog.accept)
-            thread.start()
-            self.progress_bar_dialog.exec()
-            thread.wait()
-            if not thread.success:
-                ExceptionDialog(thread.error_message).exec()
-                return
+        if not self.use_random_seed_check_box.isChecked():
+            request_data['seed'] = self.seed_spin_box.value()
 
-            self._result_image = thread.result
+        return 'gobig', request_data
 
+    def upscale(self):
+        if self.running:
+            self.cancel_job()
+            return
+
+        client_method, request_data = self._build_request()
+        self.apply_button.setEnabled(False)
+        self._submit_job('Upscale', client_method, request_data)
+
+    def _job_finished(self, job: Job):
+        if job.status != JobStatus.FINISHED:
+            return
+
+        self._result_image = job.result
         self._imageqt = ImageQt(self._result_image)
         pixmap = QPixmap.fromImage(self._imageqt)
         self.image_label.setPixmap(pixmap)
         self.apply_button.setEnabled(True)
 
+    def queue(self):
+        self._queued_request = self._build_request()
+        self.done(QUEUED_RESULT_CODE)
+
+    @property
+    def queued_request(self) -> Optional[Tuple[str, Dict[str, Any]]]:
+        return self._queued_request
+
     @property
     def result_image(self) -> Optional[Image.Image]:
         return self._result_image
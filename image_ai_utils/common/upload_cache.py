@@ -0,0 +1,72 @@
+import hashlib
+from collections import OrderedDict
+from typing import Union, Iterable
+
+from PIL import Image
+
+from .image_codecs import EncodedImage
+from .pixel_buffer import PixelBuffer
+
+BLOB_KEY = '$blob'
+# PIL images are hashed in strips, so hashing doesn't need a copy of the whole image
+DIGEST_STRIP_HEIGHT = 256
+# Modes that convert to RGBA exactly
+LOSSLESS_RGBA_MODES = {'1', 'L', 'LA', 'P', 'PA', 'RGB', 'RGBA', 'RGBX'}
+
+
+# Digest of pixels, not of encoded bytes, so unchanged image isn't even encoded again
+def image_digest(image: Union[Image.Image, PixelBuffer, EncodedImage]) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    if isinstance(image, EncodedImage):
+        # Decoding only to hash pixels would defeat the point of keeping it encoded
+        digest.update(f'{image.format} {image.width}x{image.height}\n'.encode())
+        digest.update(image.data)
+        return digest.hexdigest()
+
+    # Pixel buffers and PIL images of same pixels must hash alike, so 8 bit images are hashed as
+    # PixelBuffer's BGRA. Deeper modes can't be converted without losing precision and keep theirs
+    normalized = isinstance(image, PixelBuffer) or image.mode in LOSSLESS_RGBA_MODES
+    raw_mode = PixelBuffer.CHANNEL_ORDER if normalized else image.mode
+    digest.update(f'{raw_mode} {image.width}x{image.height}\n'.encode())
+    if isinstance(image, PixelBuffer):
+        digest.update(image.raw_bytes())
+    else:
+        for top in range(0, image.height, DIGEST_STRIP_HEIGHT):
+            bottom = min(image.height, top + DIGEST_STRIP_HEIGHT)
+            strip = image.crop((0, top, image.width, bottom))
+            if normalized:
+                strip = strip if strip.mode == 'RGBA' else strip.convert('RGBA')
+                digest.update(strip.tobytes('raw', PixelBuffer.CHANNEL_ORDER))
+            else:
+                digest.update(strip.tobytes())
+    return digest.hexdigest()
+
+
+# Digests of images server is expected to still have. Server evicts its blobs on its own, so this
+# is only a guess, misses are reported back and those images are sent inline instead
+class UploadCache:
+    def __init__(self, max_size: int = 64):
+        self._max_size = max_size
+        self._digests: 'OrderedDict[str, None]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._digests)
+
+    def touch(self, digest: str) -> bool:
+        if digest not in self._digests:
+            return False
+        self._digests.move_to_end(digest)
+        return True
+
+    def add(self, digest: str):
+        self._digests[digest] = None
+        self._digests.move_to_end(digest)
+        while len(self._digests) > self._max_size:
+            self._digests.popitem(last=False)
+
+    def discard(self, digests: Iterable[str]):
+        for digest in digests:
+            self._digests.pop(digest, None)
+
+    def clear(self):
+        self._digests.clear()
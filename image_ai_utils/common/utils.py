@@ -1,22 +1,167 @@
 import mimetypes
 import os
 from base64 import b64encode, b64decode
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
+from typing import Any, Dict, List, Tuple, Union, Optional, Callable
 
 from PIL import Image
 
+from .image_codecs import ImageEncoder, EncodedImage, IMAGE_TYPES, decode_image
+
+ATTACHMENT_KEY = '$attachment'
+DATA_URL_PREFIX = 'data:image/'
+DECODE_WORKERS = min(8, os.cpu_count() or 1)
+
+_decode_pool: Optional[ThreadPoolExecutor] = None
+
+
+# PIL releases GIL while decoding and resampling, so threads are enough to use all cores
+def decode_pool() -> ThreadPoolExecutor:
+    global _decode_pool
+    if _decode_pool is None:
+        _decode_pool = ThreadPoolExecutor(DECODE_WORKERS, thread_name_prefix='image_decode')
+    return _decode_pool
+
+
+def map_images(function: Callable[[Any], Any], items: List[Any]) -> List[Any]:
+    if DECODE_WORKERS == 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    return list(decode_pool().map(function, items))
+
 
 def get_ui_file_path(filename: str):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), 'ui', filename)
 
 
+def image_to_bytes(image: Image.Image, output_format: str = 'PNG') -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format=output_format)
+    return buffer.getvalue()
+
+
+def bytes_to_image(data: Union[bytes, memoryview]) -> Image.Image:
+    return decode_image(data)
+
+
 def image_to_base64url(image: Image.Image, output_format: str = 'PNG') -> bytes:
     data_string = f'data:{mimetypes.types_map[f".{output_format.lower()}"]};base64,'.encode()
     buffer = BytesIO()
     image.save(buffer, format=output_format)
-    return data_string + b64encode(buffer.getvalue())
+    return data_string + b64encode(buffer.getbuffer())
+
+
+def base64url_to_image(source: Union[bytes, str]) -> Image.Image:
+    if isinstance(source, str):
+        source = source.encode()
+    # memoryview slice avoids copying the whole payload before decoding
+    data = memoryview(source)[source.index(b',') + 1:]
+    return bytes_to_image(b64decode(data))
+
+
+def encoded_to_base64url(data: bytes, mime_type: str) -> bytes:
+    return f'data:{mime_type};base64,'.encode() + b64encode(data)
+
+
+def encode_request_images(
+        request_data: Dict[str, Any],
+        binary: bool = False,
+        encoder: Optional[ImageEncoder] = None,
+        mime_types: Optional[List[str]] = None
+) -> Tuple[Dict[str, Any], List[bytes]]:
+    # `mime_types` is filled with mime type of each attachment, for transports that label parts
+    attachments: List[bytes] = []
+    if encoder is None:
+        encoder = ImageEncoder()
+
+    def encode(value: Any) -> Any:
+        if isinstance(value, IMAGE_TYPES):
+            data, mime_type = encoder.encode(value)
+            if not binary:
+                return encoded_to_base64url(data, mime_type).decode()
+            attachments.append(data)
+            if mime_types is not None:
+                mime_types.append(mime_type)
+            return {ATTACHMENT_KEY: len(attachments) - 1}
+        if isinstance(value, list):
+            return [encode(item) for item in value]
+        return value
+
+    return {key: encode(value) for key, value in request_data.items()}, attachments
+
+
+class _PendingImage:
+    def __init__(self, index: int, data: Union[str, bytes, memoryview]):
+        self.index = index
+        self.data = data
+
+    def encoded(self) -> EncodedImage:
+        if isinstance(self.data, str):
+            source = self.data.encode()
+            return EncodedImage(b64decode(memoryview(source)[source.index(b',') + 1:]))
+        return EncodedImage(self.data)
+
+    def decode(self) -> Image.Image:
+        if isinstance(self.data, str):
+            image = base64url_to_image(self.data)
+        else:
+            image = bytes_to_image(self.data)
+        # Image.open is lazy, without this decoding would happen on first access in GUI thread
+        image.load()
+        return image
+
+
+def decode_response_images(
+        value: Any,
+        attachments: List[Union[bytes, memoryview]],
+        on_decoded: Optional[Callable[[int, Image.Image], None]] = None,
+        lazy: bool = False
+) -> Any:
+    encoded_images: List[_PendingImage] = []
+
+    def collect(value: Any) -> Any:
+        if isinstance(value, str) and value.startswith(DATA_URL_PREFIX):
+            encoded_images.append(_PendingImage(len(encoded_images), value))
+            return encoded_images[-1]
+        if isinstance(value, dict):
+            if ATTACHMENT_KEY in value:
+                encoded_images.append(
+                    _PendingImage(len(encoded_images), attachments[value[ATTACHMENT_KEY]])
+                )
+                return encoded_images[-1]
+            return {key: collect(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [collect(item) for item in value]
+        return value
+
+    value = collect(value)
+    if lazy:
+        # Only headers are parsed, pixels are decoded by whoever needs them
+        images = [encoded_image.encoded() for encoded_image in encoded_images]
+    elif DECODE_WORKERS == 1 or len(encoded_images) <= 1:
+        images = []
+        for encoded_image in encoded_images:
+            images.append(encoded_image.decode())
+            if on_decoded is not None:
+                on_decoded(encoded_image.index, images[-1])
+    else:
+        futures = {
+            decode_pool().submit(encoded_image.decode): encoded_image.index
+            for encoded_image in encoded_images
+        }
+        images = [None] * len(encoded_images)
+        for future in as_completed(futures):
+            images[futures[future]] = future.result()
+            if on_decoded is not None:
+                on_decoded(futures[future], images[futures[future]])
 
+    def fill(value: Any) -> Any:
+        if isinstance(value, _PendingImage):
+            return images[value.index]
+        if isinstance(value, dict):
+            return {key: fill(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [fill(item) for item in value]
+        return value
 
-def base64url_to_image(source: bytes) -> Image.Image:
-    _, data = source.split(b',')
-    return Image.open(BytesIO(b64decode(data)))
+    return fill(value)
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import time
+import uuid
+from contextlib import suppress
+from enum import Enum
+from json import JSONDecodeError
+from typing import Optional, Callable, Any, Dict, Tuple, List, Union
+
+import websockets
+from websockets.exceptions import ConnectionClosed, \
+    WebSocketException as WebSocketProtocolException
+
+from .exceptions import WebSocketException, ConnectionLostException, ConnectionFailedException
+from .image_codecs import ThroughputMeter
+
+UpdateCallback = Callable[[Dict[str, Any], List[memoryview]], None]
+
+
+class _PendingRequest:
+    def __init__(self, update_callback: Optional[UpdateCallback]):
+        self.update_callback = update_callback
+        self.future = asyncio.get_running_loop().create_future()
+        self.attachments: List[memoryview] = []
+
+    def finish(self, response: Optional[Dict[str, Any]] = None, error: Optional[Exception] = None):
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(response)
+
+
+# Long-lived authenticated connection, every frame carries `request_id` so many requests can
+# share one socket instead of doing handshake and authentication for each of them.
+# Binary frames are prefixed with the request id they belong to
+class WebSocketSession:
+    class ResponseStatus(str, Enum):
+        FINISHED = 'finished'
+        ERROR = 'error'
+
+    SESSION_ENDPOINT = 'session'
+    REQUEST_ID_LENGTH = 32
+
+    # Has to be created inside the event loop, asyncio primitives bind to it on python < 3.10
+    def __init__(
+            self,
+            base_websocket_url: str,
+            auth: Tuple[str, str],
+            connect_timeout: float = 10,
+            throughput_meter: Optional[ThroughputMeter] = None
+    ):
+        self._url = base_websocket_url + self.SESSION_ENDPOINT
+        self._auth = auth
+        self._connect_timeout = connect_timeout
+        self._throughput_meter = throughput_meter
+        self._websocket = None
+        self._reader: Optional[asyncio.Task] = None
+        self._connect_lock = asyncio.Lock()
+        self._send_lock = asyncio.Lock()
+        self._pending: Dict[str, _PendingRequest] = {}
+
+    @property
+    def connected(self) -> bool:
+        return self._websocket is not None
+
+    async def _connect(self):
+        # Single attempt, unreachable server is reported right away so job queue can fail over
+        try:
+            websocket = await websockets.connect(
+                self._url, max_size=None, open_timeout=self._connect_timeout
+            )
+            await websocket.send(
+                json.dumps({'username': self._auth[0], 'password': self._auth[1]})
+            )
+            return websocket
+        except (OSError, asyncio.TimeoutError, WebSocketProtocolException) as e:
+            raise ConnectionFailedException(f'Couldn\'t connect to server: {e}')
+
+    async def _ensure_connected(self):
+        async with self._connect_lock:
+            if self._websocket is not None:
+                return self._websocket
+
+            self._websocket = await self._connect()
+            self._reader = asyncio.ensure_future(self._read_loop(self._websocket))
+            return self._websocket
+
+    async def _read_loop(self, websocket):
+        error: Exception = ConnectionLostException(
+            'Connection to server closed unexpectedly. See server logs for details'
+        )
+        try:
+            async for message in websocket:
+                self._dispatch(message)
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            # Without reader nothing would ever answer requests sent over this socket
+            error = ConnectionLostException(f'Session reader failed: {e}')
+        finally:
+            if self._websocket is websocket:
+                self._websocket = None
+            self._fail_pending(error)
+            await websocket.close()
+
+    def _dispatch(self, message: Union[str, bytes]):
+        if isinstance(message, bytes):
+            request_id = message[:self.REQUEST_ID_LENGTH].decode(errors='replace')
+            pending = self._pending.get(request_id)
+            if pending is not None:
+                pending.attachments.append(memoryview(message)[self.REQUEST_ID_LENGTH:])
+            return
+
+        try:
+            response = json.loads(message)
+        except JSONDecodeError:
+            return
+        if not isinstance(response, dict):
+            return
+
+        request_id = response.get('request_id')
+        pending = self._pending.get(request_id)
+        if pending is None:
+            return
+
+        status = response.get('status')
+        if status == self.ResponseStatus.FINISHED:
+            self._pending.pop(request_id, None)
+            pending.finish(response=response)
+        elif status == self.ResponseStatus.ERROR:
+            self._pending.pop(request_id, None)
+            pending.finish(error=WebSocketException(response.get('message', message)))
+        elif status is None:
+            self._pending.pop(request_id, None)
+            pending.finish(error=WebSocketException(f'Wrong response format:\n{message}'))
+        elif pending.update_callback is not None:
+            # Broken update only fails its own request, others keep sharing the socket
+            try:
+                pending.update_callback(response, pending.attachments)
+            except Exception as e:
+                self._pending.pop(request_id, None)
+                pending.finish(error=WebSocketException(f'Couldn\'t handle update: {e}\n{message}'))
+
+    def _fail_pending(self, error: Exception):
+        pending, self._pending = self._pending, {}
+        for request in pending.values():
+            request.finish(error=error)
+
+    async def request(
+            self,
+            request: str,
+            request_data: Dict[str, Any],
+            attachments: Optional[List[bytes]] = None,
+            update_callback: Optional[UpdateCallback] = None
+    ) -> Tuple[Dict[str, Any], List[memoryview]]:
+        websocket = await self._ensure_connected()
+        request_id = uuid.uuid4().hex
+        pending = _PendingRequest(update_callback)
+        self._pending[request_id] = pending
+
+        frame = json.dumps({'request_id': request_id, 'request': request, 'data': request_data})
+        attachments = attachments or []
+        try:
+            async with self._send_lock:
+                start = time.perf_counter()
+                await websocket.send(frame)
+                prefix = request_id.encode()
+                for attachment in attachments:
+                    # Sent as two fragments of one message, prepending would copy whole image
+                    await websocket.send([prefix, attachment])
+                if self._throughput_meter is not None:
+                    self._throughput_meter.record(
+                        len(frame) + sum(map(len, attachments)), time.perf_counter() - start
+                    )
+
+            response = await pending.future
+            return response, pending.attachments
+        except ConnectionClosed:
+            raise ConnectionLostException('Connection to server closed unexpectedly')
+        except asyncio.CancelledError:
+            with suppress(ConnectionClosed):
+                await websocket.send(json.dumps({'request_id': request_id, 'action': 'cancel'}))
+            raise
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def close(self):
+        async with self._connect_lock:
+            websocket, self._websocket = self._websocket, None
+        if websocket is not None:
+            await websocket.close()
@@ -1,17 +1,29 @@
+import asyncio
 from enum import Enum
-from typing import Optional, Tuple
+from functools import partial
+from typing import Optional, Tuple, List, Any, Dict, Callable, Union, NamedTuple
 
 from PyQt5 import uic
-from PyQt5.QtWidgets import QMessageBox
+from PyQt5.QtWidgets import QMessageBox, QDialog
 
 from PIL import Image, ImageOps
 from krita import Extension, DockWidget, Krita, Document, Node
+from .common.client import ImageAIUtilsClient
+from .common.exceptions import UnsupportedPixelFormatException
+from .common.image_codecs import EncodedImage
+from .common.job_queue import JobQueue, Job, JobBatch, QUEUED_RESULT_CODE
+from .common.pixel_buffer import PixelBuffer, image_to_pixel_data
+from .common.pixel_format import PixelFormat, RGBA_U8
+from .common.progress_task import ProgressTask
+from .common.resampling import ResamplingFilter
 from .common.settings import Settings
-from .common.ui.diffusion_dialog import DiffusionMode, DiffusionDialog
+from .common.tiling import TilePlan, TileBlender, Tile, Box, mask_crop_box, tile_digests
+from .common.ui.diffusion_dialog import DiffusionMode, DiffusionDialog, DIFFUSION_MODE_NAMES
 from .common.ui.face_restoration_dialog import FaceRestorationDialog
+from .common.ui.job_queue_widget import JobQueueWidget
 from .common.ui.settings_dialog import SettingsDialog
 from .common.ui.upscale_dialog import UpscaleDialog
-from .common.utils import get_ui_file_path
+from .common.utils import get_ui_file_path, map_images
 
 
 class LayerType(str, Enum):
@@ -33,6 +45,77 @@ class NotEnoughInfoException(Exception):
     pass
 
 
+class LayerTarget(NamedTuple):
+    document: Document
+    selection: Tuple[int, int, int, int]
+    layer: Node
+
+
+# Last img2img on a layer: digests of its source tiles and ids of layers results went to. Next run
+# can regenerate only tiles repainted since and update one of those layers in place
+class IncrementalSource(NamedTuple):
+    plan: TilePlan
+    digests: List[str]
+    result_ids: List[Any]  # QUuid
+
+
+async def _hash_tiles(
+        image: Image.Image, plan: TilePlan, progress_callback: Optional[Callable] = None
+) -> List[str]:
+    return await asyncio.get_running_loop().run_in_executor(
+        None, tile_digests, image, plan, progress_callback
+    )
+
+
+# Hashing every tile of a large selection would freeze GUI, so img2img source is only hashed in
+# background and only when incremental run or its bookkeeping needs it
+class LazyTileDigests:
+    def __init__(self, image: Image.Image, plan: TilePlan):
+        self._image = image
+        self._plan = plan
+        self._task: Optional[ProgressTask] = None
+        self._callbacks: List[Callable[[List[str]], None]] = []
+        self.digests: Optional[List[str]] = None
+
+    def get(
+            self,
+            callback: Callable[[List[str]], None],
+            progress_callback: Optional[Callable[[float], None]] = None
+    ):
+        if self.digests is not None:
+            callback(self.digests)
+            return
+        self._callbacks.append(callback)
+        if self._task is None:
+            self._task = ProgressTask(_hash_tiles, {'image': self._image, 'plan': self._plan})
+            self._task.finished.connect(self._on_finished)
+            self._task.start()
+        if progress_callback is not None:
+            self._task.progress_signal.connect(progress_callback)
+
+    def _on_finished(self):
+        callbacks, self._callbacks = self._callbacks, []
+        if not self._task.success:
+            self._task = None
+            return
+        self.digests = self._task.result
+        for callback in callbacks:
+            callback(self.digests)
+
+
+def _to_pixel_data(
+        image: Union[Image.Image, EncodedImage],
+        size: Optional[Tuple[int, int]] = None,
+        pixel_format: PixelFormat = RGBA_U8
+) -> bytes:
+    resampling_filter = Settings.settings().RESAMPLING_FILTER if Settings.settings() is not None \
+        else ResamplingFilter.AUTO
+    # Queued results stay encoded until they are inserted, raw ones are never decoded by PIL
+    if isinstance(image, EncodedImage):
+        return image.to_pixel_data(size, pixel_format, resampling_filter)
+    return image_to_pixel_data(image, size, pixel_format, resampling_filter)
+
+
 class DiffusionToolsDockWidget(DockWidget):
     def __init__(self):
         super().__init__()
@@ -53,20 +136,87 @@ class DiffusionToolsDockWidget(DockWidget):
             self.main_widget.inpaint_button,
         ]
 
-        for widget in self._depend_on_settings:
-            widget.setEnabled(Settings.settings() is not None)
+        # Buttons of features server doesn't have are disabled after handshake
+        self._required_endpoints = {
+            self.main_widget.text_to_image_button: ('text_to_image',),
+            self.main_widget.image_to_image_button: ('image_to_image',),
+            self.main_widget.inpaint_button: ('inpainting',),
+            self.main_widget.upscale_button: ('upscale', 'gobig'),
+            self.main_widget.face_restoration_button: ('restore_face',),
+            self.main_widget.make_tilable_button: ('make_tilable',),
+        }
+
+        self.job_queue_widget = JobQueueWidget()
+        self.main_widget.job_queue_layout.addWidget(self.job_queue_widget)
+        # Running requests would otherwise keep server busy after Krita is closed
+        notifier = Krita.instance().notifier()
+        notifier.setActive(True)
+        notifier.applicationClosing.connect(JobQueue.instance().cancel_all)
 
         self.setWidget(self.main_widget)
 
         self.upscale_dialog = UpscaleDialog()
         self.diffusion_dialog = DiffusionDialog()
         self.settings_dialog = SettingsDialog()
+        self.settings_dialog.capabilities_changed.connect(self._update_capabilities)
         self.face_restoration_dialog = FaceRestorationDialog()
 
-    def insert_layers_from_diffusion(self, below: bool = False):
-        current_document = Krita.instance().activeDocument()
-        x, y, width, height = self._get_document_selection(current_document)
-        current_node = current_document.activeNode()
+        self._dialog_handlers: Dict[QDialog, Callable[[int], None]] = {}
+        self._incremental_sources: Dict[Tuple, IncrementalSource] = {}
+        # Source of img2img dialog while it's open, with the result it would update in place
+        self._dialog_digests: Optional[Tuple[LazyTileDigests, IncrementalSource]] = None
+        self.diffusion_dialog.incremental_requested.connect(self._count_changed_tiles)
+        for dialog in (self.upscale_dialog, self.diffusion_dialog, self.face_restoration_dialog):
+            dialog.finished.connect(
+                lambda result, dialog=dialog: self._on_dialog_finished(dialog, result)
+            )
+        self._update_capabilities()
+
+    def _update_capabilities(self):
+        capabilities = ImageAIUtilsClient.cached_capabilities()
+        for widget, endpoints in self._required_endpoints.items():
+            widget.setEnabled(
+                (widget not in self._depend_on_settings or Settings.settings() is not None)
+                and any(capabilities.supports_endpoint(endpoint) for endpoint in endpoints)
+            )
+        self.upscale_dialog.set_capabilities(capabilities)
+        self.face_restoration_dialog.set_capabilities(capabilities)
+        self.diffusion_dialog.set_capabilities(capabilities)
+
+    def _show_dialog(self, dialog: QDialog, on_finished: Callable[[int], None]):
+        # Dialogs are modeless so artist can keep painting, result is handled once dialog closes
+        self._dialog_handlers[dialog] = on_finished
+        dialog.show()
+
+    @staticmethod
+    def _raise_dialog(dialog: QDialog) -> bool:
+        if not dialog.isVisible():
+            return False
+        dialog.raise_()
+        dialog.activateWindow()
+        return True
+
+    def _on_dialog_finished(self, dialog: QDialog, result: int):
+        on_finished = self._dialog_handlers.pop(dialog, None)
+        if on_finished is None:
+            return
+        try:
+            on_finished(result)
+        except UnsupportedPixelFormatException as e:
+            self._show_unsupported_pixel_format(e)
+
+    def _show_unsupported_pixel_format(self, exception: UnsupportedPixelFormatException):
+        QMessageBox.warning(self, 'Unsupported layer', exception.message)
+
+    def _insert_diffusion_layers(
+            self,
+            document: Document,
+            selection: Tuple[int, int, int, int],
+            current_node: Node,
+            images: List[Union[Image.Image, EncodedImage]],
+            below: bool = False
+    ) -> List[Node]:
+        x, y, width, height = selection
         parent = current_node.parentNode()
 
         if below:
@@ -77,13 +227,393 @@ class DiffusionToolsDockWidget(DockWidget):
             else:
                 current_node = None
 
-        for i, image in enumerate(self.diffusion_dialog.result_images):
-            new_node = current_document.createNode(f'diffusion {i}', LayerType.PAINT_LAYER)
-            pixel_bytes = image.convert('RGBA').resize((width, height)).tobytes('raw', 'BGRA')
+        new_nodes = [
+            document.createNode(f'diffusion {i}', LayerType.PAINT_LAYER)
+            for i in range(len(images))
+        ]
+        pixel_formats = [PixelFormat.from_node(new_node) for new_node in new_nodes]
+        # Only conversion runs in the pool, nodes are touched from GUI thread
+        all_pixel_bytes = map_images(
+            lambda item: _to_pixel_data(item[0], (width, height), item[1]),
+            list(zip(images, pixel_formats))
+        )
+        for new_node, pixel_bytes in zip(new_nodes, all_pixel_bytes):
             new_node.setPixelData(pixel_bytes, x, y, width, height)
             parent.addChildNode(new_node, current_node)
 
-        current_document.refreshProjection()
+        document.refreshProjection()
+        return new_nodes
+
+    def _insert_processed_layer(
+            self,
+            document: Document,
+            selection: Tuple[int, int, int, int],
+            layer: Node,
+            image: Union[Image.Image, EncodedImage],
+            suffix: str
+    ):
+        x, y, width, height = selection
+        if document.selection() is None:
+            document.setWidth(image.width)
+            document.setHeight(image.height)
+            width, height = image.size
+
+        # With selection result is fitted into it instead of spilling over the rest of the layer
+        parent = layer.parentNode()
+        new_node = document.createNode(f'{layer.name()} {suffix}', 'paintLayer')
+        pixel_bytes = _to_pixel_data(image, (width, height), PixelFormat.from_node(new_node))
+        new_node.setPixelData(pixel_bytes, x, y, width, height)
+        parent.addChildNode(new_node, layer)
+
+    @staticmethod
+    def _document_is_open(document: Document) -> bool:
+        return any(document == open_document for open_document in Krita.instance().documents())
+
+    def _make_job(
+            self,
+            name: str,
+            document: Document,
+            queued_request: Tuple[str, Dict[str, Any]],
+            insert_result: Callable[[Any], None]
+    ) -> Job:
+        # Result is inserted into the document request was made from, even if it isn't active
+        def on_result(result: Any):
+            if not self._document_is_open(document):
+                raise NotEnoughInfoException('Document was closed')
+            insert_result(result)
+
+        client_method, request_data = queued_request
+        return Job(name, client_method, request_data, on_result)
+
+    def _queue_job(
+            self,
+            name: str,
+            document: Document,
+            queued_request: Tuple[str, Dict[str, Any]],
+            insert_result: Callable[[Any], None]
+    ):
+        JobQueue.instance().submit(self._make_job(name, document, queued_request, insert_result))
+
+    def _queue_batch(
+            self,
+            name: str,
+            targets: List[LayerTarget],
+            make_request: Callable[[LayerTarget], Tuple[str, Dict[str, Any]]],
+            insert_result: Callable[[LayerTarget, Any], None]
+    ):
+        # Request, with pixels of the layer, is only made when batch has room for it
+        def make_job(target: LayerTarget) -> Optional[Job]:
+            if not self._document_is_open(target.document):
+                return None
+            try:
+                queued_request = make_request(target)
+            except UnsupportedPixelFormatException:
+                return None
+            return self._make_job(
+                f'{name} {target.layer.name()}',
+                target.document,
+                queued_request,
+                partial(insert_result, target)
+            )
+
+        if len(targets) == 1:
+            job = make_job(targets[0])
+            if job is not None:
+                JobQueue.instance().submit(job)
+            return
+
+        JobQueue.instance().submit_batch(JobBatch(
+            f'{name} batch',
+            [partial(make_job, target) for target in targets],
+            Settings.settings().BATCH_WINDOW
+        ))
+
+    def _queue_diffusion(
+            self,
+            name: str,
+            document: Document,
+            selection: Tuple[int, int, int, int],
+            current_node: Node,
+            below: bool = False,
+            on_inserted: Optional[Callable[[List[Node]], None]] = None
+    ):
+        client_method, request_data = self.diffusion_dialog.queued_request
+
+        def insert_result(result: Any):
+            # make_tilable also returns mask
+            images = result[0] if client_method == 'make_tilable' else result
+            nodes = self._insert_diffusion_layers(document, selection, current_node, images, below)
+            if on_inserted is not None:
+                on_inserted(nodes)
+
+        self._queue_job(
+            name, document, (client_method, {**request_data, 'lazy_images': True}), insert_result
+        )
+
+    def _queue_diffusion_batch(self, name: str, targets: List[LayerTarget]):
+        client_method, request_data = self.diffusion_dialog.queued_request
+
+        def make_request(target: LayerTarget) -> Tuple[str, Dict[str, Any]]:
+            _, _, width, height = target.selection
+            # Selections of other documents can have different size
+            plan = self.diffusion_dialog.render_plan_for(width, height)
+            source_image = PixelBuffer.from_node(target.layer, *target.selection).to_image()
+            layer_request_data = dict(request_data)
+            layer_request_data['source_image'] = plan.fit_source(source_image)
+            layer_request_data['render_size'] = (plan.width, plan.height)
+            layer_request_data['lazy_images'] = True
+            return client_method, layer_request_data
+
+        def insert_result(target: LayerTarget, result: List[EncodedImage]):
+            self._insert_diffusion_layers(target.document, target.selection, target.layer, result)
+
+        self._queue_batch(name, targets, make_request, insert_result)
+
+    def _show_diffusion_dialog(
+            self,
+            mode: DiffusionMode,
+            document: Document,
+            selection: Tuple[int, int, int, int],
+            current_node: Node,
+            below: bool = False,
+            on_inserted: Optional[Callable[[List[Node]], None]] = None,
+            queue_incremental: Optional[Callable[[], None]] = None,
+            targets: Optional[List[LayerTarget]] = None
+    ):
+        def on_finished(result: int):
+            if result == QUEUED_RESULT_CODE:
+                if queue_incremental is not None and self.diffusion_dialog.incremental:
+                    queue_incremental()
+                    return
+                if targets is not None and len(targets) > 1:
+                    self._queue_diffusion_batch(DIFFUSION_MODE_NAMES[mode], targets)
+                    return
+                self._queue_diffusion(
+                    DIFFUSION_MODE_NAMES[mode],
+                    document,
+                    selection,
+                    current_node,
+                    below,
+                    on_inserted
+                )
+            elif result and self._document_is_open(document):
+                nodes = self._insert_diffusion_layers(
+                    document, selection, current_node, self.diffusion_dialog.result_images, below
+                )
+                if on_inserted is not None:
+                    on_inserted(nodes)
+
+        self.diffusion_dialog.set_mode(mode)
+        self._show_dialog(self.diffusion_dialog, on_finished)
+
+    def _show_processing_dialog(
+            self,
+            dialog: QDialog,
+            name: str,
+            document: Document,
+            selection: Tuple[int, int, int, int],
+            current_layer: Node,
+            suffix: str
+    ):
+        targets = self._batch_targets(document, selection, current_layer)
+
+        def on_finished(result: int):
+            if result == QUEUED_RESULT_CODE:
+                if dialog is self.upscale_dialog and self.upscale_dialog.tile_params is not None:
+                    # Tiles are written straight into the document, only current one is tiled
+                    self._queue_tiled_upscale(
+                        document,
+                        selection,
+                        [target.layer for target in targets if target.document == document],
+                        dialog.queued_request[1],
+                        *self.upscale_dialog.tile_params
+                    )
+                    return
+                self._queue_for_layers(name, selection, targets, dialog.queued_request, suffix)
+            elif result and self._document_is_open(document):
+                self._insert_processed_layer(
+                    document, selection, current_layer, dialog.result_image, suffix
+                )
+
+        self._show_dialog(dialog, on_finished)
+
+    @classmethod
+    def _paint_layers(cls, nodes: List[Node]) -> List[Node]:
+        # Group stands for every paint layer inside it
+        layers = []
+        for node in nodes:
+            if node.type() == LayerType.PAINT_LAYER:
+                layers.append(node)
+            elif node.type() == LayerType.GROUP_LAYER:
+                layers.extend(cls._paint_layers(node.childNodes()))
+        return layers
+
+    def _selected_paint_layers(self, current_layer: Node) -> List[Node]:
+        # There is no active window while Krita starts up or shuts down
+        window = Krita.instance().activeWindow()
+        view = window.activeView() if window is not None else None
+        layers = self._paint_layers(view.selectedNodes()) if view is not None else []
+        # Layer can be selected together with its group
+        unique_layers = {layer.uniqueId().toString(): layer for layer in layers}
+        return list(unique_layers.values()) or [current_layer]
+
+    def _batch_targets(
+            self, document: Document, selection: Tuple[int, int, int, int], current_layer: Node
+    ) -> List[LayerTarget]:
+        if not self.main_widget.all_documents_check_box.isChecked():
+            return [
+                LayerTarget(document, selection, layer)
+                for layer in self._selected_paint_layers(current_layer)
+            ]
+
+        return [
+            LayerTarget(open_document, self._get_document_selection(open_document), layer)
+            for open_document in Krita.instance().documents()
+            for layer in self._paint_layers(open_document.rootNode().childNodes())
+        ]
+
+    def _queue_for_layers(
+            self,
+            name: str,
+            selection: Tuple[int, int, int, int],
+            targets: List[LayerTarget],
+            queued_request: Tuple[str, Dict[str, Any]],
+            suffix: str
+    ):
+        client_method, request_data = queued_request
+        _, _, width, height = selection
+
+        def make_request(target: LayerTarget) -> Tuple[str, Dict[str, Any]]:
+            layer_request_data = dict(request_data)
+            layer_request_data['source_image'] = PixelBuffer.from_node(
+                target.layer, *target.selection
+            )
+            layer_request_data['lazy_images'] = True
+            if 'target_width' in request_data:
+                # Every layer is scaled by the same factor, other documents can differ in size
+                _, _, target_width, target_height = target.selection
+                layer_request_data['target_width'] = round(
+                    target_width * request_data['target_width'] / width
+                )
+                layer_request_data['target_height'] = round(
+                    target_height * request_data['target_height'] / height
+                )
+            return client_method, layer_request_data
+
+        def insert_result(target: LayerTarget, result: EncodedImage):
+            self._insert_processed_layer(
+                target.document, target.selection, target.layer, result, suffix
+            )
+
+        self._queue_batch(name, targets, make_request, insert_result)
+
+    @staticmethod
+    def _tile_io(
+            document: Document, node: Node, x: int, y: int
+    ) -> Tuple[Callable[[Box], Image.Image], Callable[[Box, Image.Image], None]]:
+        # Boxes are relative to (x, y) of the node
+        pixel_format = PixelFormat.from_node(node)
+
+        def read(box: Box) -> Image.Image:
+            left, top, right, bottom = box
+            return PixelBuffer.from_node(
+                node, x + left, y + top, right - left, bottom - top
+            ).to_image()
+
+        def write(box: Box, image: Image.Image):
+            left, top, right, bottom = box
+            pixel_bytes = image_to_pixel_data(image, pixel_format=pixel_format)
+            node.setPixelData(pixel_bytes, x + left, y + top, right - left, bottom - top)
+            document.refreshProjection()
+
+        return read, write
+
+    def _queue_tiled_upscale(
+            self,
+            document: Document,
+            selection: Tuple[int, int, int, int],
+            layers: List[Node],
+            request_data: Dict[str, Any],
+            tile_size: int,
+            overlap: int
+    ):
+        x, y, width, height = selection
+        target_width, target_height = request_data['target_width'], request_data['target_height']
+        if document.selection() is None:
+            document.setWidth(target_width)
+            document.setHeight(target_height)
+            width_in_layer, height_in_layer = target_width, target_height
+        else:
+            # Same as _insert_processed_layer, tiles are upscaled at target scale and fitted into
+            # selection while blending
+            width_in_layer, height_in_layer = width, height
+
+        plan = TilePlan(width, height, width_in_layer, height_in_layer, tile_size, overlap)
+        target_plan = TilePlan(width, height, target_width, target_height, tile_size, overlap)
+        for layer in layers:
+            source_pixels = PixelBuffer.from_node(layer, *selection)
+            # Tiles are written into the new layer as they arrive, whole result never exists
+            node = document.createNode(f'{layer.name()} upscaled', 'paintLayer')
+            layer.parentNode().addChildNode(node, layer)
+            blender = TileBlender(plan, *self._tile_io(document, node, x, y))
+            for tile in plan.tiles:
+                tile_request_data = dict(request_data)
+                left, top, right, bottom = target_plan.scale_box(tile.context)
+                tile_request_data['source_image'] = source_pixels.crop(tile.context)
+                tile_request_data['target_width'] = right - left
+                tile_request_data['target_height'] = bottom - top
+
+                def insert_result(result: Image.Image, tile: Tile = tile, blender=blender):
+                    blender.add(tile, result)
+
+                self._queue_job(
+                    f'Upscale {layer.name()} {tile.index + 1}/{len(plan.tiles)}',
+                    document,
+                    ('upscale', tile_request_data),
+                    insert_result
+                )
+
+    def _queue_incremental_diffusion(
+            self,
+            document: Document,
+            selection: Tuple[int, int, int, int],
+            source_image: Image.Image,
+            source: IncrementalSource,
+            digests: List[str],
+            node: Node,
+            queued_request: Tuple[str, Dict[str, Any]]
+    ):
+        x, y, _, _ = selection
+        plan = source.plan
+        changed = [tile for tile in plan.tiles if digests[tile.index] != source.digests[tile.index]]
+        # Unchanged tiles of previous result stay as they are, regenerated ones are blended in
+        blender = TileBlender(
+            plan,
+            *self._tile_io(document, node, x, y),
+            written=[(tile.column, tile.row) for tile in plan.tiles if tile not in changed]
+        )
+        client_method, request_data = queued_request
+        for tile in changed:
+            left, top, right, bottom = tile.context
+            # Request was planned for the whole selection, each tile gets its own plan
+            render_plan = self.diffusion_dialog.render_plan_for(right - left, bottom - top)
+            tile_request_data = dict(request_data)
+            tile_request_data['source_image'] = render_plan.fit_source(
+                source_image.crop(tile.context)
+            )
+            tile_request_data['render_size'] = (render_plan.width, render_plan.height)
+            tile_request_data['num_variants'] = 1
+
+            def insert_result(result: List[Image.Image], tile: Tile = tile):
+                blender.add(tile, result[0])
+                source.digests[tile.index] = digests[tile.index]
+
+            self._queue_job(
+                f'Img2Img {node.name()} {tile.index + 1}/{len(source.plan.tiles)}',
+                document,
+                (client_method, tile_request_data),
+                insert_result
+            )
 
     def _get_document_selection(self, document: Document) -> Tuple[int, int, int, int]:
         selection = document.selection()
@@ -93,8 +623,8 @@ class DiffusionToolsDockWidget(DockWidget):
             return 0, 0, document.width(), document.height()
 
     def _get_current_info(
-            self, check_layer_type: bool = True
-    ) -> Tuple[Document, Tuple[int, int, int, int], Node, Image.Image]:
+            self, check_layer_type: bool = True, read_image: bool = True
+    ) -> Tuple[Document, Tuple[int, int, int, int], Node, Optional[Image.Image]]:
         current_document = Krita.instance().activeDocument()
         if not current_document:
             raise NotEnoughInfoException
@@ -103,57 +633,122 @@ class DiffusionToolsDockWidget(DockWidget):
         current_layer = current_document.activeNode()
         if check_layer_type and current_layer.type() != LayerType.PAINT_LAYER:
             raise NotEnoughInfoException
+        if not read_image:
+            return current_document, selection, current_layer, None
 
-        image = self._image_from_layer(current_layer, *selection)
+        try:
+            image = self._image_from_layer(current_layer, *selection)
+        except UnsupportedPixelFormatException as e:
+            self._show_unsupported_pixel_format(e)
+            raise NotEnoughInfoException
         return current_document, selection, current_layer, image
 
     def text_to_image(self):
         current_document = Krita.instance().activeDocument()
-        if not current_document:
+        if not current_document or self._raise_dialog(self.diffusion_dialog):
             return
 
-        _, _, width, height = self._get_document_selection(current_document)
+        selection = self._get_document_selection(current_document)
+        _, _, width, height = selection
         self.diffusion_dialog.set_target_size(width, height)
-
-        self.diffusion_dialog.set_mode(DiffusionMode.TEXT_TO_IMAGE)
-        if not self.diffusion_dialog.exec():
-            return
-
-        self.insert_layers_from_diffusion()
+        self._show_diffusion_dialog(
+            DiffusionMode.TEXT_TO_IMAGE, current_document, selection, current_document.activeNode()
+        )
 
     def _image_from_layer(
             self, layer: Node, x: int, y: int, width: int, height: int
     ) -> Optional[Image.Image]:
-        pixel_bytes = layer.pixelData(x, y, width, height)  # BGRA pixels
-        # TODO support other formats than rgba
         if layer.type() == LayerType.PAINT_LAYER:
-            return Image.frombytes('RGBA', (width, height), pixel_bytes, 'raw', 'BGRA')
+            return PixelBuffer.from_node(layer, x, y, width, height).to_image()
         if layer.type() == LayerType.TRANSPARENCY_MASK:
-            return Image.frombytes('L', (width, height), pixel_bytes, 'raw')
+            pixel_bytes = layer.pixelData(x, y, width, height)
+            return Image.frombuffer('L', (width, height), pixel_bytes, 'raw', 'L', 0, 1)
         return None
 
+    def _count_changed_tiles(self):
+        dialog_digests = self._dialog_digests
+        if dialog_digests is None:
+            return
+        digests, source = dialog_digests
+
+        def show_changed(new_digests: List[str]):
+            # Dialog could have been opened for another selection in the meantime
+            if self._dialog_digests is dialog_digests:
+                self.diffusion_dialog.set_changed_tiles(
+                    sum(new != old for new, old in zip(new_digests, source.digests)),
+                    len(source.plan.tiles)
+                )
+
+        def show_progress(progress: float):
+            if self._dialog_digests is dialog_digests:
+                self.diffusion_dialog.set_tile_hashing_progress(progress)
+
+        digests.get(show_changed, show_progress)
+
     def image_to_image(self):
+        if self._raise_dialog(self.diffusion_dialog):
+            return
         try:
-            current_document, (x, y, width, height), current_layer, image = self._get_current_info()
+            current_document, selection, current_layer, image = self._get_current_info()
         except NotEnoughInfoException:
             return
 
+        _, _, width, height = selection
         self.diffusion_dialog.set_target_size(width, height)
         self.diffusion_dialog.set_source_image(image)
-        self.diffusion_dialog.set_mode(DiffusionMode.IMAGE_TO_IMAGE)
-        if not self.diffusion_dialog.exec():
-            return
 
-        self.insert_layers_from_diffusion()
+        settings = Settings.settings()
+        tile_size, overlap = settings.INCREMENTAL_TILE_SIZE, settings.INCREMENTAL_TILE_OVERLAP
+        key = (current_layer.uniqueId().toString(), selection, tile_size, overlap)
+        plan = TilePlan(width, height, width, height, tile_size, overlap)
+        digests = LazyTileDigests(image, plan)
+        source = self._incremental_sources.get(key)
+        # Results are updated in the first of previous result layers user didn't delete
+        nodes = [
+            current_document.nodeByUniqueID(result_id)
+            for result_id in (source.result_ids if source is not None else [])
+        ]
+        node = next((node for node in nodes if node is not None), None)
+        self._dialog_digests = (digests, source) if node is not None else None
+        self.diffusion_dialog.set_incremental_available(node is not None)
+
+        def on_inserted(new_nodes: List[Node]):
+            result_ids = [new_node.uniqueId() for new_node in new_nodes]
+
+            def store_source(new_digests: List[str]):
+                # Copy, digests of the next run's source are updated as its tiles are replaced
+                self._incremental_sources[key] = IncrementalSource(
+                    plan, list(new_digests), result_ids
+                )
+
+            digests.get(store_source)
+
+        def queue_incremental():
+            queued_request = self.diffusion_dialog.queued_request
+            digests.get(lambda new_digests: self._queue_incremental_diffusion(
+                current_document, selection, image, source, new_digests, node, queued_request
+            ))
+
+        self._show_diffusion_dialog(
+            DiffusionMode.IMAGE_TO_IMAGE,
+            current_document,
+            selection,
+            current_layer,
+            on_inserted=on_inserted,
+            queue_incremental=queue_incremental if node is not None else None,
+            targets=self._batch_targets(current_document, selection, current_layer)
+        )
 
     def inpaint(self):
+        if self._raise_dialog(self.diffusion_dialog):
+            return
         try:
-            current_document, (x, y, width, height), current_layer, image = self._get_current_info()
+            current_document, selection, current_layer, _ = self._get_current_info(
+                read_image=False
+            )
         except NotEnoughInfoException:
             return
 
-        self.diffusion_dialog.set_target_size(width, height)
-        self.diffusion_dialog.set_source_image(image)
         for layer in current_layer.childNodes():
             if layer.type() == LayerType.TRANSPARENCY_MASK:
                 mask = layer
@@ -161,95 +756,92 @@ class DiffusionToolsDockWidget(DockWidget):
         else:
             return
 
-        mask_image = self._image_from_layer(mask, x, y, width, height)
-        self.diffusion_dialog.set_mask(ImageOps.invert(mask_image))
+        mask_image = ImageOps.invert(self._image_from_layer(mask, *selection))
+        settings = Settings.settings()
+        if settings is not None and settings.INPAINT_CROP_TO_MASK:
+            # Only masked area with some context around it is sent at its own resolution, result
+            # is inserted over the same area
+            box = mask_crop_box(mask_image, settings.INPAINT_CONTEXT_MARGIN)
+            if box is not None:
+                x, y, _, _ = selection
+                left, top, right, bottom = box
+                mask_image = mask_image.crop(box)
+                selection = (x + left, y + top, right - left, bottom - top)
 
-        self.diffusion_dialog.set_mode(DiffusionMode.INPAINT)
-        if not self.diffusion_dialog.exec():
+        try:
+            image = self._image_from_layer(current_layer, *selection)
+        except UnsupportedPixelFormatException as e:
+            self._show_unsupported_pixel_format(e)
             return
 
-        self.insert_layers_from_diffusion(below=True)
+        _, _, width, height = selection
+        self.diffusion_dialog.set_target_size(width, height)
+        self.diffusion_dialog.set_source_image(image)
+        self.diffusion_dialog.set_mask(mask_image)
+        self._show_diffusion_dialog(
+            DiffusionMode.INPAINT, current_document, selection, current_layer, below=True
+        )
 
     def upscale(self):
+        if self._raise_dialog(self.upscale_dialog):
+            return
         try:
-            current_document, (x, y, width, height), current_layer, image = self._get_current_info()
+            current_document, selection, current_layer, image = self._get_current_info()
         except NotEnoughInfoException:
             return
 
+        _, _, width, height = selection
         self.upscale_dialog.set_upscaling_params(
             source_image=image,
             target_width=width * 2,
             target_height=height * 2,
             lock_aspect_ratio=True
         )
-
-        if not self.upscale_dialog.exec():
-            return
-
-        upscaled = self.upscale_dialog.result_image
-        if current_document.selection() is None:
-            current_document.setWidth(upscaled.width)
-            current_document.setHeight(upscaled.height)
-
-        parent = current_layer.parentNode()
-        new_node = current_document.createNode(f'{current_layer.name()} upscaled', 'paintLayer')
-        pixel_bytes = upscaled.convert('RGBA').tobytes('raw', 'BGRA')
-        new_node.setPixelData(pixel_bytes, x, y, upscaled.width, upscaled.height)
-        parent.addChildNode(new_node, current_layer)
+        self._show_processing_dialog(
+            self.upscale_dialog, 'Upscale', current_document, selection, current_layer, 'upscaled'
+        )
 
     def face_restoration(self):
+        if self._raise_dialog(self.face_restoration_dialog):
+            return
         try:
-            current_document, (x, y, width, height), current_layer, image = self._get_current_info()
+            current_document, selection, current_layer, image = self._get_current_info()
         except NotEnoughInfoException:
             return
 
         self.face_restoration_dialog.set_source_image(image)
-        if not self.face_restoration_dialog.exec():
-            return
-
-        restored = self.face_restoration_dialog.result_image
-        if current_document.selection() is None:
-            current_document.setWidth(restored.width)
-            current_document.setHeight(restored.height)
-
-        parent = current_layer.parentNode()
-        new_node = current_document.createNode(f'{current_layer.name()} restored', 'paintLayer')
-        pixel_bytes = restored.convert('RGBA').tobytes('raw', 'BGRA')
-        new_node.setPixelData(pixel_bytes, x, y, restored.width, restored.height)
-        parent.addChildNode(new_node, current_layer)
+        self._show_processing_dialog(
+            self.face_restoration_dialog,
+            'Face Restoration',
+            current_document,
+            selection,
+            current_layer,
+            'restored'
+        )
 
     def make_tilable(self):
+        if self._raise_dialog(self.diffusion_dialog):
+            return
         try:
-            current_document, (x, y, width, height), current_layer, image = self._get_current_info()
+            current_document, selection, current_layer, image = self._get_current_info()
         except NotEnoughInfoException:
             return
 
+        _, _, width, height = selection
         self.diffusion_dialog.set_target_size(width, height)
         self.diffusion_dialog.set_source_image(image)
-        self.diffusion_dialog.set_mode(DiffusionMode.MAKE_TILABLE)
-        if not self.diffusion_dialog.exec():
-            return
-
-        # FIXME seems to be bug in krita, addChildNode produces invalid mask
-        '''mask_node = current_document.createNode('mask', LayerType.TRANSPARENCY_MASK)
-        print(self.diffusion_dialog.result_mask.mode)
-        self.diffusion_dialog.result_mask.save('../out/mask.png')
-        pixel_bytes = self.diffusion_dialog.result_mask.convert('L').resize(
-            (width, height)
-        ).tobytes('raw')
-        print(len(pixel_bytes))
-        mask_node.setPixelData(pixel_bytes, x, y, width, height)
-        current_layer.addChildNode(mask_node, None)'''
-
-        self.insert_layers_from_diffusion()
+        # FIXME seems to be bug in krita, addChildNode produces invalid mask, so
+        #  diffusion_dialog.result_mask isn't inserted as transparency mask
+        self._show_diffusion_dialog(
+            DiffusionMode.MAKE_TILABLE, current_document, selection, current_layer
+        )
 
     def call_settings(self):
         self.settings_dialog.init_fields()
         if not self.settings_dialog.exec():
             return
 
-        for widget in self._depend_on_settings:
-            widget.setEnabled(True)
+        self._update_capabilities()
 
     def canvasChanged(self, canvas: 'Canvas') -> None:
         pass
@@ -0,0 +1,44 @@
+import importlib
+import json
+import os
+import sys
+import tempfile
+import types
+
+import pytest
+
+# Plugin's own __init__ installs dependencies and registers itself with Krita, tests only need
+# the modules, so the package is registered without running it
+package = types.ModuleType('image_ai_utils')
+package.__path__ = [os.path.join(os.path.dirname(os.path.dirname(__file__)), 'image_ai_utils')]
+sys.modules.setdefault('image_ai_utils', package)
+
+# Settings, capabilities and result cache are kept next to this path, never in the plugin folder
+os.environ['AI_IMAGE_UTILS_SETTINGS_PATH'] = os.path.join(tempfile.mkdtemp(), 'settings.json')
+
+
+@pytest.fixture
+def settings(monkeypatch):
+    from image_ai_utils.common.settings import Settings, SETTINGS_PATH
+
+    def write(**values):
+        with open(SETTINGS_PATH, 'w') as f:
+            json.dump({'USERNAME': 'user', 'PASSWORD': 'password', **values}, f)
+        return Settings.reload()
+
+    monkeypatch.setattr(Settings, '_settings', None)
+    yield write
+    if os.path.isfile(SETTINGS_PATH):
+        os.remove(SETTINGS_PATH)
+
+
+@pytest.fixture
+def diffusion_tools(monkeypatch):
+    pytest.importorskip('PyQt5.QtWidgets')
+    # krita module only exists inside Krita, docker methods are driven with stand-ins
+    if 'krita' not in sys.modules:
+        krita = types.ModuleType('krita')
+        for name in ('Extension', 'DockWidget', 'Krita', 'Document', 'Node'):
+            setattr(krita, name, type(name, (), {}))
+        monkeypatch.setitem(sys.modules, 'krita', krita)
+    return importlib.import_module('image_ai_utils.diffusion_tools')
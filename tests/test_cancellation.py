@@ -0,0 +1,120 @@
+import asyncio
+import json
+import threading
+
+import pytest
+import websockets
+
+from image_ai_utils.common.cancellation import CancellationToken
+from image_ai_utils.common.client import ImageAIUtilsClient
+from image_ai_utils.common.event_loop import BackgroundEventLoop
+from image_ai_utils.common.exceptions import RequestCancelledException
+from image_ai_utils.common.websocket_session import WebSocketSession
+
+STEPS = 500
+
+
+# Stand-in that keeps reporting progress of a long generation until it's told to cancel it
+class StandInServer:
+    def __init__(self, session: bool = False):
+        self.session = session
+        self.cancelled_requests = []
+        self.steps_sent = 0
+        self.generation_stopped = threading.Event()
+        self._server = None
+
+    async def _generate(self, websocket, request_id):
+        ids = {'request_id': request_id} if self.session else {}
+        try:
+            for step in range(STEPS):
+                await websocket.send(json.dumps({**ids, 'status': 'progress', 'progress': step}))
+                self.steps_sent += 1
+                await asyncio.sleep(0.01)
+            await websocket.send(json.dumps({**ids, 'status': 'finished', 'result': {}}))
+        finally:
+            self.generation_stopped.set()
+
+    async def _handler(self, websocket, path=None):
+        await websocket.recv()
+        generations = {}
+        try:
+            async for message in websocket:
+                message = json.loads(message)
+                request_id = message.get('request_id')
+                if message.get('action') == 'cancel':
+                    self.cancelled_requests.append(request_id)
+                    generations.pop(request_id).cancel()
+                else:
+                    generations[request_id] = asyncio.ensure_future(
+                        self._generate(websocket, request_id)
+                    )
+        finally:
+            for generation in generations.values():
+                generation.cancel()
+
+    async def start(self) -> int:
+        self._server = await websockets.serve(self._handler, '127.0.0.1', 0)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+@pytest.fixture
+def stand_in():
+    server = StandInServer()
+    loop = BackgroundEventLoop.instance()
+    port = loop.run(server.start())
+    yield server, port
+    loop.run(server.stop())
+
+
+def test_cancelled_token_stops_generation_on_server(stand_in):
+    server, port = stand_in
+    client = ImageAIUtilsClient(f'127.0.0.1:{port}', 'user', 'password')
+    token = CancellationToken()
+    try:
+        with pytest.raises(RequestCancelledException):
+            client.do_diffusion_request(
+                'text_to_image',
+                'prompt',
+                progress_callback=lambda progress: progress >= 3 and token.cancel(),
+                cancellation_token=token
+            )
+        assert server.generation_stopped.wait(5)
+    finally:
+        BackgroundEventLoop.instance().run(client.async_client.close())
+
+    assert server.cancelled_requests == [None]
+    assert server.steps_sent < STEPS
+
+
+def test_cancelled_session_request_stops_only_its_generation():
+    server = StandInServer(session=True)
+
+    async def run():
+        port = await server.start()
+        session = WebSocketSession(f'ws://127.0.0.1:{port}/', ('user', 'password'))
+        progress = asyncio.Event()
+        try:
+            cancelled = asyncio.ensure_future(
+                session.request('text_to_image', {}, update_callback=lambda *_: progress.set())
+            )
+            await progress.wait()
+            cancelled.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await cancelled
+            await asyncio.get_running_loop().run_in_executor(
+                None, server.generation_stopped.wait, 5
+            )
+            return session.connected
+        finally:
+            await session.close()
+            await server.stop()
+
+    connected = asyncio.run(run())
+    assert len(server.cancelled_requests) == 1 and server.cancelled_requests[0] is not None
+    assert server.steps_sent < STEPS
+    # Cancelling one request doesn't drop the session shared with other requests
+    assert connected
@@ -0,0 +1,60 @@
+import asyncio
+import threading
+
+import pytest
+
+from image_ai_utils.common.cancellation import CancellationToken
+from image_ai_utils.common.event_loop import BackgroundEventLoop
+from image_ai_utils.common.exceptions import RequestCancelledException
+
+
+def test_run_returns_result():
+    async def add(a, b):
+        await asyncio.sleep(0)
+        return a + b
+
+    assert BackgroundEventLoop.instance().run(add(1, 2)) == 3
+
+
+def test_cancelled_token_cancels_running_coroutine():
+    started, finished = threading.Event(), threading.Event()
+    token = CancellationToken()
+
+    async def wait():
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        finally:
+            finished.set()
+
+    threading.Thread(target=lambda: started.wait(5) and token.cancel(), daemon=True).start()
+    with pytest.raises(RequestCancelledException):
+        BackgroundEventLoop.instance().run(wait(), token)
+    # Coroutine itself was cancelled, not only the wait for it
+    assert finished.wait(5)
+
+
+def test_already_cancelled_token_doesnt_run_coroutine():
+    token = CancellationToken()
+    token.cancel()
+    ran = []
+
+    async def run():
+        ran.append(True)
+
+    with pytest.raises(RequestCancelledException):
+        BackgroundEventLoop.instance().run(run(), token)
+    assert not ran
+
+
+def test_blocking_run_from_loop_thread_is_refused():
+    loop = BackgroundEventLoop.instance()
+
+    async def nested():
+        async def inner():
+            return 1
+
+        with pytest.raises(RuntimeError):
+            loop.run(inner())
+
+    loop.run(nested())
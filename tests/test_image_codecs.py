@@ -0,0 +1,65 @@
+import os
+
+import pytest
+from PIL import Image
+
+from image_ai_utils.common.image_codecs import encode_raw, decode_raw, is_raw, RawCompression, \
+    EncodedImage, ImageEncoder, ImageCodec, zstandard, lz4
+from image_ai_utils.common.pixel_buffer import PixelBuffer
+
+COMPRESSIONS = [
+    RawCompression.NONE,
+    RawCompression.ZLIB,
+    pytest.param(RawCompression.LZ4, marks=pytest.mark.skipif(lz4 is None, reason='no lz4')),
+    pytest.param(
+        RawCompression.ZSTD, marks=pytest.mark.skipif(zstandard is None, reason='no zstandard')
+    ),
+]
+
+
+def random_image(mode: str = 'RGBA', size=(37, 23)) -> Image.Image:
+    channels = len(mode)
+    return Image.frombytes(mode, size, os.urandom(size[0] * size[1] * channels))
+
+
+@pytest.mark.parametrize('compression', COMPRESSIONS)
+@pytest.mark.parametrize('mode', ['RGBA', 'RGB', 'L'])
+def test_raw_round_trip(mode, compression):
+    image = random_image(mode)
+    data = encode_raw(image, compression)
+    assert is_raw(data)
+    decoded = decode_raw(data)
+    assert decoded.mode == mode
+    assert decoded.tobytes() == image.tobytes()
+
+
+def test_pixel_buffer_is_sent_in_its_own_channel_order():
+    image = random_image()
+    buffer = PixelBuffer(image.tobytes('raw', 'BGRA'), image.width, image.height)
+    decoded = decode_raw(encode_raw(buffer, RawCompression.ZLIB))
+    assert decoded.mode == 'RGBA'
+    assert decoded.tobytes() == image.tobytes()
+
+
+def test_encoded_image_reads_header_without_decoding():
+    image = random_image()
+    encoded = EncodedImage(encode_raw(image))
+    assert encoded.size == image.size
+    assert encoded.mime_type == ImageCodec.RAW.mime_type
+    assert not encoded.loaded
+    assert encoded.load().tobytes() == image.tobytes()
+
+
+def test_raw_bgra_is_converted_to_pixel_data_without_decoding():
+    image = random_image()
+    encoded = EncodedImage(encode_raw(PixelBuffer(image.tobytes('raw', 'BGRA'), *image.size)))
+    assert bytes(encoded.to_pixel_data()) == image.tobytes('raw', 'BGRA')
+    assert not encoded.loaded
+
+
+def test_encoder_falls_back_to_png_for_unsupported_codec():
+    encoder = ImageEncoder(codec=ImageCodec.RAW)
+    encoder.supported_codecs = ['png']
+    data, mime_type = encoder.encode(random_image())
+    assert mime_type == 'image/png'
+    assert data.startswith(b'\x89PNG')
@@ -0,0 +1,55 @@
+import types
+
+import pytest
+from PIL import Image
+
+pytest.importorskip('PyQt5.QtWidgets')
+
+from image_ai_utils.common.resolution import plan_resolution  # noqa: E402
+from image_ai_utils.common.tiling import TilePlan, tile_digests  # noqa: E402
+
+
+class StandInNode:
+    def name(self) -> str:
+        return 'layer'
+
+
+def test_incremental_run_queues_only_changed_tiles(diffusion_tools):
+    plan = TilePlan(1024, 512, 1024, 512, tile_size=512, overlap=32)
+    previous = Image.new('RGBA', (1024, 512), 'black')
+    source = diffusion_tools.IncrementalSource(plan, tile_digests(previous, plan), [])
+    painted = previous.copy()
+    painted.paste((255, 255, 255, 255), (600, 100, 700, 200))
+    digests = tile_digests(painted, plan)
+
+    written = []
+    jobs = []
+    tools = types.SimpleNamespace(
+        diffusion_dialog=types.SimpleNamespace(render_plan_for=plan_resolution),
+        _tile_io=lambda document, node, x, y: (
+            lambda box: Image.new('RGBA', (box[2] - box[0], box[3] - box[1]), 'black'),
+            lambda box, image: written.append(box)
+        ),
+        _queue_job=lambda name, document, queued_request, insert_result: jobs.append(
+            (name, queued_request, insert_result)
+        )
+    )
+    diffusion_tools.DiffusionToolsDockWidget._queue_incremental_diffusion(
+        tools,
+        None,
+        (0, 0, 1024, 512),
+        painted,
+        source,
+        digests,
+        StandInNode(),
+        ('image_to_image', {'prompt': 'prompt', 'num_variants': 4})
+    )
+
+    assert [name for name, _, _ in jobs] == ['Img2Img layer 2/2']
+    _, (client_method, request_data), insert_result = jobs[0]
+    assert client_method == 'image_to_image' and request_data['num_variants'] == 1
+    assert all(side % 64 == 0 for side in request_data['render_size'])
+
+    insert_result([Image.new('RGBA', request_data['render_size'], 'white')])
+    assert written and all(box[0] >= 512 - plan.blend for box in written)
+    assert source.digests == digests
@@ -0,0 +1,202 @@
+import io
+import json
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+pytest.importorskip('PyQt5')
+
+import websockets  # noqa: E402
+from PIL import Image  # noqa: E402
+from PyQt5.QtCore import QCoreApplication  # noqa: E402
+
+from image_ai_utils.common.client import ImageAIUtilsClient  # noqa: E402
+from image_ai_utils.common.event_loop import BackgroundEventLoop  # noqa: E402
+from image_ai_utils.common.job_queue import JobQueue, Job, JobStatus  # noqa: E402
+from image_ai_utils.common.server_pool import ServerPool  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def png(size=(8, 8)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', size).save(buffer, 'png')
+    return buffer.getvalue()
+
+
+# Stand-in for one server of the pool, answers upscale over http and diffusion over websocket
+class StandInServer:
+    def __init__(self):
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers['Content-Length']))
+                server.requests += 1
+                body = png()
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._http = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._http.serve_forever, daemon=True).start()
+        self.url = f'127.0.0.1:{self._http.server_port}'
+        self._websocket = None
+
+    def serve_websocket(self, response=None) -> str:
+        response = response or {'status': 'finished', 'result': {'images': []}}
+
+        async def handler(websocket, path=None):
+            await websocket.recv()
+            await websocket.recv()
+            self.requests += 1
+            await websocket.send(json.dumps(response))
+
+        async def serve():
+            return await websockets.serve(handler, '127.0.0.1', 0)
+
+        self._websocket = BackgroundEventLoop.instance().run(serve())
+        port = self._websocket.sockets[0].getsockname()[1]
+        return f'127.0.0.1:{port}'
+
+    def close(self):
+        self._http.shutdown()
+        if self._websocket is not None:
+            self._websocket.close()
+
+
+@pytest.fixture
+def qt_app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+@pytest.fixture
+def pool_settings(settings, qt_app, monkeypatch):
+    monkeypatch.setattr(ServerPool, '_instance', None)
+    monkeypatch.setattr(JobQueue, '_instance', None)
+    monkeypatch.setattr(ImageAIUtilsClient, '_clients', {})
+
+    def write(servers, **values):
+        return settings(
+            SERVER_URL=servers[0],
+            SERVER_URLS=servers[1:],
+            USE_UPLOAD_CACHE=False,
+            USE_RESULT_CACHE=False,
+            JOB_RETRY_DELAY=5,
+            CONNECT_TIMEOUT=2,
+            **values
+        )
+
+    yield write
+    ImageAIUtilsClient.refresh_credentials()
+
+
+def process_until(condition, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        QCoreApplication.processEvents()
+        time.sleep(0.01)
+    return condition()
+
+
+def upscale_job(**kwargs) -> Job:
+    return Job(
+        'upscale',
+        'upscale',
+        {'source_image': Image.new('RGB', (8, 8)), 'target_width': 8, 'target_height': 8},
+        **kwargs
+    )
+
+
+@pytest.fixture
+def server():
+    server = StandInServer()
+    yield server
+    server.close()
+
+
+def test_job_fails_over_from_dead_server_without_backoff(pool_settings, server):
+    dead = f'127.0.0.1:{free_port()}'
+    pool_settings([dead, server.url])
+    job = JobQueue.instance().submit(upscale_job(affinity=dead))
+
+    start = time.monotonic()
+    assert process_until(lambda: job.done)
+    # Retry delay is 5 seconds, failover to another server doesn't wait for it
+    assert time.monotonic() - start < 3
+    assert job.status == JobStatus.FINISHED
+    assert job.server == server.url
+    assert job.attempts == 2
+    assert not ServerPool.instance().health(dead).available
+
+
+def test_websocket_job_fails_over_from_dead_server(pool_settings, server):
+    dead = f'127.0.0.1:{free_port()}'
+    websocket_url = server.serve_websocket()
+    pool_settings([dead, websocket_url])
+    job = JobQueue.instance().submit(Job(
+        'diffusion', 'text_to_image', {'prompt': 'prompt', 'aspect_ratio': 1.}, affinity=dead
+    ))
+
+    start = time.monotonic()
+    assert process_until(lambda: job.done)
+    assert time.monotonic() - start < 3
+    assert job.status == JobStatus.FINISHED, job.error_message
+    assert job.server == websocket_url
+
+
+def test_error_reported_by_server_is_not_retried(pool_settings, server):
+    websocket_url = server.serve_websocket({'status': 'finished', 'message': 'Out of memory'})
+    pool_settings([websocket_url])
+    job = JobQueue.instance().submit(
+        Job('diffusion', 'text_to_image', {'prompt': 'prompt', 'aspect_ratio': 1.})
+    )
+
+    assert process_until(lambda: job.done)
+    assert job.status == JobStatus.FAILED
+    assert job.attempts == 1 and server.requests == 1
+    assert ServerPool.instance().health(websocket_url).available
+
+
+def test_pinned_job_stays_on_its_server(pool_settings, server):
+    other = StandInServer()
+    try:
+        pool_settings([other.url, server.url])
+        jobs = [JobQueue.instance().submit(upscale_job(affinity=server.url, pinned=True))
+                for _ in range(3)]
+        assert process_until(lambda: all(job.done for job in jobs))
+        assert {job.server for job in jobs} == {server.url}
+        assert other.requests == 0
+    finally:
+        other.close()
+
+
+def test_pinned_job_without_affinity_runs(pool_settings, server):
+    pool_settings([server.url])
+    job = JobQueue.instance().submit(upscale_job(pinned=True))
+    assert process_until(lambda: job.done)
+    assert job.status == JobStatus.FINISHED
+
+
+def test_refreshed_client_is_closed_after_its_jobs_finish(pool_settings, server):
+    pool_settings([server.url])
+    old_client = ImageAIUtilsClient.client(server.url)
+    job = JobQueue.instance().submit(upscale_job())
+    ImageAIUtilsClient.refresh_credentials()
+    assert process_until(lambda: job.done)
+    assert job.status == JobStatus.FINISHED
+    assert process_until(lambda: old_client.async_client._http_client.is_closed, timeout=2)
+    assert ImageAIUtilsClient.client(server.url) is not old_client
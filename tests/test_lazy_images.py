@@ -0,0 +1,33 @@
+import asyncio
+import json
+
+import websockets
+from PIL import Image
+
+from image_ai_utils.common.async_client import AsyncImageAIUtilsClient
+from image_ai_utils.common.image_codecs import EncodedImage
+from image_ai_utils.common.utils import image_to_base64url
+
+
+def test_gobig_returns_encoded_image_when_lazy():
+    result = image_to_base64url(Image.new('RGB', (16, 8), 'red')).decode()
+
+    async def handler(websocket, path=None):
+        await websocket.recv()
+        await websocket.recv()
+        await websocket.send(json.dumps({'status': 'finished', 'result': {'image': result}}))
+
+    async def run():
+        async with websockets.serve(handler, '127.0.0.1', 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            client = AsyncImageAIUtilsClient(f'127.0.0.1:{port}', 'user', 'password')
+            try:
+                return await client.gobig(
+                    'prompt', Image.new('RGB', (8, 4)), 16, 8, lazy_images=True
+                )
+            finally:
+                await client.close()
+
+    image = asyncio.run(run())
+    assert isinstance(image, EncodedImage) and not image.loaded
+    assert image.size == (16, 8)
@@ -0,0 +1,97 @@
+import os
+
+import pytest
+from PIL import Image
+
+from image_ai_utils.common import pixel_format as pixel_format_module
+from image_ai_utils.common.pixel_format import PixelFormat, ColorModel, ColorDepth, \
+    pixels_to_bgra, image_to_pixels
+
+numpy = pytest.importorskip('numpy')
+
+EXACT_FORMATS = [
+    PixelFormat(ColorModel.RGBA, ColorDepth.U8),
+    PixelFormat(ColorModel.RGBA, ColorDepth.U16),
+    PixelFormat(ColorModel.RGBA, ColorDepth.F16),
+    PixelFormat(ColorModel.RGBA, ColorDepth.F32),
+    PixelFormat(ColorModel.RGBA, ColorDepth.U16, linear=True),
+    PixelFormat(ColorModel.RGBA, ColorDepth.F16, linear=True),
+    PixelFormat(ColorModel.RGBA, ColorDepth.F32, linear=True),
+    PixelFormat(ColorModel.CMYKA, ColorDepth.U8),
+    PixelFormat(ColorModel.CMYKA, ColorDepth.F32),
+]
+
+
+def random_image(size=(64, 32)) -> Image.Image:
+    return Image.frombytes('RGBA', size, os.urandom(size[0] * size[1] * 4))
+
+
+@pytest.mark.parametrize('pixel_format', EXACT_FORMATS, ids=str)
+def test_round_trip_through_layer_format(pixel_format):
+    image = random_image()
+    data = image_to_pixels(image, pixel_format)
+    channels = pixel_format.model.channels
+    assert len(data) == image.width * image.height * channels * \
+        numpy.dtype(pixel_format.depth.dtype).itemsize
+    bgra = pixels_to_bgra(data, pixel_format, image.width, image.height)
+    assert bgra == image.tobytes('raw', 'BGRA')
+
+
+def test_linear_u8_round_trip_loses_only_shadows():
+    pixel_format = PixelFormat(ColorModel.RGBA, ColorDepth.U8, linear=True)
+    image = Image.frombytes('RGBA', (256, 1), bytes(value for value in range(256) for _ in 'RGBA'))
+    bgra = pixels_to_bgra(image_to_pixels(image, pixel_format), pixel_format, 256, 1)
+    errors = numpy.abs(
+        numpy.frombuffer(bgra, numpy.uint8).astype(int) -
+        numpy.frombuffer(image.tobytes('raw', 'BGRA'), numpy.uint8)
+    ).reshape((-1, 4))
+    assert errors.max() <= 6
+    # Linear steps are finer than sRGB ones in highlights and alpha isn't gamma encoded
+    assert not errors[128:].any() and not errors[:, 3].any()
+
+
+def test_gray_round_trip():
+    pixel_format = PixelFormat(ColorModel.GRAYA, ColorDepth.U16)
+    image = Image.merge('RGBA', [random_image().getchannel(0)] * 3 + [random_image().getchannel(3)])
+    bgra = pixels_to_bgra(
+        image_to_pixels(image, pixel_format), pixel_format, image.width, image.height
+    )
+    assert bgra == image.tobytes('raw', 'BGRA')
+
+
+def test_float_values_are_scaled_to_channel_units():
+    pixel_format = PixelFormat(ColorModel.RGBA, ColorDepth.F32)
+    image = Image.new('RGBA', (1, 1), (255, 0, 51, 255))
+    pixels = numpy.frombuffer(image_to_pixels(image, pixel_format), numpy.float32)
+    assert pixels.tolist() == pytest.approx([1, 0, 0.2, 1])
+
+
+FALLBACK_FORMATS = [
+    PixelFormat(ColorModel.RGBA, ColorDepth.U16),
+    PixelFormat(ColorModel.RGBA, ColorDepth.F32),
+    PixelFormat(ColorModel.RGBA, ColorDepth.U16, linear=True),
+    PixelFormat(ColorModel.RGBA, ColorDepth.F32, linear=True),
+    PixelFormat(ColorModel.CMYKA, ColorDepth.F32),
+]
+
+
+@pytest.mark.parametrize('pixel_format', FALLBACK_FORMATS, ids=str)
+def test_fallback_without_numpy_matches(monkeypatch, pixel_format):
+    image = random_image()
+    expected = image.tobytes('raw', 'BGRA')
+    monkeypatch.setattr(pixel_format_module, 'numpy', None)
+    bgra = pixels_to_bgra(
+        image_to_pixels(image, pixel_format), pixel_format, image.width, image.height
+    )
+    assert bgra == expected
+
+
+@pytest.mark.parametrize('pixel_format', FALLBACK_FORMATS, ids=str)
+def test_fallback_reads_layers_like_numpy(monkeypatch, pixel_format):
+    # Values that aren't results of 8-bit conversion, as painted in the layer
+    values = numpy.random.default_rng(0).random(64 * 32 * pixel_format.model.channels)
+    values = values * 1.2 - 0.1 if pixel_format.depth.is_float else values * 65535
+    data = values.astype(pixel_format.depth.dtype).tobytes()
+    expected = pixels_to_bgra(data, pixel_format, 64, 32)
+    monkeypatch.setattr(pixel_format_module, 'numpy', None)
+    assert pixels_to_bgra(data, pixel_format, 64, 32) == expected
@@ -0,0 +1,55 @@
+import asyncio
+import json
+import threading
+
+import websockets
+from PIL import Image
+
+from image_ai_utils.common import utils
+from image_ai_utils.common.async_client import AsyncImageAIUtilsClient
+from image_ai_utils.common.utils import image_to_base64url
+
+
+def test_previews_are_decoded_off_event_loop(monkeypatch):
+    decoding_threads = []
+    decode = utils.decode_response_images
+
+    def recording_decode(*args, **kwargs):
+        decoding_threads.append(threading.current_thread())
+        return decode(*args, **kwargs)
+
+    monkeypatch.setattr(
+        'image_ai_utils.common.async_client.decode_response_images', recording_decode
+    )
+    preview = image_to_base64url(Image.new('RGB', (8, 8), 'red')).decode()
+    variant = image_to_base64url(Image.new('RGB', (8, 8), 'blue')).decode()
+
+    async def handler(websocket, path=None):
+        await websocket.recv()
+        await websocket.recv()
+        await websocket.send(json.dumps({'status': 'preview', 'variant': 0, 'image': preview}))
+        await websocket.send(json.dumps({
+            'status': 'finished', 'result': {'images': [variant]}
+        }))
+
+    async def run():
+        shown = []
+        loop_thread = threading.current_thread()
+        async with websockets.serve(handler, '127.0.0.1', 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            client = AsyncImageAIUtilsClient(f'127.0.0.1:{port}', 'user', 'password')
+            try:
+                images = await client.do_diffusion_request(
+                    'text_to_image',
+                    'prompt',
+                    preview_callback=lambda index, image: shown.append(image.getpixel((0, 0)))
+                )
+            finally:
+                await client.close()
+        return loop_thread, shown, images
+
+    loop_thread, shown, images = asyncio.run(run())
+    assert loop_thread not in decoding_threads
+    # Preview of the variant can't be shown after the variant itself
+    assert shown[-1] == (0, 0, 255)
+    assert images[0].getpixel((0, 0)) == (0, 0, 255)
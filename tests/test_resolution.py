@@ -0,0 +1,53 @@
+from PIL import Image
+
+from image_ai_utils.common.resolution import plan_resolution, RESOLUTION_MULTIPLE, \
+    NATIVE_RESOLUTION, DEFAULT_MAX_PIXELS
+
+
+def test_grow_brings_shorter_side_to_native_resolution():
+    plan = plan_resolution(300, 200, 'grow')
+    assert plan.height == NATIVE_RESOLUTION
+    assert plan.width == 768
+    assert plan.resized
+
+
+def test_shrink_brings_longer_side_to_native_resolution():
+    plan = plan_resolution(1920, 1080, 'shrink')
+    assert plan.width == NATIVE_RESOLUTION
+    assert plan.height % RESOLUTION_MULTIPLE == 0
+
+
+def test_valid_selection_is_rendered_as_is():
+    plan = plan_resolution(256, 256)
+    assert (plan.width, plan.height) == (256, 256)
+    assert not plan.resized
+    assert plan.cost == 0.25
+
+
+def test_render_is_capped_to_pixel_budget():
+    plan = plan_resolution(4000, 100, 'grow')
+    assert plan.width * plan.height <= DEFAULT_MAX_PIXELS
+    assert plan.width % RESOLUTION_MULTIPLE == 0 and plan.height % RESOLUTION_MULTIPLE == 0
+    plan = plan_resolution(2048, 2048, max_pixels=512 * 512)
+    assert (plan.width, plan.height) == (512, 512)
+
+
+def test_bucket_closest_in_aspect_ratio_is_chosen():
+    buckets = [[512, 512], [768, 512], [512, 768], [1024, 1024]]
+    assert plan_resolution(1920, 1080, buckets=buckets)[:2] == (768, 512)
+    assert plan_resolution(1080, 1920, buckets=buckets)[:2] == (512, 768)
+    # Among equally shaped buckets, one closest to unbucketed size
+    assert plan_resolution(300, 300, buckets=buckets)[:2] == (512, 512)
+    assert plan_resolution(1024, 1024, buckets=buckets)[:2] == (1024, 1024)
+
+
+def test_buckets_over_pixel_budget_are_skipped():
+    buckets = [[512, 512], [1024, 1024]]
+    assert plan_resolution(1024, 1024, buckets=buckets, max_pixels=512 * 512)[:2] == (512, 512)
+
+
+def test_source_is_only_scaled_down():
+    plan = plan_resolution(1024, 1024, max_pixels=512 * 512)
+    assert plan.fit_source(Image.new('RGB', (1024, 1024))).size == (512, 512)
+    small = Image.new('RGB', (64, 64))
+    assert plan.fit_source(small) is small
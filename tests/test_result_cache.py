@@ -0,0 +1,63 @@
+import os
+
+from PIL import Image
+
+from image_ai_utils.common.result_cache import ResultCache, result_cache_key
+
+
+def random_image(size=(16, 8)) -> Image.Image:
+    return Image.frombytes('RGBA', size, os.urandom(size[0] * size[1] * 4))
+
+
+REQUEST = {'prompt': 'prompt', 'seed': 1, 'num_variants': 2, 'strength': 0.5}
+
+
+def test_key_is_stable_and_ignores_key_order():
+    image = random_image()
+    key = result_cache_key('server', 'image_to_image', {**REQUEST, 'source_image': image})
+    reordered = dict(reversed(list({**REQUEST, 'source_image': image.copy()}.items())))
+    assert result_cache_key('server', 'image_to_image', reordered) == key
+
+
+def test_key_depends_on_request_server_and_parameters():
+    key = result_cache_key('server', 'text_to_image', REQUEST)
+    assert result_cache_key('other', 'text_to_image', REQUEST) != key
+    assert result_cache_key('server', 'image_to_image', REQUEST) != key
+    assert result_cache_key('server', 'text_to_image', {**REQUEST, 'seed': 2}) != key
+    webp = {**REQUEST, 'output_format': 'webp'}
+    assert result_cache_key('server', 'text_to_image', webp) != key
+    assert result_cache_key('server', 'text_to_image', {**webp, 'output_format': 'png'}) != \
+        result_cache_key('server', 'text_to_image', webp)
+
+
+def test_key_depends_on_image_pixels():
+    image = random_image()
+    key = result_cache_key('server', 'image_to_image', {**REQUEST, 'source_image': image})
+    other = Image.new('RGBA', image.size)
+    assert result_cache_key('server', 'image_to_image', {**REQUEST, 'source_image': other}) != key
+
+
+def test_result_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path), max_size=1024 * 1024)
+    images = [random_image(), random_image()]
+    cache.put('key', {'images': images, 'result_id': 'id'})
+    result = cache.get('key')
+    assert result['result_id'] == 'id'
+    assert [image.tobytes() for image in result['images']] == [image.tobytes() for image in images]
+    assert cache.get('missing') is None
+    assert cache.stats.hits == 1 and cache.stats.misses == 1
+
+
+def test_least_recently_used_result_is_evicted(tmp_path):
+    image = random_image((64, 64))
+    cache = ResultCache(str(tmp_path), max_size=1024 * 1024)
+    cache.put('first', {'image': image})
+    entry_size = cache.stats.size
+    cache.set_max_size(int(entry_size * 2.5))
+    cache.put('second', {'image': image})
+    cache.get('first')
+    cache.put('third', {'image': image})
+    assert cache.get('second') is None
+    assert cache.get('first') is not None and cache.get('third') is not None
+    # Entries are found again by a new instance
+    assert ResultCache(str(tmp_path), max_size=1024 * 1024).stats.entries == 2
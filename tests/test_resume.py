@@ -0,0 +1,239 @@
+import asyncio
+import io
+import json
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import httpx
+import pytest
+import websockets
+from PIL import Image
+
+from image_ai_utils.common import async_client
+from image_ai_utils.common.async_client import AsyncImageAIUtilsClient, JOB_ID
+from image_ai_utils.common.exceptions import ConnectionLostException, ConnectionFailedException
+
+
+@pytest.fixture(autouse=True)
+def fast_resume(monkeypatch):
+    monkeypatch.setattr(async_client, 'RESUME_DELAY', 0.01)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def make_client(port: int, **kwargs) -> AsyncImageAIUtilsClient:
+    return AsyncImageAIUtilsClient(f'127.0.0.1:{port}', 'user', 'password', **kwargs)
+
+
+async def request(client: AsyncImageAIUtilsClient, job_id=None):
+    JOB_ID.set(job_id)
+    try:
+        return await client.do_diffusion_request('text_to_image', 'prompt', return_raw=True)
+    finally:
+        await client.close()
+
+
+# Stand-in server, `behaviour` decides what happens to each received request
+def serve(port: int, behaviour):
+    requests = []
+
+    async def handler(websocket, path=None):
+        await websocket.recv()
+        request_data = json.loads(await websocket.recv())
+        requests.append(request_data)
+        await behaviour(websocket, request_data, len(requests))
+
+    return websockets.serve(handler, '127.0.0.1', port), requests
+
+
+async def finish(websocket, request_data):
+    await websocket.send(json.dumps({
+        'status': 'finished', 'result': {'images': [], 'job_id': request_data.get('job_id')}
+    }))
+
+
+def test_refused_connection_fails_without_retries():
+    async def run():
+        start = time.perf_counter()
+        with pytest.raises(ConnectionFailedException):
+            await request(make_client(free_port()), 'job')
+        return time.perf_counter() - start
+
+    assert asyncio.run(run()) < 1
+
+
+def test_refused_session_connection_fails_without_retries():
+    async def run():
+        with pytest.raises(ConnectionFailedException):
+            await request(make_client(free_port(), use_session=True), 'job')
+
+    asyncio.run(run())
+
+
+def test_drop_before_acknowledgement_is_left_to_job_queue():
+    # Mid-upload: server has the request but hasn't accepted the job yet
+    async def drop(websocket, request_data, count):
+        await websocket.close()
+
+    async def run():
+        port = free_port()
+        server, requests = serve(port, drop)
+        async with server:
+            with pytest.raises(ConnectionLostException):
+                await request(make_client(port), 'job')
+        return requests
+
+    assert len(asyncio.run(run())) == 1
+
+
+def test_drop_after_acknowledgement_resumes_job():
+    # Mid-result: progress was reported, so resent request re-attaches to the same job
+    async def drop_first(websocket, request_data, count):
+        await websocket.send(json.dumps({'status': 'progress', 'progress': 0.5}))
+        if count == 1:
+            await websocket.close()
+        else:
+            await finish(websocket, request_data)
+
+    async def run():
+        port = free_port()
+        server, requests = serve(port, drop_first)
+        async with server:
+            response = await request(make_client(port), 'job')
+        return response, requests
+
+    response, requests = asyncio.run(run())
+    assert response['result']['job_id'] == 'job'
+    assert [request_data['job_id'] for request_data in requests] == ['job', 'job']
+
+
+def test_drop_without_job_id_is_not_resumed():
+    async def drop(websocket, request_data, count):
+        await websocket.send(json.dumps({'status': 'progress', 'progress': 0.5}))
+        await websocket.close()
+
+    async def run():
+        port = free_port()
+        server, requests = serve(port, drop)
+        async with server:
+            with pytest.raises(ConnectionLostException):
+                await request(make_client(port))
+        return requests
+
+    assert len(asyncio.run(run())) == 1
+
+
+def test_server_restart_resumes_job(monkeypatch):
+    # Server goes down after accepting the job and is back before resent request arrives
+    monkeypatch.setattr(async_client, 'RESUME_DELAY', 0.2)
+    port = free_port()
+    stopped = asyncio.Event()
+
+    async def stop(websocket, request_data, count):
+        await websocket.send(json.dumps({'status': 'progress', 'progress': 0.5}))
+        stopped.set()
+        await websocket.close()
+
+    async def resume(websocket, request_data, count):
+        await finish(websocket, request_data)
+
+    async def restart():
+        first_server, _ = serve(port, stop)
+        server = await first_server
+        await stopped.wait()
+        server.close()
+        await server.wait_closed()
+        second_server, requests = serve(port, resume)
+        return await second_server, requests
+
+    async def run():
+        restarted = asyncio.ensure_future(restart())
+        await asyncio.sleep(0.05)
+        response = await request(make_client(port), 'job')
+        server, requests = await restarted
+        server.close()
+        return response, requests
+
+    response, requests = asyncio.run(run())
+    assert response['result']['job_id'] == 'job'
+    assert [request_data['job_id'] for request_data in requests] == ['job']
+
+
+def test_server_down_on_resume_is_left_to_job_queue():
+    servers = []
+
+    async def stop(websocket, request_data, count):
+        await websocket.send(json.dumps({'status': 'progress', 'progress': 0.5}))
+        servers[0].close()
+        await websocket.close()
+
+    async def run():
+        port = free_port()
+        server, _ = serve(port, stop)
+        servers.append(await server)
+        with pytest.raises(ConnectionFailedException):
+            await request(make_client(port), 'job')
+
+    asyncio.run(run())
+
+
+def test_http_drop_after_body_was_sent_resumes_job():
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            requests.append(self.headers['Idempotency-Key'])
+            self.rfile.read(int(self.headers['Content-Length']))
+            if len(requests) == 1:
+                self.close_connection = True
+                return
+            body = io.BytesIO()
+            Image.new('RGB', (16, 16)).save(body, 'png')
+            body = body.getvalue()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    async def run():
+        client = make_client(server.server_port, use_upload_cache=False)
+        JOB_ID.set('job')
+        try:
+            return await client.upscale(Image.new('RGB', (8, 8)), 16, 16)
+        finally:
+            await client.close()
+
+    try:
+        image = asyncio.run(run())
+    finally:
+        server.shutdown()
+    assert image.size == (16, 16)
+    assert requests == ['job', 'job']
+
+
+def test_http_refused_connection_fails_without_retries():
+    async def run():
+        client = make_client(free_port())
+        JOB_ID.set('job')
+        try:
+            await client.upscale(Image.new('RGB', (8, 8)), 16, 16)
+        finally:
+            await client.close()
+
+    with pytest.raises(httpx.ConnectError):
+        asyncio.run(run())
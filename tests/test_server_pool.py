@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip('PyQt5')
+
+from image_ai_utils.common.server_pool import ServerPool  # noqa: E402
+
+SERVERS = ['first:8000', 'second:8000', 'third:8000']
+
+
+@pytest.fixture
+def pool():
+    pool = ServerPool()
+    pool.set_servers(SERVERS)
+    return pool
+
+
+def test_least_loaded_server_is_chosen(pool):
+    pool.health('first:8000').record_success(queue_depth=5)
+    pool.health('second:8000').record_success(queue_depth=1)
+    pool.health('third:8000').record_success(queue_depth=1)
+    assert pool.choose({'third:8000': 1}, limit=2) == 'second:8000'
+
+
+def test_affinity_is_preferred_while_it_has_free_slots(pool):
+    pool.health('first:8000').record_success(queue_depth=5)
+    assert pool.choose({}, limit=2, affinity='first:8000') == 'first:8000'
+    assert pool.choose({'first:8000': 2}, limit=2, affinity='first:8000') != 'first:8000'
+
+
+def test_unreachable_server_is_skipped(pool):
+    pool.record_failure('first:8000')
+    pool.record_failure('second:8000')
+    assert pool.choose({}, limit=2, affinity='first:8000') == 'third:8000'
+    assert pool.has_alternative('first:8000')
+
+
+def test_every_server_down_still_runs_jobs(pool):
+    for server in SERVERS:
+        pool.record_failure(server)
+    assert pool.choose({}, limit=2) in SERVERS
+
+
+def test_pinned_job_waits_for_its_server(pool):
+    assert pool.choose({'first:8000': 2}, limit=2, affinity='first:8000', pinned=True) is None
+    assert pool.choose({}, limit=2, affinity='first:8000', pinned=True) == 'first:8000'
+
+
+def test_pinned_job_without_affinity_runs_anywhere(pool):
+    assert pool.choose({}, limit=2, pinned=True) in SERVERS
@@ -0,0 +1,103 @@
+import types
+
+from PIL import Image
+
+from image_ai_utils.common.pixel_buffer import PixelBuffer
+
+
+class StandInLayer:
+    def __init__(self, width: int, height: int, color=(0, 0, 0, 0)):
+        self.pixels = Image.new('RGBA', (width, height), color)
+        self.children = []
+
+    def name(self) -> str:
+        return 'layer'
+
+    def colorModel(self) -> str:
+        return 'RGBA'
+
+    def colorDepth(self) -> str:
+        return 'U8'
+
+    def colorProfile(self) -> str:
+        return 'sRGB-elle-V2-srgbtrc.icc'
+
+    def pixelData(self, x: int, y: int, width: int, height: int) -> bytes:
+        return self.pixels.crop((x, y, x + width, y + height)).tobytes(
+            'raw', PixelBuffer.CHANNEL_ORDER
+        )
+
+    def setPixelData(self, data: bytes, x: int, y: int, width: int, height: int):
+        image = Image.frombytes('RGBA', (width, height), data, 'raw', PixelBuffer.CHANNEL_ORDER)
+        self.pixels.paste(image, (x, y))
+
+    def parentNode(self) -> 'StandInLayer':
+        return self
+
+    def addChildNode(self, node: 'StandInLayer', above: 'StandInLayer'):
+        self.children.append(node)
+
+
+class StandInDocument:
+    def __init__(self, width: int, height: int, has_selection: bool):
+        self.size = (width, height)
+        self.has_selection = has_selection
+
+    def selection(self):
+        return object() if self.has_selection else None
+
+    def setWidth(self, width: int):
+        self.size = (width, self.size[1])
+
+    def setHeight(self, height: int):
+        self.size = (self.size[0], height)
+
+    def createNode(self, name: str, node_type: str) -> StandInLayer:
+        return StandInLayer(*self.size)
+
+    def refreshProjection(self):
+        pass
+
+
+def upscale_tiles(diffusion_tools, document: StandInDocument, selection):
+    layer = StandInLayer(*document.size, 'red')
+    jobs = []
+    tools = types.SimpleNamespace(
+        _tile_io=diffusion_tools.DiffusionToolsDockWidget._tile_io,
+        _queue_job=lambda name, document, queued_request, insert_result: jobs.append(
+            (queued_request[1], insert_result)
+        )
+    )
+    diffusion_tools.DiffusionToolsDockWidget._queue_tiled_upscale(
+        tools,
+        document,
+        selection,
+        [layer],
+        {'target_width': selection[2] * 2, 'target_height': selection[3] * 2},
+        512,
+        32
+    )
+    for request_data, insert_result in jobs:
+        insert_result(Image.new(
+            'RGB', (request_data['target_width'], request_data['target_height']), 'white'
+        ))
+    return jobs, layer.children[0]
+
+
+def test_tiled_upscale_is_fitted_into_selection(diffusion_tools):
+    document = StandInDocument(2048, 2048, has_selection=True)
+    jobs, node = upscale_tiles(diffusion_tools, document, (256, 256, 1024, 1024))
+
+    assert len(jobs) == 4
+    # Tiles are still upscaled at target scale, only the result is fitted
+    assert sum(request_data['target_width'] for request_data, _ in jobs[:2]) > 2048
+    assert document.size == (2048, 2048)
+    assert node.pixels.getbbox() == (256, 256, 1280, 1280)
+    assert node.pixels.crop((256, 256, 1280, 1280)).getextrema()[0] == (255, 255)
+
+
+def test_tiled_upscale_without_selection_resizes_document(diffusion_tools):
+    document = StandInDocument(1024, 1024, has_selection=False)
+    upscale_tiles(diffusion_tools, document, (0, 0, 1024, 1024))
+    assert document.size == (2048, 2048)
+
@@ -0,0 +1,126 @@
+from PIL import Image, ImageChops
+
+from image_ai_utils.common.tiling import (
+    TilePlan, TileBlender, mask_crop_box, tile_digests, CROP_MULTIPLE
+)
+
+
+def test_tile_cores_cover_image_without_gaps():
+    plan = TilePlan(1000, 700, 4000, 2800, tile_size=512, overlap=32)
+    assert (plan.columns, plan.rows) == (2, 2)
+    covered = Image.new('L', (plan.width, plan.height))
+    output_covered = Image.new('L', (plan.target_width, plan.target_height))
+    for tile in plan.tiles:
+        # Cores don't overlap, so each of them still has zeros under it
+        assert covered.crop(tile.core).getextrema() == (0, 0)
+        covered.paste(255, tile.core)
+        assert output_covered.crop(tile.output_core).getextrema() == (0, 0)
+        output_covered.paste(255, tile.output_core)
+    assert covered.getextrema() == (255, 255)
+    assert output_covered.getextrema() == (255, 255)
+
+
+def test_tile_context_is_core_grown_by_overlap_inside_image():
+    plan = TilePlan(1000, 700, 1000, 700, tile_size=512, overlap=32)
+    first, last = plan.tiles[0], plan.tiles[-1]
+    assert first.context[:2] == (0, 0)
+    assert first.context[2:] == (first.core[2] + 32, first.core[3] + 32)
+    assert last.context[:2] == (last.core[0] - 32, last.core[1] - 32)
+    assert last.context[2:] == (1000, 700)
+
+
+def test_small_image_is_single_tile():
+    plan = TilePlan(100, 50, 400, 200)
+    assert len(plan.tiles) == 1
+    assert plan.tiles[0].output_context == (0, 0, 400, 200)
+
+
+def solid_tile(tile, colour) -> Image.Image:
+    left, top, right, bottom = tile.output_context
+    return Image.new('RGBA', (right - left, bottom - top), colour)
+
+
+def blend(plan: TilePlan, tile_image, order):
+    destination = Image.new('RGBA', (plan.target_width, plan.target_height))
+
+    def write(box, image):
+        destination.paste(image, box[:2])
+
+    blender = TileBlender(plan, destination.crop, write)
+    for index in order:
+        tile = plan.tiles[index]
+        blender.add(tile, tile_image(tile))
+    assert blender.finished
+    return destination
+
+
+def test_blended_tiles_reproduce_source_in_any_order():
+    plan = TilePlan(600, 600, 1200, 1200, tile_size=256, overlap=32)
+    source = Image.linear_gradient('L').resize((1200, 1200)).convert('RGBA')
+
+    def tile_image(tile):
+        return source.crop(tile.output_context)
+
+    for order in (range(len(plan.tiles)), reversed(range(len(plan.tiles)))):
+        result = blend(plan, tile_image, order)
+        difference = ImageChops.difference(result, source).convert('L').getextrema()
+        # Only rounding of blend weights differs
+        assert difference[1] <= 1
+
+
+def test_seams_are_blended_between_different_tiles():
+    plan = TilePlan(512, 256, 512, 256, tile_size=256, overlap=32)
+    colours = ['black', 'white']
+    result = blend(plan, lambda tile: solid_tile(tile, colours[tile.index]), [0, 1])
+    row = [result.getpixel((x, 128))[0] for x in range(plan.tiles[0].core[2] - 16, 272)]
+    assert row == sorted(row)
+    assert 0 < row[len(row) // 2] < 255
+    assert result.getpixel((0, 0))[0] == 0
+    assert result.getpixel((511, 0))[0] == 255
+
+
+def test_already_written_tiles_are_blended_over():
+    plan = TilePlan(512, 256, 512, 256, tile_size=256, overlap=32)
+    destination = Image.new('RGBA', (512, 256), 'black')
+    blender = TileBlender(
+        plan, destination.crop, lambda box, image: destination.paste(image, box[:2]),
+        written=[(0, 0)]
+    )
+    blender.add(plan.tiles[1], solid_tile(plan.tiles[1], 'white'))
+    assert blender.finished
+    assert destination.getpixel((0, 0))[0] == 0
+    assert 0 < destination.getpixel((256, 128))[0] < 255
+
+
+def test_mask_crop_box_is_mask_bounds_with_margin_rounded_to_multiple():
+    mask = Image.new('L', (1000, 800))
+    mask.paste(255, (400, 300, 450, 330))
+    left, top, right, bottom = mask_crop_box(mask, margin=32)
+    assert left <= 400 - 32 and top <= 300 - 32 and right >= 450 + 32 and bottom >= 330 + 32
+    assert (right - left) % CROP_MULTIPLE == 0 and (bottom - top) % CROP_MULTIPLE == 0
+    assert 0 <= left and 0 <= top and right <= 1000 and bottom <= 800
+
+
+def test_mask_crop_box_is_shifted_inside_image_at_edges():
+    mask = Image.new('L', (1000, 800))
+    mask.paste(255, (0, 790, 10, 800))
+    left, top, right, bottom = mask_crop_box(mask, margin=64)
+    assert (left, bottom) == (0, 800)
+    assert (right - left) % CROP_MULTIPLE == 0 and (bottom - top) % CROP_MULTIPLE == 0
+
+
+def test_mask_crop_box_of_empty_mask_is_none():
+    assert mask_crop_box(Image.new('L', (64, 64)), margin=16) is None
+
+
+def test_mask_crop_box_never_exceeds_image():
+    mask = Image.new('L', (100, 70), 255)
+    assert mask_crop_box(mask, margin=64) == (0, 0, 100, 70)
+
+
+def test_tile_digests_report_progress_of_each_tile():
+    plan = TilePlan(1536, 1024, 1536, 1024, tile_size=512)
+    progress = []
+    digests = tile_digests(Image.new('RGBA', (1536, 1024)), plan, progress.append)
+    assert len(digests) == len(plan.tiles)
+    assert sorted(progress) == [(i + 1) / len(plan.tiles) for i in range(len(plan.tiles))]
@@ -0,0 +1,73 @@
+import os
+
+from PIL import Image
+
+from image_ai_utils.common import upload_cache
+from image_ai_utils.common.image_codecs import EncodedImage, encode_raw
+from image_ai_utils.common.pixel_buffer import PixelBuffer
+from image_ai_utils.common.upload_cache import UploadCache, image_digest
+
+
+def random_image(size=(40, 600)) -> Image.Image:
+    return Image.frombytes('RGBA', size, os.urandom(size[0] * size[1] * 4))
+
+
+def test_digest_depends_only_on_pixels():
+    image = random_image()
+    assert image_digest(image) == image_digest(image.copy())
+    changed = image.copy()
+    changed.putpixel((3, 500), (0, 0, 0, 0) if image.getpixel((3, 500)) != (0, 0, 0, 0) else 1)
+    assert image_digest(changed) != image_digest(image)
+
+
+def test_digest_depends_on_size():
+    image = Image.new('RGBA', (20, 10))
+    assert image_digest(image) != image_digest(Image.new('RGBA', (10, 20)))
+
+
+def test_digest_doesnt_depend_on_strip_height(monkeypatch):
+    image = random_image()
+    digest = image_digest(image)
+    monkeypatch.setattr(upload_cache, 'DIGEST_STRIP_HEIGHT', 7)
+    assert image_digest(image) == digest
+
+
+def test_pixel_buffer_crop_digest_matches_copied_buffer():
+    image = random_image()
+    buffer = PixelBuffer(image.tobytes('raw', 'BGRA'), *image.size)
+    box = (5, 100, 35, 300)
+    copy = PixelBuffer(image.crop(box).tobytes('raw', 'BGRA'), 30, 200)
+    assert image_digest(buffer.crop(box)) == image_digest(copy)
+
+
+def test_pixel_buffer_and_image_with_same_pixels_hash_alike():
+    image = random_image()
+    buffer = PixelBuffer(image.tobytes('raw', 'BGRA'), *image.size)
+    assert image_digest(buffer) == image_digest(image)
+    opaque = image.convert('RGB')
+    buffer = PixelBuffer(opaque.convert('RGBA').tobytes('raw', 'BGRA'), *image.size)
+    assert image_digest(buffer) == image_digest(opaque)
+
+
+def test_deep_image_isnt_hashed_as_8_bit():
+    image = Image.new('I;16', (4, 4), 257)
+    assert image_digest(image) != image_digest(Image.new('RGBA', (4, 4), (1, 1, 1, 255)))
+    assert image_digest(image) != image_digest(Image.new('I;16', (4, 4), 258))
+
+
+def test_encoded_image_is_hashed_without_decoding():
+    encoded = EncodedImage(encode_raw(random_image()))
+    assert image_digest(encoded) == image_digest(EncodedImage(encoded.data))
+    assert not encoded.loaded
+
+
+def test_least_recently_used_digest_is_evicted():
+    cache = UploadCache(max_size=2)
+    cache.add('first')
+    cache.add('second')
+    assert cache.touch('first')
+    cache.add('third')
+    assert not cache.touch('second')
+    assert cache.touch('first') and cache.touch('third')
+    cache.discard(['first'])
+    assert len(cache) == 1
@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+import pytest
+import websockets
+
+from image_ai_utils.common.exceptions import WebSocketException, ConnectionLostException
+from image_ai_utils.common.websocket_session import WebSocketSession
+
+
+# Session stand-in: reports progress of every request, then finishes it
+async def handler(websocket, path=None):
+    await websocket.recv()
+    async for message in websocket:
+        request = json.loads(message)
+        if 'action' in request:
+            continue
+        request_id = request['request_id']
+        await websocket.send(json.dumps({
+            'request_id': request_id, 'status': 'progress', 'progress': 0.5
+        }))
+        await websocket.send(json.dumps({
+            'request_id': request_id, 'status': 'finished', 'result': request['data']
+        }))
+
+
+async def open_session():
+    server = await websockets.serve(handler, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, WebSocketSession(f'ws://127.0.0.1:{port}/', ('user', 'password'))
+
+
+def test_broken_update_fails_only_its_request():
+    def broken_update(update, attachments):
+        raise KeyError('progress')
+
+    async def run():
+        server, session = await open_session()
+        try:
+            broken, working = await asyncio.gather(
+                session.request('test', {'value': 1}, update_callback=broken_update),
+                session.request('test', {'value': 2}, update_callback=lambda *_: None),
+                return_exceptions=True
+            )
+            again, _ = await session.request('test', {'value': 3})
+            return broken, working, again, session.connected
+        finally:
+            await session.close()
+            server.close()
+
+    broken, working, again, connected = asyncio.run(run())
+    assert isinstance(broken, WebSocketException)
+    assert working[0]['result'] == {'value': 2}
+    assert again['result'] == {'value': 3}
+    assert connected
+
+
+def test_reader_failure_closes_socket_and_fails_pending(monkeypatch):
+    def failing_dispatch(self, message):
+        raise RuntimeError('reader bug')
+
+    async def run():
+        server, session = await open_session()
+        monkeypatch.setattr(WebSocketSession, '_dispatch', failing_dispatch)
+        try:
+            websocket = await session._ensure_connected()
+            with pytest.raises(ConnectionLostException):
+                await asyncio.wait_for(session.request('test', {'value': 1}), 5)
+            await asyncio.wait_for(session._reader, 5)
+            return websocket.close_code, session.connected
+        finally:
+            await session.close()
+            server.close()
+
+    close_code, connected = asyncio.run(run())
+    assert close_code is not None
+    assert not connected
+
+
+def test_attachment_arrives_as_one_message_with_request_id_prefix():
+    received = []
+
+    async def attachment_handler(websocket, path=None):
+        await websocket.recv()
+        request = json.loads(await websocket.recv())
+        received.append(await websocket.recv())
+        await websocket.send(json.dumps({
+            'request_id': request['request_id'], 'status': 'finished', 'result': {}
+        }))
+
+    async def run():
+        server = await websockets.serve(attachment_handler, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        session = WebSocketSession(f'ws://127.0.0.1:{port}/', ('user', 'password'))
+        try:
+            await session.request('test', {}, attachments=[memoryview(bytes(range(256)) * 64)])
+        finally:
+            await session.close()
+            server.close()
+
+    asyncio.run(run())
+    message, = received
+    assert len(message) == WebSocketSession.REQUEST_ID_LENGTH + 256 * 64
+    assert message[WebSocketSession.REQUEST_ID_LENGTH:] == bytes(range(256)) * 64